@@ -15,16 +15,28 @@ from google.colab import drive
 drive.mount('/content/drive')
 
 import os
+import re
+import math
+import hashlib
+import time
+import random
+import contextlib
+import copy
 import torch
+import torch.utils.checkpoint
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 from torchvision import transforms, models
 from PIL import Image
 import matplotlib.pyplot as plt
 import numpy as np
 from cornet import cornet_s
 from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from cornet.cornet_s import CORblock_S
 import json
 
@@ -37,6 +49,7 @@ else:
 
 MODEL_DIR = os.path.join(BASE_PATH, "models")
 OUTPUT_DIR = os.path.join(BASE_PATH, "output_images")
+WEIGHTS_DIR = os.path.join(os.path.dirname(DATA_ROOT), "pretrained_weights")
 
 os.makedirs(MODEL_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -70,38 +83,353 @@ model_filenames = {
 }
 
 # Prepare to read the image pair
-def read_pairs(file_path, label):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    return [(line.strip().split()[0], line.strip().split()[1], label) for line in lines]
+# Pair index: int32 rows of (left id, right id, label, fold, split), ids point into `names`
+PAIR_SPLITS = ["train", "test"]
 
-def load_all_pairs(list_dir):
-    all_pairs = []
+def pair_list_files(list_dir):
+    files = []
     for i in range(1, 11):
         prefix = f"{i:02d}"
-        for split in ["train", "test"]:
-            same_file = os.path.join(list_dir, f"{prefix}_{split}_same.txt")
-            diff_file = os.path.join(list_dir, f"{prefix}_{split}_diff.txt")
-            all_pairs += read_pairs(same_file, 1)
-            all_pairs += read_pairs(diff_file, 0)
-    return all_pairs
+        for split in PAIR_SPLITS:
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_same.txt"), 1, i, PAIR_SPLITS.index(split)))
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_diff.txt"), 0, i, PAIR_SPLITS.index(split)))
+    return files
+
+def load_pair_index(list_dir, cache_dir=None):
+    files = pair_list_files(list_dir)
+    digest = hashlib.sha1()
+    for path, _, _, _ in files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    key = digest.hexdigest()[:16]
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(list_dir), "pair_index")
+    names_path = os.path.join(cache_dir, f"names_{key}.npy")
+    pairs_path = os.path.join(cache_dir, f"pairs_{key}.npy")
+    if os.path.exists(names_path) and os.path.exists(pairs_path):
+        return np.load(names_path), np.load(pairs_path)
+
+    ids = {}
+    rows = []
+    for path, label, fold, split in files:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                left = ids.setdefault(fields[0], len(ids))
+                right = ids.setdefault(fields[1], len(ids))
+                rows.append((left, right, label, fold, split))
+
+    names = np.array(list(ids), dtype=str)
+    pairs = np.array(rows, dtype=np.int32).reshape(-1, 5)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(names_path, names)
+    np.save(pairs_path, pairs)
+    print(f"Pair index built: {len(pairs)} pairs, {len(names)} faces → {pairs_path}")
+    return names, pairs
+
+def select_pairs(pairs, fold=None, split=None, label=None):
+    mask = np.ones(len(pairs), dtype=bool)
+    if fold is not None:
+        mask &= pairs[:, 3] == fold
+    if split is not None:
+        mask &= pairs[:, 4] == PAIR_SPLITS.index(split)
+    if label is not None:
+        mask &= pairs[:, 2] == label
+    return pairs[mask]
+
+def dedupe_pairs(pairs):
+    # (a, b) and (b, a) with the same label count as one pair, first occurrence is kept
+    key = np.stack([pairs[:, :2].min(axis=1), pairs[:, :2].max(axis=1), pairs[:, 2]], axis=1)
+    _, first = np.unique(key, axis=0, return_index=True)
+    return pairs[np.sort(first)]
+
+# LFWCrop faces are binary PPM (P6), so the pixel block can be mapped directly without PIL
+PPM_HEADER = re.compile(rb'P6(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)\s')
+
+def read_ppm(path):
+    with open(path, 'rb') as f:
+        header = PPM_HEADER.match(f.read(512))
+    if header is None or int(header.group(3)) > 255:
+        return None
+    width, height = int(header.group(1)), int(header.group(2))
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=header.end(), shape=(height, width, 3))
+
+def load_pixels(path):
+    # Other formats (e.g. the .jpg illusion stimuli) fall back to PIL
+    pixels = read_ppm(path) if path.lower().endswith(".ppm") else None
+    if pixels is None:
+        pixels = np.asarray(Image.open(path).convert("RGB"))
+    return pixels
+
+def load_image(path):
+    return Image.fromarray(np.asarray(load_pixels(path)))
+
+# Decode every face once into a memory-mapped uint8 store (faces.npy + name -> row index)
+def build_face_store(names, image_dir, store_dir):
+    names = [str(name) for name in names]
+    faces_path = os.path.join(store_dir, "faces.npy")
+    index_path = os.path.join(store_dir, "index.json")
+
+    if os.path.exists(faces_path) and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if all(name in index for name in names):
+            return faces_path, index
+
+    os.makedirs(store_dir, exist_ok=True)
+    first = np.asarray(load_image(os.path.join(image_dir, names[0] + ".ppm")))
+    faces = np.lib.format.open_memmap(faces_path, mode='w+', dtype=np.uint8, shape=(len(names),) + first.shape)
+    for row, name in enumerate(names):
+        faces[row] = np.asarray(load_image(os.path.join(image_dir, name + ".ppm")))
+    faces.flush()
+    del faces
+
+    # The index is written last, so an interrupted build is redone next time
+    index = {name: row for row, name in enumerate(names)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f"Face store built: {len(names)} faces → {faces_path}")
+    return faces_path, index
 
 class FacePairsDataset(Dataset):
-    def __init__(self, pairs, image_dir, transform=None):
+    def __init__(self, pairs, names, image_dir, transform=None, store=None, raw=False):
         self.pairs = pairs
+        self.names = names
         self.image_dir = image_dir
         self.transform = transform or transforms.ToTensor()
+        # store = (faces_path, index) from build_face_store, pairs are then served by row lookup
+        self.store = store
+        # raw = True skips the transform and returns uint8 CHW tensors for prepare_batch
+        self.raw = raw
+        self._faces = None
 
     def __len__(self):
         return len(self.pairs)
 
+    def _load(self, name):
+        if self.store is None:
+            pixels = load_pixels(os.path.join(self.image_dir, name + ".ppm"))
+        else:
+            if self._faces is None:
+                # Opened lazily so that every DataLoader worker maps the file on its own
+                self._faces = np.load(self.store[0], mmap_mode='r')
+            pixels = self._faces[self.store[1][name]]
+        if self.raw:
+            return torch.from_numpy(np.array(pixels)).permute(2, 0, 1)
+        return self.transform(Image.fromarray(np.asarray(pixels)))
+
+    def __getitem__(self, idx):
+        left, right, label = self.pairs[idx, :3]
+        img1 = self._load(str(self.names[left]))
+        img2 = self._load(str(self.names[right]))
+        return img1, img2, torch.tensor(label, dtype=torch.float32)
+
+# Resized uint8 faces per training resolution, written once as memory-mapped shards + manifest.json. Each script
+# builds only the size it trains at (sizes); another size is added to the same cache the first time it is asked for
+CACHE_SIZES = (64, 224, 256)
+
+def build_resized_cache(names, face_store, cache_dir, sizes=CACHE_SIZES, shard_size=4096):
+    names = [str(name) for name in names]
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {"names": names, "sizes": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            cached = json.load(f)
+        if cached["names"] == names:
+            manifest = cached
+
+    missing = [size for size in sizes if str(size) not in manifest["sizes"]]
+    if not missing:
+        return manifest_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    faces = np.load(face_store[0], mmap_mode='r')
+    # transforms.Resize on the decoded face, so cached pixels equal today's Resize + ToTensor output
+    resizers = {size: transforms.Resize((size, size)) for size in missing}
+    shards = {size: [] for size in missing}
+
+    for start in range(0, len(names), shard_size):
+        chunk = names[start:start + shard_size]
+        arrays = {}
+        for size in missing:
+            file_name = f"faces_{size}_{start // shard_size:03d}.npy"
+            arrays[size] = np.lib.format.open_memmap(os.path.join(cache_dir, file_name), mode='w+',
+                                                     dtype=np.uint8, shape=(len(chunk), 3, size, size))
+            shards[size].append({"file": file_name, "start": start, "count": len(chunk)})
+        for row, name in enumerate(chunk):
+            image = Image.fromarray(np.asarray(faces[face_store[1][name]]))
+            for size in missing:
+                arrays[size][row] = np.asarray(resizers[size](image)).transpose(2, 0, 1)
+        for array in arrays.values():
+            array.flush()
+
+    for size in missing:
+        manifest["sizes"][str(size)] = shards[size]
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    print(f"Face cache built for sizes {missing} → {cache_dir}")
+    return manifest_path
+
+class ShardedFacePairsDataset(Dataset):
+    def __init__(self, pairs, names, manifest_path, size):
+        self.pairs = pairs
+        self.names = names
+        self.size = size
+        self.cache_dir = os.path.dirname(manifest_path)
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        self.shards = manifest["sizes"][str(size)]
+        self.starts = np.array([shard["start"] for shard in self.shards])
+        cache_rows = {name: row for row, name in enumerate(manifest["names"])}
+        # image id (from the pair index) -> row in the cache
+        self.rows = np.array([cache_rows[str(name)] for name in names])
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def _load(self, image_id):
+        if self._arrays is None:
+            # Opened lazily so that every DataLoader worker maps the shards on its own
+            self._arrays = [np.load(os.path.join(self.cache_dir, shard["file"]), mmap_mode='r') for shard in self.shards]
+        row = self.rows[image_id]
+        shard = np.searchsorted(self.starts, row, side='right') - 1
+        return torch.from_numpy(np.array(self._arrays[shard][row - self.starts[shard]]))
+
+    def __getitem__(self, idx):
+        left, right, label = self.pairs[idx, :3]
+        return self._load(left), self._load(right), torch.tensor(label, dtype=torch.float32)
+
+# Every distinct face of a pair dataset once, in sorted id order (for per-image evaluation)
+class UniqueFacesDataset(Dataset):
+    def __init__(self, pair_dataset):
+        self.pair_dataset = pair_dataset
+        self.ids = np.unique(pair_dataset.pairs[:, :2])
+
+    def __len__(self):
+        return len(self.ids)
+
     def __getitem__(self, idx):
-        name1, name2, label = self.pairs[idx]
-        name1 += ".ppm"
-        name2 += ".ppm"
-        img1 = Image.open(os.path.join(self.image_dir, name1)).convert("RGB")
-        img2 = Image.open(os.path.join(self.image_dir, name2)).convert("RGB")
-        return self.transform(img1), self.transform(img2), torch.tensor(label, dtype=torch.float32)
+        return self.pair_dataset._load(self.ids[idx])
+
+# Shuffling sampler whose order depends only on (seed, epoch), so an interrupted epoch can restart at any batch
+class ResumableSampler(Sampler):
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        # start = number of samples of this epoch already consumed
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+# Batched Resize + ToTensor for the uint8 batches of a raw FacePairsDataset, float batches pass through
+def prepare_batch(images, size):
+    if images.dtype != torch.uint8:
+        return images
+    images = images.float().div_(255)
+    if tuple(images.shape[-2:]) != (size, size):
+        images = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+    return images
+
+def check_batch_resize(dataset, transform, size, num_batches=20, batch_size=64, num_workers=4, save_path=None):
+    # Throughput of per-sample PIL Resize vs. raw uint8 + prepare_batch, and how far apart the outputs are
+    pil_dataset = FacePairsDataset(dataset.pairs, dataset.names, dataset.image_dir, transform=transform, store=dataset.store)
+    raw_dataset = FacePairsDataset(dataset.pairs, dataset.names, dataset.image_dir, store=dataset.store, raw=True)
+
+    results = {"size": size}
+    for mode, ds in (("pil", pil_dataset), ("batched", raw_dataset)):
+        loader = DataLoader(ds, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        seen = 0
+        start = time.time()
+        for b, (img1, img2, _) in enumerate(loader):
+            if b == num_batches:
+                break
+            img1, img2 = prepare_batch(img1, size), prepare_batch(img2, size)
+            seen += img1.size(0)
+        results[f"{mode}_samples_per_sec"] = seen / (time.time() - start)
+
+    n = min(batch_size, len(dataset))
+    reference = torch.stack([pil_dataset[i][0] for i in range(n)])
+    batched = prepare_batch(torch.stack([raw_dataset[i][0] for i in range(n)]), size)
+    results["max_abs_diff"] = (reference - batched).abs().max().item()
+    results["speedup"] = results["batched_samples_per_sec"] / results["pil_samples_per_sec"]
+
+    print(f"Resize {size}x{size}: PIL {results['pil_samples_per_sec']:.1f} samples/s | "
+          f"batched {results['batched_samples_per_sec']:.1f} samples/s | max diff {results['max_abs_diff']:.5f}")
+    # PIL rounds to uint8 after resampling, so one grey level is the expected gap
+    if results["max_abs_diff"] > 2 / 255:
+        print(f"Warning: prepare_batch differs from transforms.Resize by more than 2/255 ({results['max_abs_diff']:.5f})")
+
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+# Pretrained backbones come from a local registry in WEIGHTS_DIR: one flat state-dict file per backbone,
+# sha256-checked against registry.json and memory-mapped on load. A missing entry is fetched once from
+# PRETRAINED_SOURCES, which needs network, so populate the registry on such a machine first.
+PRETRAINED_SOURCES = {
+    "resnet18": lambda: models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1),
+}
+_verified_weights = set()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_weight_registry(weights_dir):
+    registry_path = os.path.join(weights_dir, "registry.json")
+    if not os.path.exists(registry_path):
+        return {}
+    with open(registry_path, 'r') as f:
+        return json.load(f)
+
+def register_weights(name, state_dict, weights_dir=None):
+    weights_dir = weights_dir or WEIGHTS_DIR
+    os.makedirs(weights_dir, exist_ok=True)
+    path = os.path.join(weights_dir, f"{name}.pt")
+    torch.save({key: value.detach().cpu().contiguous() for key, value in state_dict.items()}, path)
+
+    registry = read_weight_registry(weights_dir)
+    registry[name] = {"file": f"{name}.pt", "sha256": file_sha256(path), "bytes": os.path.getsize(path)}
+    with open(os.path.join(weights_dir, "registry.json"), 'w') as f:
+        json.dump(registry, f, indent=2)
+    print(f"Registered pretrained weights {name} → {path}")
+
+def pretrained_state(name, weights_dir=None):
+    weights_dir = weights_dir or WEIGHTS_DIR
+    registry = read_weight_registry(weights_dir)
+    if name not in registry:
+        register_weights(name, PRETRAINED_SOURCES[name]().state_dict(), weights_dir)
+        registry = read_weight_registry(weights_dir)
+
+    entry = registry[name]
+    path = os.path.join(weights_dir, entry["file"])
+    stat = os.stat(path)
+    # Hash once per file version and process, later loads are plain page-cache reads
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _verified_weights:
+        if file_sha256(path) != entry["sha256"]:
+            raise ValueError(f"Pretrained weights {name} do not match the registry hash: {path}")
+        _verified_weights.add(key)
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
 
 # The CORnet Model
 class ChannelAlign(nn.Module):
@@ -115,10 +443,162 @@ class ChannelAlign(nn.Module):
     def forward(self, x):
         return self.proj(x)
 
+# Iteration t of CORblock_S.forward on the state x (x is conv_input(inp) for t = 0)
+def corblock_step(block, x, t):
+    if isinstance(block, FoldedCORblock):
+        return block.step(x, t)
+    if t == 0:
+        skip = block.norm_skip(block.skip(x))
+        block.conv2.stride = (2, 2)
+    else:
+        skip = x
+        block.conv2.stride = (1, 1)
+    x = block.conv1(x)
+    x = getattr(block, f'norm1_{t}')(x)
+    x = block.nonlin1(x)
+    x = block.conv2(x)
+    x = getattr(block, f'norm2_{t}')(x)
+    x = block.nonlin2(x)
+    x = block.conv3(x)
+    x = getattr(block, f'norm3_{t}')(x)
+    x += skip
+    return block.nonlin3(x)
+
+# CORblock_S.forward unrolled as a generator, yielding the block state after every recurrent iteration
+def corblock_steps(block, inp):
+    x = block.conv_input(inp)
+    for t in range(block.times):
+        x = corblock_step(block, x, t)
+        yield block.output(x)
+
+# Output of `block` after only its first `steps` recurrent iterations (truncated unroll of a longer block)
+def run_corblock(block, x, steps):
+    if steps >= block.times:
+        return block(x)
+    for _, out in zip(range(steps), corblock_steps(block, x)):
+        pass
+    return out
+
+# Truncated BPTT over the first `steps` iterations of `block`: the state is detached right before the last k
+# iterations, so backward runs through those k only. In CORblock_S the input enters at step 0, so a truncated
+# block passes no gradient to conv_input or to the layers below it.
+# straight_through = True keeps step 0 in the graph as well (k + 1 iterations) and passes the gradient from the
+# detached state to step 0 as identity, so the layers below still learn; the skipped iterations get no gradient
+def run_corblock_truncated(block, x, steps, k, straight_through=False):
+    if steps <= (k + 1 if straight_through else k):
+        return run_corblock(block, x, steps)
+    if straight_through:
+        h0 = corblock_step(block, block.conv_input(x), 0)
+        h = h0.detach()
+        start = 1
+    else:
+        h = block.conv_input(x)
+        start = 0
+    with torch.no_grad():
+        for t in range(start, steps - k):
+            h = corblock_step(block, h, t)
+    if straight_through:
+        h = h + (h0 - h0.detach())
+    for t in range(steps - k, steps):
+        h = corblock_step(block, h, t)
+    return block.output(h)
+
+# Early exit (inference only): at most max_steps iterations of `block`, a sample halts once the relative change
+# of its state between two iterations falls below tol. Halted samples leave the batch, so later iterations only
+# run on the samples still changing. Returns the output and the iterations used per sample
+def corblock_adaptive(block, inp, tol, max_steps):
+    x = corblock_step(block, block.conv_input(inp), 0)
+    steps = torch.ones(x.size(0), dtype=torch.long, device=x.device)
+    active = torch.arange(x.size(0), device=x.device)
+    for t in range(1, min(max_steps, block.times)):
+        h = x[active]
+        new = corblock_step(block, h, t)
+        change = (new - h).float().flatten(1).norm(dim=1) / h.float().flatten(1).norm(dim=1).clamp_min(1e-12)
+        x = x.index_copy(0, active, new)
+        steps[active] += 1
+        active = active[change >= tol]
+        if active.numel() == 0:
+            break
+    return block.output(x), steps
+
+# CORblock_S for inference with its conv -> BatchNorm pairs folded. The block reuses conv1-3 on every iteration with
+# per-iteration norms, so every iteration gets its own folded copy (conv2 with the stride of that iteration)
+class FoldedCORblock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.times = block.times
+        self.conv_input = block.conv_input
+        self.skip = torch.nn.utils.fuse_conv_bn_eval(block.skip, block.norm_skip)
+        self.nonlin1, self.nonlin2, self.nonlin3 = block.nonlin1, block.nonlin2, block.nonlin3
+        self.output = block.output
+        for t in range(block.times):
+            for i in (1, 2, 3):
+                setattr(self, f'conv{i}_{t}', torch.nn.utils.fuse_conv_bn_eval(getattr(block, f'conv{i}'), getattr(block, f'norm{i}_{t}')))
+            getattr(self, f'conv2_{t}').stride = (2, 2) if t == 0 else (1, 1)
+
+    def step(self, x, t):
+        skip = self.skip(x) if t == 0 else x
+        x = self.nonlin1(getattr(self, f'conv1_{t}')(x))
+        x = self.nonlin2(getattr(self, f'conv2_{t}')(x))
+        x = getattr(self, f'conv3_{t}')(x)
+        x += skip
+        return self.nonlin3(x)
+
+    def forward(self, inp):
+        for out in corblock_steps(self, inp):
+            pass
+        return out
+
+# Recompute context of a checkpointed segment: the BatchNorm running stats of its modules are restored after the
+# recomputation in backward, so they are updated once per training step as without checkpointing
+@contextlib.contextmanager
+def restore_bn_stats(modules):
+    buffers = [buf for module in modules for buf in module.buffers()]
+    saved = [buf.clone() for buf in buffers]
+    try:
+        yield
+    finally:
+        # Also runs when the recomputation stops early, once the tensors backward needs are recomputed
+        with torch.no_grad():
+            for buf, value in zip(buffers, saved):
+                buf.copy_(value)
+
+# Activation checkpointing: only the input of fn is kept, its activations are recomputed during backward
+def checkpoint_segment(fn, x, *modules):
+    modules = [module for module in modules if module is not None]
+    return torch.utils.checkpoint.checkpoint(fn, x, use_reentrant=False,
+                                             context_fn=lambda: (contextlib.nullcontext(), restore_bn_stats(modules)))
+
+# First `steps` iterations of `block` as checkpointed segments of `every` iterations each
+def run_corblock_checkpointed(block, x, steps, every):
+    for start in range(0, steps, every):
+        def segment(h, start=start):
+            if start == 0:
+                h = block.conv_input(h)
+            for t in range(start, min(start + every, steps)):
+                h = corblock_step(block, h, t)
+            return h
+        x = checkpoint_segment(segment, x, block)
+    return block.output(x)
+
+# Run fn once per group of equally shaped states (stacked along the batch), outputs in input order
+def apply_stacked(fn, states):
+    groups = {}
+    for i, state in enumerate(states):
+        groups.setdefault(tuple(state.shape), []).append(i)
+    outputs = [None] * len(states)
+    for idx in groups.values():
+        out = fn(torch.cat([states[i] for i in idx]))
+        for i, chunk in zip(idx, out.chunk(len(idx))):
+            outputs[i] = chunk
+    return outputs
+
 class PretrainedCORnetEmbedding(nn.Module):
     def __init__(self, times_dict, pretrained=True):
         super().__init__()
-        self.resnet = models.resnet18(pretrained=pretrained)
+        self.resnet = models.resnet18()
+        if pretrained:
+            self.resnet.load_state_dict(pretrained_state("resnet18"))
         def get_times(region): return times_dict.get(region, 2)
         self.v2_time = get_times('V2')
         self.v4_time = get_times('V4')
@@ -135,8 +615,66 @@ class PretrainedCORnetEmbedding(nn.Module):
 
         self.pool = nn.AdaptiveAvgPool2d((1, 1))
         self.flatten = nn.Flatten()
+        # Supernet mode: a {"V2", "V4", "IT"} times dict that truncates each region's unroll at that time
+        # (never beyond the configured one); None runs the full configured unroll
+        self.active_times = None
+        # Early exit: exit_tol halts a region's recurrence per sample once its relative state change drops below it,
+        # max_steps caps every region's time; steps_used holds the time each sample used per region (last forward)
+        self.exit_tol = None
+        self.max_steps = None
+        self.steps_used = {}
+        # Activation checkpointing while training: {region: "region" | k}. "region" recomputes the region's ResNet
+        # layers and whole unroll as one segment, k checkpoints the layers and then every k recurrent steps
+        self.activation_checkpoints = {}
+        # Truncated BPTT while training: {region: k} backpropagates through the last k recurrent iterations only
+        # (regions trained this way skip step-level checkpointing, their backward is already bounded)
+        self.bptt_steps = {}
+        # bptt_straight_through = True also keeps the gradient path to the region input (see run_corblock_truncated)
+        self.bptt_straight_through = False
+
+    def region_time(self, region, configured):
+        time = configured if self.active_times is None else min(self.active_times.get(region, 2), configured)
+        return time if self.max_steps is None else min(time, self.max_steps)
+
+    def run_recurrent(self, region, x, time):
+        block = getattr(self, f'{region}_recurrent')
+        if self.exit_tol is None:
+            k = self.bptt_steps.get(region) if self.training and torch.is_grad_enabled() else None
+            if k:
+                return run_corblock_truncated(block, x, time - 1, k, self.bptt_straight_through)
+            return run_corblock(block, x, time - 1)
+        if self.training:
+            raise ValueError("Early exit is inference-only (BatchNorm must use running stats), call model.eval() first")
+        x, steps = corblock_adaptive(block, x, self.exit_tol, time - 1)
+        self.steps_used[region] = steps + 1
+        return x
+
+    def run_region(self, region, layers, x, time):
+        block = getattr(self, f'{region}_recurrent') if time > 1 else None
+        segment = self.activation_checkpoints.get(region) if self.training and torch.is_grad_enabled() else None
+
+        def run_layers(h):
+            for layer in layers:
+                h = layer(h)
+            return h
+
+        def run(h):
+            h = run_layers(h)
+            return self.run_recurrent(region, h, time) if block is not None else h
+
+        if segment is None:
+            return run(x)
+        if segment == "region":
+            return checkpoint_segment(run, x, *layers, block)
+        x = checkpoint_segment(run_layers, x, *layers)
+        if block is None:
+            return x
+        if self.bptt_steps.get(region):
+            return self.run_recurrent(region, x, time)
+        return run_corblock_checkpointed(block, x, time - 1, segment)
 
     def forward(self, x):
+        self.steps_used = {}
         # V1: conv1 + bn1 + relu + maxpool
         x = self.resnet.conv1(x)
         x = self.resnet.bn1(x)
@@ -144,20 +682,13 @@ class PretrainedCORnetEmbedding(nn.Module):
         x = self.resnet.maxpool(x)
 
         # V2: layer1 (BasicBlock x2)
-        x = self.resnet.layer1(x)
-        if self.v2_time > 1:
-            x = self.V2_recurrent(x)
+        x = self.run_region('V2', [self.resnet.layer1], x, self.region_time('V2', self.v2_time))
 
         # V4: layer2 (BasicBlock x2)
-        x = self.resnet.layer2(x)
-        if self.v4_time > 1:
-            x = self.V4_recurrent(x)
+        x = self.run_region('V4', [self.resnet.layer2], x, self.region_time('V4', self.v4_time))
 
         # IT: layer3 (BasicBlock x2) + layer4 (BasicBlock x2)
-        x = self.resnet.layer3(x)
-        x = self.resnet.layer4(x)
-        if self.it_time > 1:
-            x = self.IT_recurrent(x)
+        x = self.run_region('IT', [self.resnet.layer3, self.resnet.layer4], x, self.region_time('IT', self.it_time))
 
         # Pooling and Flatten
         x = self.pool(x)
@@ -165,9 +696,42 @@ class PretrainedCORnetEmbedding(nn.Module):
 
         return x
 
+    def forward_anytime(self, x, region='IT'):
+        # Embedding after every recurrent step of `region` in one unrolled pass: [region time, B, D], where
+        # index 0 skips the recurrence and the last index equals forward(x). Earlier regions run once at their
+        # configured depth, later regions run once on all step states together
+        stages = [
+            ('V2', [self.resnet.layer1], getattr(self, 'V2_recurrent', None)),
+            ('V4', [self.resnet.layer2], getattr(self, 'V4_recurrent', None)),
+            ('IT', [self.resnet.layer3, self.resnet.layer4], getattr(self, 'IT_recurrent', None))
+        ]
+        x = self.resnet.maxpool(self.resnet.relu(self.resnet.bn1(self.resnet.conv1(x))))
+        states = None
+        for name, layers, block in stages:
+            def run(h, layers=layers, block=block):
+                for layer in layers:
+                    h = layer(h)
+                return block(h) if block is not None else h
+
+            if states is not None:
+                states = apply_stacked(run, states)
+            elif name == region:
+                for layer in layers:
+                    x = layer(x)
+                states = [x] + (list(corblock_steps(block, x)) if block is not None else [])
+            else:
+                x = run(x)
+
+        return torch.stack(apply_stacked(lambda h: self.flatten(self.pool(h)), states))
+
 class SiamesePretrainedCORnet(nn.Module):
-    def __init__(self, times_dict, pretrained=True, freeze_backbone=False):
+    def __init__(self, times_dict, pretrained=True, freeze_backbone=False, input_size=256, single_pass=False):
         super().__init__()
+        self.input_size = input_size
+        # single_pass = True embeds x1 and x2 as one 2B batch (one backbone call per step).
+        # In train mode BatchNorm then normalises with the joint statistics of both branches and
+        # updates its running stats once per step instead of once per branch; eval mode is unchanged.
+        self.single_pass = single_pass
         self.embedding_net = PretrainedCORnetEmbedding(times_dict, pretrained=pretrained)
 
         if freeze_backbone:
@@ -190,11 +754,216 @@ class SiamesePretrainedCORnet(nn.Module):
         else:
             print("使用预训练权重作为初始化，将训练所有层")
 
+    def forward_once(self, x):
+        return self.embedding_net(prepare_batch(x, self.input_size))
+
     def forward(self, x1, x2):
+        x1 = prepare_batch(x1, self.input_size)
+        x2 = prepare_batch(x2, self.input_size)
+        if self.single_pass:
+            f = self.embedding_net(torch.cat([x1, x2]))
+            return f[:x1.size(0)], f[x1.size(0):]
         f1 = self.embedding_net(x1)
         f2 = self.embedding_net(x2)
         return f1, f2
 
+    def forward_anytime(self, x1, x2, region='IT'):
+        if not hasattr(self.embedding_net, 'forward_anytime'):
+            raise ValueError("forward_anytime needs the fp32 model: the int8 embedding_net (quantize_structure) is a traced graph of the configured unroll only")
+        x = torch.cat([prepare_batch(x1, self.input_size), prepare_batch(x2, self.input_size)])
+        f = self.embedding_net.forward_anytime(x, region)
+        return f[:, :x1.size(0)], f[:, x1.size(0):]
+
+# Build a model straight from a checkpoint: parameters are created on the meta device (no ImageNet copy,
+# no random init of the CORblocks) and the memory-mapped checkpoint tensors are assigned in their place
+def load_checkpoint_model(build, checkpoint_path, device):
+    with torch.device('meta'):
+        model = build()
+    state_dict = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device)
+
+# Fold every Conv2d -> BatchNorm2d pair of an eval-mode module into the conv, in place (the BatchNorm becomes
+# Identity): consecutive children of nn.Sequential, conv<i> / bn<i> of torchvision ResNet blocks and every CORblock_S
+# (replaced by a FoldedCORblock). Returns the number of folded pairs
+def fold_conv_bn(module):
+    folded = 0
+    for name, child in list(module.named_children()):
+        if isinstance(child, CORblock_S):
+            setattr(module, name, FoldedCORblock(child))
+            folded += 1 + 3 * child.times
+        else:
+            folded += fold_conv_bn(child)
+    names = list(module._modules)
+    pairs = list(zip(names, names[1:])) if isinstance(module, nn.Sequential) else []
+    if isinstance(module, (models.ResNet, models.resnet.BasicBlock, models.resnet.Bottleneck)):
+        pairs += [(f'conv{i}', f'bn{i}') for i in (1, 2, 3)]
+    for conv_name, bn_name in pairs:
+        conv, bn = module._modules.get(conv_name), module._modules.get(bn_name)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, conv_name, torch.nn.utils.fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+            folded += 1
+    return folded
+
+# Largest difference of the embeddings and of the pair distances of two Siamese models on the same image pairs
+def inference_equivalence(reference, model, x1, x2):
+    with torch.no_grad():
+        r1, r2 = reference(x1, x2)
+        f1, f2 = model(x1, x2)
+    return {
+        'max_embedding_diff': max((r1 - f1).abs().max().item(), (r2 - f2).abs().max().item()),
+        'max_distance_diff': (F.pairwise_distance(r1, r2) - F.pairwise_distance(f1, f2)).abs().max().item()
+    }
+
+# Inference export of a Siamese model: an eval-mode copy with the conv -> BatchNorm pairs folded, the weights in
+# channels_last (the convolutions then keep their activations channels_last) and no parameter gradients. The copy is
+# checked against the model on example = (x1, x2), random images by default, and a pair distance that moves by more
+# than atol raises ValueError. Returns the copy and the check
+def freeze_for_inference(model, example=None, atol=1e-4):
+    training = model.training
+    model.eval()
+    frozen = copy.deepcopy(model)
+    folded = fold_conv_bn(frozen)
+    frozen = frozen.to(memory_format=torch.channels_last).requires_grad_(False)
+    if example is None:
+        device = next(model.parameters()).device
+        generator = torch.Generator().manual_seed(0)
+        example = [torch.rand(4, 3, model.input_size, model.input_size, generator=generator).to(device) for _ in range(2)]
+    check = dict(inference_equivalence(model, frozen, *example), folded_pairs=folded)
+    model.train(training)
+    if check['max_distance_diff'] > atol:
+        raise ValueError(f"Folded model differs from the original: max pair distance difference {check['max_distance_diff']:.2e}")
+    return frozen, check
+
+# int8 artifact of a checkpoint (quantize_model), stored next to it
+def quantized_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + "_int8.pt"
+
+# Int8 version of a frozen model (freeze_for_inference): its embedding_net is traced with torch.fx and quantized
+# statically, with the activation ranges observed by calibrate(prepared); nn.Linear layers are quantized dynamically
+# (int8 weights, activation range per batch). Quantized kernels run on the CPU only. The traced embedding_net runs
+# the configured unroll only: forward_anytime and early exit (exit_tol) need the fp32 model
+def quantize_structure(frozen, calibrate=None):
+    quantized = copy.deepcopy(frozen).cpu()
+    # Linear layers (also when fused with a following ReLU) stay float in the traced graph for quantize_dynamic
+    qconfig_mapping = get_default_qconfig_mapping('x86')
+    for name, module in quantized.embedding_net.named_modules():
+        if isinstance(module, nn.Linear):
+            qconfig_mapping.set_module_name(name, None)
+    example = torch.rand(1, 3, frozen.input_size, frozen.input_size)
+    prepared = prepare_fx(quantized.embedding_net, qconfig_mapping, (example,))
+    if calibrate is not None:
+        with torch.no_grad():
+            calibrate(prepared)
+    quantized.embedding_net = convert_fx(prepared)
+    return quantize_dynamic(quantized, {nn.Linear, torch.ao.nn.intrinsic.LinearReLU}, dtype=torch.qint8)
+
+# The artifact is the int8 state dict: the quantized structure is rebuilt (uncalibrated) from `build` created on the
+# meta device and materialised as zeros on the CPU, so no pretrained copy, init or equivalence check runs for values
+# that the quantized weights, scales and zero points of the artifact then replace
+def load_quantized_model(build, path):
+    with torch.device('meta'):
+        structure = build()
+    structure = structure.to_empty(device='cpu').eval().requires_grad_(False)
+    with torch.no_grad():
+        for tensor in list(structure.parameters()) + list(structure.buffers()):
+            tensor.zero_()
+    fold_conv_bn(structure)
+    model = quantize_structure(structure)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    return model.eval()
+
+# Post-training int8 quantization for CPU pair scoring (quantize_structure), calibrated on calibration_images faces
+# sampled from `dataset` (the validation pairs). Saves the int8 state dict to save_path and a report of the
+# pair-distance drift and verification-accuracy change against the fp32 model on all pairs of `dataset` to
+# <save_path>_report.json. Returns the int8 model and the report
+def quantize_model(model, dataset, save_path, calibration_images=256, batch_size=32, threshold=0.5):
+    reference = freeze_for_inference(model)[0].cpu()
+    faces = UniqueFacesDataset(dataset)
+    sample = np.random.RandomState(0).permutation(len(faces))[:calibration_images]
+    loader = DataLoader(torch.utils.data.Subset(faces, sample), batch_size=batch_size, shuffle=False, num_workers=4)
+
+    def calibrate(prepared):
+        for images in loader:
+            prepared(prepare_batch(images, model.input_size))
+
+    quantized = quantize_structure(reference, calibrate)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    torch.save(quantized.state_dict(), save_path)
+
+    report = {'calibration_images': len(sample)}
+    results = {}
+    for name, m in (('fp32', reference), ('int8', quantized)):
+        start = time.time()
+        results[name] = evaluate_pairs(m, dataset, torch.device('cpu'), threshold=threshold, batch_size=batch_size)
+        report[f'{name}_accuracy'] = results[name]['accuracy']
+        report[f'{name}_eval_sec'] = time.time() - start
+        report[f'{name}_mb'] = model_nbytes(m) / 1024 ** 2
+    drift = (results['int8']['distances'] - results['fp32']['distances']).abs()
+    flips = (results['int8']['distances'] < threshold) != (results['fp32']['distances'] < threshold)
+    report.update({
+        'num_pairs': results['fp32']['num_pairs'],
+        'accuracy_change': report['int8_accuracy'] - report['fp32_accuracy'],
+        'mean_distance_drift': drift.mean().item(),
+        'max_distance_drift': drift.max().item(),
+        'decision_flips': int(flips.sum())
+    })
+
+    report_path = os.path.splitext(save_path)[0] + "_report.json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"int8 model saved to {save_path} | accuracy {report['fp32_accuracy']:.5f} -> {report['int8_accuracy']:.5f}, "
+          f"mean distance drift {report['mean_distance_drift']:.4f}, {report['fp32_mb']:.1f} -> {report['int8_mb']:.1f} MB")
+    return quantized, report
+
+# Process-wide LRU cache of built models, shared by the prediction, saliency and comparison functions, which only
+# run them forward: the cached models are frozen for inference (freeze_for_inference). Keyed by (architecture, times_dict, checkpoint path, checkpoint mtime, device); least recently used
+# models are dropped once the cached parameters and buffers exceed MODEL_CACHE_BYTES
+MODEL_CACHE_BYTES = 4 * 1024 ** 3
+_model_cache = OrderedDict()
+
+# From the state dict: quantized modules keep their (packed) weights outside parameters()
+def model_nbytes(model):
+    values = [v for value in model.state_dict().values() for v in (value if isinstance(value, tuple) else (value,))]
+    return sum(t.numel() * t.element_size() for t in values if isinstance(t, torch.Tensor))
+
+def cached_model(arch, times_dict, checkpoint_path, device, build, quantized=False):
+    # checkpoint_path = None caches the freshly initialised model from `build`. quantized = True takes the int8
+    # artifact of the checkpoint (quantize_model) instead; int8 kernels run on the CPU only, and a checkpoint
+    # without an artifact is loaded in fp32 with a warning
+    quantized = quantized and checkpoint_path is not None
+    if quantized and torch.device(device).type != 'cpu':
+        raise ValueError(f"{arch}: int8 models run on the CPU only, got device {device}")
+    missing_int8 = None
+    if quantized and not os.path.exists(quantized_path(checkpoint_path)):
+        missing_int8, quantized = quantized_path(checkpoint_path), False
+    if quantized:
+        checkpoint_path = quantized_path(checkpoint_path)
+    mtime = os.path.getmtime(checkpoint_path) if checkpoint_path else None
+    times_key = tuple(sorted(times_dict.items())) if times_dict else None
+    key = (arch, times_key, checkpoint_path, mtime, str(device))
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        return _model_cache[key]
+
+    if missing_int8:
+        print(f"Warning: {arch}: int8 model {missing_int8} not found, using the fp32 checkpoint")
+    if quantized:
+        model = load_quantized_model(build, checkpoint_path)
+        print(f"{arch}: int8 model {checkpoint_path}")
+    else:
+        if checkpoint_path:
+            model = load_checkpoint_model(build, checkpoint_path, device)
+        else:
+            model = build().to(device)
+        model, check = freeze_for_inference(model)
+        print(f"{arch} frozen for inference: {check['folded_pairs']} conv-BN pairs folded, max distance difference {check['max_distance_diff']:.2e}")
+    _model_cache[key] = model
+    while len(_model_cache) > 1 and sum(model_nbytes(m) for m in _model_cache.values()) > MODEL_CACHE_BYTES:
+        _model_cache.popitem(last=False)
+    return model
+
 class ContrastiveLoss(nn.Module):
     def __init__(self, margin=1.0):
         super(ContrastiveLoss, self).__init__()
@@ -206,152 +975,621 @@ class ContrastiveLoss(nn.Module):
                (1 - label) * torch.pow(torch.clamp(self.margin - euclidean_distance, min=0.0), 2)
         return loss.mean()
 
-def compute_accuracy(out1, out2, labels, threshold=0.5):
+# Running loss / accuracy kept as device tensors, read back once per epoch instead of with .item() every batch
+class MetricsAccumulator:
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = 0.0
+        self.correct = 0.0
+        self.count = 0
+
+    def update(self, out1, out2, labels, loss):
+        with torch.no_grad():
+            distances = F.pairwise_distance(out1.float(), out2.float())
+            preds = (distances < self.threshold).float()
+            self.correct = self.correct + (preds == labels).float().sum()
+            # Batch means are weighted by batch size, so a short last batch counts for what it holds
+            self.loss_sum = self.loss_sum + loss.detach().float() * labels.size(0)
+        self.count += labels.size(0)
+
+    def compute(self):
+        return float(self.loss_sum) / self.count, float(self.correct) / self.count
+
+# Mixed precision for the training loops: CUDA fp16 with a GradScaler, CPU bfloat16 where the CPU computes bf16
+# natively (AMX / AVX512-BF16), fp32 otherwise. bf16 keeps the fp32 exponent range, so off CUDA the scaler is a no-op
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'amx_bf16' in flags or 'avx512_bf16' in flags
+
+class MixedPrecision:
+    def __init__(self, device, enabled=True):
+        self.device_type = torch.device(device).type
+        if self.device_type == 'cuda':
+            self.dtype = torch.float16
+        elif self.device_type == 'cpu' and cpu_supports_bf16():
+            self.dtype = torch.bfloat16
+        else:
+            self.dtype = None
+        self.enabled = enabled and self.dtype is not None
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.enabled and self.dtype == torch.float16)
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def __repr__(self):
+        return f"MixedPrecision({self.device_type}, {self.dtype if self.enabled else 'fp32'})"
+
+# Exact resume: a training state holds model, optimizer, GradScaler, RNG and running metrics plus the position
+# (resume_epoch, resume_step = batches of that epoch already done). Train loaders draw their worker seeds from
+# their own generator, so restoring the global RNG reproduces the uninterrupted run from that step on
+RESUME_EVERY_STEPS = 200
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_training_state(path, model, optimizer, scaler, resume_epoch, resume_step, metrics=None, **extra):
+    state = {
+        'resume_epoch': resume_epoch,
+        'resume_step': resume_step,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scaler_state_dict': scaler.state_dict() if scaler is not None else None,
+        'rng_state': rng_state(),
+        'metrics': vars(metrics) if metrics is not None else None
+    }
+    state.update(extra)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_training_state(path, model, optimizer, scaler):
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if 'resume_epoch' not in checkpoint:
+        raise ValueError(f"Checkpoint has no resume state: {path}")
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if scaler is not None and checkpoint['scaler_state_dict'] is not None:
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
+    set_rng_state(checkpoint['rng_state'])
+    return checkpoint
+
+# Evaluation engine: embed each unique face of the split once, then score every pair from the embedding table
+def embed_faces(model, dataset, device, batch_size=64, num_workers=4):
+    faces = UniqueFacesDataset(dataset)
+    loader = DataLoader(faces, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for images in loader:
+            embeddings.append(model.forward_once(images.to(device)).float())
+    return faces.ids, torch.cat(embeddings)
+
+def evaluate_pairs(model, dataset, device, criterion=None, threshold=0.5, batch_size=64, num_workers=4):
+    ids, embeddings = embed_faces(model, dataset, device, batch_size, num_workers)
+    rows = torch.from_numpy(np.searchsorted(ids, dataset.pairs[:, :2])).long().to(embeddings.device)
+    labels = torch.from_numpy(dataset.pairs[:, 2]).float().to(embeddings.device)
+    out1, out2 = embeddings[rows[:, 0]], embeddings[rows[:, 1]]
     distances = F.pairwise_distance(out1, out2)
     preds = (distances < threshold).float()
-    correct = (preds == labels).float().sum()
-    accuracy = correct / labels.size(0)
-    return accuracy.item()
+    results = {
+        'accuracy': (preds == labels).float().mean().item(),
+        'distances': distances.cpu(),
+        'num_images': len(ids),
+        'num_pairs': len(labels)
+    }
+    if criterion is not None:
+        results['loss'] = criterion(out1, out2, labels).item()
+    return results
 
-def train_models(time_settings, num_epochs=10):
+# Sweep scheduler: every (time setting, mode) pair is one job with a state file in SWEEP_DIR. Finished jobs are
+# skipped on restart and interrupted ones resume from their last step-level resume checkpoint. mode is "standard" (CORnet-S)
+# or "full_finetune" / "frozen_backbone" (pretrained ResNet backbone), optionally with a suffix such as
+# "full_finetune_tbptt" that keeps a variant's models and states apart
+SWEEP_DIR = os.path.join(MODEL_DIR, "sweep")
+
+def sweep_paths(t, mode):
+    return os.path.join(SWEEP_DIR, f"{mode}_T{t}.json"), os.path.join(SWEEP_DIR, f"{mode}_T{t}_last.pt")
+
+def read_job_state(state_path):
+    if os.path.exists(state_path):
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    return {'status': 'pending', 'epoch': 0}
+
+def write_job_state(state_path, state):
+    # Written to a temporary file first so an interrupted write never leaves a truncated state file
+    with open(state_path + ".tmp", 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + ".tmp", state_path)
+
+def train_time_setting(job):
+    t, times_dict, mode, num_epochs = job['name'], job['times'], job['mode'], job['num_epochs']
+    # stop_epoch < num_epochs pauses the job there (successive halving rungs), it continues on the next call
+    stop_epoch = min(job.get('stop_epoch') or num_epochs, num_epochs)
+    torch.set_num_threads(job['threads'])
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f"Using device: {device}")
 
-    face_dir = os.path.join(DATA_ROOT, "faces")
-    list_dir = os.path.join(DATA_ROOT, "lists")
-    print(f"Data path: {face_dir}")
+    state_path, last_path = sweep_paths(t, mode)
+    state = read_job_state(state_path)
+    if state['status'] == 'done':
+        print(f"[{mode} T={t}] already trained, skipped")
+        return state['results']
+    state.pop('results', None)
+    state.update({'status': 'running', 'pid': os.getpid(), 'threads': job['threads'], 'started': time.time()})
+    write_job_state(state_path, state)
 
-    pairs = load_all_pairs(list_dir)
-    split_idx = int(0.9 * len(pairs))
-    train_pairs = pairs[:split_idx]
-    val_pairs = pairs[split_idx:]
-
-    transform = transforms.Compose([
-        transforms.Resize((256, 256)),
-        transforms.ToTensor()
-    ])
-
-    train_dataset = FacePairsDataset(train_pairs, face_dir, transform=transform)
-    val_dataset = FacePairsDataset(val_pairs, face_dir, transform=transform)
-
-    train_loader = DataLoader(train_dataset, batch_size=128, shuffle=True, num_workers=8, pin_memory=True)
-    val_loader = DataLoader(val_dataset, batch_size=128, shuffle=False, num_workers=8, pin_memory=True)
-
-    scaler = torch.cuda.amp.GradScaler()
-
-    results = {}
+    train_dataset = ShardedFacePairsDataset(job['train_pairs'], job['names'], job['face_cache'], 256)
+    val_dataset = ShardedFacePairsDataset(job['val_pairs'], job['names'], job['face_cache'], 256)
 
-    for t, times_dict in time_settings.items():
+    if mode == "standard":
         print(f"\n==== Training time setting = {t} ====")
-
         model = SiameseCORnet(times_dict).to(device)
-        criterion = ContrastiveLoss()
-        optimizer = torch.optim.Adam(model.parameters(), lr=4e-6)
-
-        train_losses, val_losses = [], []
-        train_accuracies, val_accuracies = [], []
-
-        for epoch in range(num_epochs):
-            model.train()
-            running_loss = 0.0
-            running_acc = 0.0
-            for img1, img2, label in train_loader:
-                img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-                optimizer.zero_grad()
+        lr, batch_size, tag = 4e-6, 128, f"T={t}"
+        epoch_data_dir = os.path.join(MODEL_DIR, "standard", "epoch_data", t)
+        save_path = os.path.join(MODEL_DIR, f"model_T{t}.pt")
+    else:
+        print(f"\n==== Training pretrained model for time setting = {t} ====")
+        model = SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=mode.startswith("frozen_backbone"), single_pass=job['single_pass']).to(device)
+        # Training options of PretrainedCORnetEmbedding, e.g. {'activation_checkpoints': {'V4': 2, 'IT': 'region'}}
+        for name, value in (job.get('embedding_options') or {}).items():
+            setattr(model.embedding_net, name, value)
+        total_params = sum(p.numel() for p in model.parameters())
+        trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        print(f"总参数数量: {total_params:,}")
+        print(f"可训练参数数量: {trainable_params:,}")
+        print(f"冻结参数比例: {100 * (total_params - trainable_params) / total_params:.2f}%")
+        lr, batch_size, tag = 1e-5, 64, f"Pretrained T={t}"
+        epoch_data_dir = os.path.join(MODEL_DIR, "pretrained", mode, "epoch_data", t)
+        save_path = os.path.join(MODEL_DIR, "pretrained", mode, f"pretrained_model_T{t}.pt")
+
+    criterion = ContrastiveLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    sampler = ResumableSampler(train_dataset)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, sampler=sampler, num_workers=job['loader_workers'], pin_memory=True, generator=torch.Generator())
+    amp = MixedPrecision(device, enabled=job.get('amp', True))
+    scaler = amp.scaler
+    state['precision'] = str(amp.dtype) if amp.enabled else 'float32'
+
+    history = {'train_losses': [], 'val_losses': [], 'train_accs': [], 'val_accs': []}
+    start_epoch, start_step, metrics_state = 0, 0, None
+    if os.path.exists(last_path):
+        checkpoint = load_training_state(last_path, model, optimizer, scaler)
+        history, metrics_state = checkpoint['history'], checkpoint['metrics']
+        start_epoch, start_step = checkpoint['resume_epoch'], checkpoint['resume_step']
+        print(f"[{tag}] Resuming at epoch {start_epoch+1}, step {start_step}")
+
+    for epoch in range(start_epoch, stop_epoch):
+        epoch_start = time.time()
+        model.train()
+        metrics = MetricsAccumulator()
+        step = start_step if epoch == start_epoch else 0
+        if step > 0:
+            metrics.__dict__.update(metrics_state)
+        sampler.set_epoch(epoch, step * batch_size)
+        samples, loop_start = 0, time.time()
+        for img1, img2, label in train_loader:
+            img1, img2, label = img1.to(device), img2.to(device), label.to(device)
+            optimizer.zero_grad()
+
+            with amp.autocast():
+                out1, out2 = model(img1, img2)
+                loss = criterion(out1, out2, label)
+
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            metrics.update(out1, out2, label, loss)
+            samples += label.size(0)
+            step += 1
+            if step % RESUME_EVERY_STEPS == 0:
+                save_training_state(last_path, model, optimizer, scaler, epoch, step, metrics, history=history)
+
+        train_loss, train_acc = metrics.compute()
+        loop_sec = time.time() - loop_start
+
+        val_results = evaluate_pairs(model, val_dataset, device, criterion, batch_size=batch_size, num_workers=job['loader_workers'])
+        val_loss, val_acc = val_results['loss'], val_results['accuracy']
+
+        history['train_losses'].append(train_loss)
+        history['val_losses'].append(val_loss)
+        history['train_accs'].append(train_acc)
+        history['val_accs'].append(val_acc)
+
+        print(f"[{tag}] Epoch {epoch+1}/{num_epochs} | Training loss: {train_loss:.5f}, Training accuracy: {train_acc:.5f} | Validation loss: {val_loss:.5f}, Validation accuracy: {val_acc:.5f}")
+
+        epoch_results = dict(history, current_epoch=epoch + 1)
+        os.makedirs(epoch_data_dir, exist_ok=True)
+        with open(os.path.join(epoch_data_dir, f"epoch_{epoch+1}_data.json"), 'w') as f:
+            json.dump(epoch_results, f, indent=2)
+
+        print(f"Epoch {epoch+1} data saved for time setting {t}")
+
+        if mode == "standard" and (epoch + 1) % 2 == 0:
+            # Also a full resume point (load_training_state)
+            checkpoint_path = os.path.join(MODEL_DIR, f"checkpoint_T{t}_epoch{epoch+1}.pt")
+            save_training_state(checkpoint_path, model, optimizer, scaler, epoch + 1, 0, epoch=epoch, loss=train_loss, history=history)
+            print(f"Checkpoint saved: {checkpoint_path}")
+
+        # Resume point of the job: replaced every RESUME_EVERY_STEPS steps and at the end of every epoch
+        save_training_state(last_path, model, optimizer, scaler, epoch + 1, 0, history=history)
+        state['epoch'] = epoch + 1
+        state['train_time_sec'] = state.get('train_time_sec', 0.0) + time.time() - epoch_start
+        # Training-loop throughput only (no validation), for the fp32 / mixed precision comparison
+        state['train_samples'] = state.get('train_samples', 0) + samples
+        state['train_loop_sec'] = state.get('train_loop_sec', 0.0) + loop_sec
+        write_job_state(state_path, state)
+
+    if len(history['val_losses']) < num_epochs:
+        state.update({'status': 'paused', 'results': history})
+        write_job_state(state_path, state)
+        return history
+
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    torch.save(model.state_dict(), save_path)
+    print(f"Model {t} saved to {save_path}")
+
+    state.update({'status': 'done', 'finished': time.time(), 'results': history})
+    write_job_state(state_path, state)
+    if os.path.exists(last_path):
+        os.remove(last_path)
+    return history
+
+# Run every (time setting, mode) job of the sweep. On a CPU box the pending jobs run concurrently in a process pool,
+# one single-threaded job per core; on CUDA (one device) they run one after another.
+# Returns {mode: {time setting: history}} for the finished jobs
+def run_sweep(time_settings, modes, train_pairs, val_pairs, names, face_cache, num_epochs=10, max_workers=None, single_pass=False, stop_epoch=None, embedding_options=None, amp=True):
+    os.makedirs(SWEEP_DIR, exist_ok=True)
+    jobs = [{'name': t, 'times': times_dict, 'mode': mode, 'num_epochs': num_epochs, 'stop_epoch': stop_epoch, 'single_pass': single_pass, 'embedding_options': embedding_options, 'amp': amp,
+             'train_pairs': train_pairs, 'val_pairs': val_pairs, 'names': names, 'face_cache': face_cache}
+            for mode in modes for t, times_dict in time_settings.items()]
+
+    results = {mode: {} for mode in modes}
+    pending = []
+    for job in jobs:
+        state = read_job_state(sweep_paths(job['name'], job['mode'])[0])
+        # Pruned jobs (successive_halving) are finished as well, they are never resumed
+        if state['status'] in ('done', 'pruned') or (stop_epoch and 'results' in state and state['epoch'] >= stop_epoch):
+            results[job['mode']][job['name']] = state['results']
+        else:
+            pending.append(job)
+
+    cpus = os.cpu_count() or 1
+    if max_workers is None:
+        max_workers = 1 if torch.cuda.is_available() else cpus
+    max_workers = max(1, min(max_workers, len(pending)))
+    # Pool jobs run with one intra-op thread and no DataLoader workers: forked children never start an OpenMP
+    # team (not fork-safe once the parent has used one), and the processes do not multiply beyond max_workers
+    threads = cpus if max_workers == 1 else 1
+    for job in pending:
+        job['threads'] = threads
+        job['loader_workers'] = 4 if max_workers == 1 else 0
+    print(f"Sweep: {len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run on {max_workers} worker(s) x {threads} thread(s)")
+
+    def finished(job, run):
+        try:
+            results[job['mode']][job['name']] = run()
+        except Exception as e:
+            print(f"Sweep job {job['mode']} T={job['name']} failed: {e}")
+            state_path = sweep_paths(job['name'], job['mode'])[0]
+            state = read_job_state(state_path)
+            state.update({'status': 'failed', 'error': str(e)})
+            write_job_state(state_path, state)
+
+    if max_workers == 1:
+        for job in pending:
+            finished(job, lambda job=job: train_time_setting(job))
+    else:
+        # fork: the functions of this notebook are not importable by spawned workers. The parent drops to one
+        # intra-op thread while the pool forks, so the children start without a thread pool of their own
+        parent_threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = {pool.submit(train_time_setting, job): job for job in pending}
+                for future in as_completed(futures):
+                    finished(futures[future], future.result)
+        finally:
+            torch.set_num_threads(parent_threads)
+
+    # Jobs finish in any order, report them in time_settings order
+    return {mode: {t: results[mode][t] for t in time_settings if t in results[mode]} for mode in modes}
+
+# Successive halving over the sweep: all settings train to the first rung, then at every rung the ones whose
+# val loss is non-finite or above divergence x the best are stopped, and of the rest only the best 1/eta go on
+# to the next rung. The survivors of the last rung train to max_epochs (the 10 epochs of the plain sweep) with the
+# compute the stopped ones freed. Jobs run as the sweep mode <mode>_asha, so their states and models never mix with
+# those of run_sweep on <mode>; they pause at the rungs and resume from there, and every decision is logged to
+# SWEEP_DIR/asha_<mode>_log.json. Returns the results of the survivors, the log and the sweep mode used
+def successive_halving(time_settings, mode, train_pairs, val_pairs, names, face_cache, rungs=(1, 3), max_epochs=10, eta=3, divergence=2.0, max_workers=None, single_pass=False, embedding_options=None):
+    os.makedirs(SWEEP_DIR, exist_ok=True)
+    log_path = os.path.join(SWEEP_DIR, f"asha_{mode}_log.json")
+    mode = f"{mode}_asha"
+    log = []
+    survivors = dict(time_settings)
+    for rung in list(rungs) + [max_epochs]:
+        results = run_sweep(survivors, [mode], train_pairs, val_pairs, names, face_cache, num_epochs=max_epochs,
+                            max_workers=max_workers, single_pass=single_pass, stop_epoch=rung, embedding_options=embedding_options)[mode]
+        if rung == max_epochs:
+            break
+
+        losses = {t: results[t]['val_losses'][rung - 1] for t in survivors if t in results}
+        best = min([loss for loss in losses.values() if math.isfinite(loss)], default=math.inf)
+        ranked = sorted([t for t, loss in losses.items() if math.isfinite(loss) and loss <= divergence * best], key=losses.get)
+        keep = max(1, math.ceil(len(survivors) / eta))
+        for t in survivors:
+            loss = losses.get(t)
+            if t in ranked[:keep]:
+                decision, reason = "promoted", f"rank {ranked.index(t) + 1} of {len(ranked)}, top {keep} go on"
+            elif loss is None:
+                decision, reason = "stopped", "job failed"
+            elif not math.isfinite(loss):
+                decision, reason = "stopped", "diverged (non-finite val loss)"
+            elif loss > divergence * best:
+                decision, reason = "stopped", f"val loss {loss:.5f} > {divergence} x best {best:.5f}"
+            else:
+                decision, reason = "stopped", f"rank {ranked.index(t) + 1} of {len(ranked)}, only top {keep} go on"
+            log.append({'rung': rung, 'setting': t, 'val_loss': loss, 'best_val_loss': best, 'decision': decision, 'reason': reason})
+            print(f"[ASHA {mode} epoch {rung}] T={t} {decision}: {reason}")
+            if decision == "stopped" and loss is not None:
+                state_path = sweep_paths(t, mode)[0]
+                state = read_job_state(state_path)
+                state.update({'status': 'pruned', 'pruned_at': rung, 'reason': reason})
+                write_job_state(state_path, state)
+
+        survivors = {t: survivors[t] for t in ranked[:keep]}
+        with open(log_path, 'w') as f:
+            json.dump(log, f, indent=2)
+
+    spent = sum(min(entry['rung'], max_epochs) for entry in log if entry['decision'] == "stopped") + max_epochs * len(results)
+    print(f"Successive halving: {spent} model-epochs instead of {max_epochs * len(time_settings)}, survivors: {list(results)}")
+    with open(log_path, 'w') as f:
+        json.dump(log, f, indent=2)
+    return results, log, mode
+
+# Memory / time of one training step (forward + backward of a Siamese batch) per time setting and checkpointing
+# config. activation_mb counts the non-parameter tensors autograd keeps for backward (saved_tensors_hooks, so it
+# also works on CPU); on CUDA the peak allocated memory is reported too. Models are randomly initialised
+def activation_checkpoint_report(time_settings, configs=None, batch_size=128, input_size=256, repeats=2, save_path=None):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if configs is None:
+        configs = {
+            "none": {},
+            "region": {"V2": "region", "V4": "region", "IT": "region"},
+            "step": {"V2": 1, "V4": 1, "IT": 1}
+        }
 
-                with torch.cuda.amp.autocast():
-                    out1, out2 = model(img1, img2)
+    report = {}
+    for t, times_dict in time_settings.items():
+        model = SiamesePretrainedCORnet(times_dict, pretrained=False, input_size=input_size).to(device).train()
+        criterion = ContrastiveLoss()
+        params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+        x1 = torch.rand(batch_size, 3, input_size, input_size, device=device)
+        x2 = torch.rand(batch_size, 3, input_size, input_size, device=device)
+        label = torch.randint(0, 2, (batch_size,), device=device).float()
+
+        report[t] = {}
+        for name, config in configs.items():
+            model.embedding_net.activation_checkpoints = config
+            saved = {}
+
+            def pack(tensor):
+                storage = tensor.untyped_storage()
+                if storage.data_ptr() not in params:
+                    saved[storage.data_ptr()] = storage.nbytes()
+                return tensor
+
+            step_times = []
+            for _ in range(repeats):
+                saved.clear()
+                model.zero_grad()
+                if device.type == 'cuda':
+                    torch.cuda.reset_peak_memory_stats(device)
+                start = time.time()
+                with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                    out1, out2 = model(x1, x2)
                     loss = criterion(out1, out2, label)
+                loss.backward()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                step_times.append(time.time() - start)
+
+            entry = {'activation_mb': sum(saved.values()) / 1024 ** 2, 'step_time_sec': min(step_times)}
+            if device.type == 'cuda':
+                entry['peak_mb'] = torch.cuda.max_memory_allocated(device) / 1024 ** 2
+            report[t][name] = entry
+            print(f"T={t} {name}: activations {entry['activation_mb']:.1f} MB, step {entry['step_time_sec']:.3f}s")
+        del model
+
+    save_path = save_path or os.path.join(OUTPUT_DIR, "activation_checkpoint_report.json")
+    with open(save_path, 'w') as f:
+        json.dump({'batch_size': batch_size, 'input_size': input_size, 'configs': configs, 'settings': report}, f, indent=2)
+    print(f"Activation checkpointing report saved to {save_path}")
+    return report
+
+# Final val accuracy / loss, training time and throughput of every time setting across sweep modes (e.g. full_finetune
+# vs full_finetune_tbptt or full_finetune_fp32), read from the job state files; differences are relative to the first mode
+def compare_sweep_modes(time_settings, modes, save_path=None):
+    comparison = {}
+    for t in time_settings:
+        comparison[t] = {}
+        for mode in modes:
+            state = read_job_state(sweep_paths(t, mode)[0])
+            if 'results' not in state:
+                continue
+            comparison[t][mode] = {
+                'val_acc': state['results']['val_accs'][-1],
+                'val_loss': state['results']['val_losses'][-1],
+                'epochs': len(state['results']['val_accs']),
+                'train_time_sec': state.get('train_time_sec'),
+                'precision': state.get('precision'),
+                'samples_per_sec': state['train_samples'] / state['train_loop_sec'] if state.get('train_loop_sec') else None
+            }
+        base = comparison[t].get(modes[0])
+        for mode in modes[1:]:
+            entry = comparison[t].get(mode)
+            if base is None or entry is None:
+                continue
+            entry['val_acc_diff'] = entry['val_acc'] - base['val_acc']
+            if base['train_time_sec'] and entry['train_time_sec']:
+                entry['time_ratio'] = entry['train_time_sec'] / base['train_time_sec']
+            if base['samples_per_sec'] and entry['samples_per_sec']:
+                entry['throughput_ratio'] = entry['samples_per_sec'] / base['samples_per_sec']
+        print(f"T={t} | " + " | ".join(f"{mode}: acc {entry['val_acc']:.4f}" + (f", {entry['train_time_sec']:.0f}s" if entry['train_time_sec'] else "")
+                                       + (f", {entry['samples_per_sec']:.1f} samples/s" if entry['samples_per_sec'] else "")
+                                       for mode, entry in comparison[t].items()))
+
+    save_path = save_path or os.path.join(BASE_PATH, f"sweep_comparison_{'_vs_'.join(modes)}.json")
+    with open(save_path, 'w') as f:
+        json.dump(comparison, f, indent=2)
+    print(f"Sweep comparison saved to {save_path}")
+    return comparison
+
+def train_models(time_settings, num_epochs=10, max_workers=None):
+    print(f"Using device: {torch.device('cuda' if torch.cuda.is_available() else 'cpu')}")
 
-                scaler.scale(loss).backward()
-                scaler.step(optimizer)
-                scaler.update()
-
-                acc = compute_accuracy(out1, out2, label)
-                running_loss += loss.item()
-                running_acc += acc
-
-            train_loss = running_loss / len(train_loader)
-            train_acc = running_acc / len(train_loader)
-
-            model.eval()
-            running_loss = 0.0
-            running_acc = 0.0
-            with torch.no_grad():
-                for img1, img2, label in val_loader:
-                    img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-
-                    with torch.cuda.amp.autocast():
-                        out1, out2 = model(img1, img2)
-                        loss = criterion(out1, out2, label)
-
-                    acc = compute_accuracy(out1, out2, label)
-                    running_loss += loss.item()
-                    running_acc += acc
-
-            val_loss = running_loss / len(val_loader)
-            val_acc = running_acc / len(val_loader)
-
-            train_losses.append(train_loss)
-            val_losses.append(val_loss)
-            train_accuracies.append(train_acc)
-            val_accuracies.append(val_acc)
-
-            print(f"[T={t}] Epoch {epoch+1}/{num_epochs} | Training loss: {train_loss:.5f}, Training accuracy: {train_acc:.5f} | Validation loss: {val_loss:.5f}, Validation accuracy: {val_acc:.5f}")
+    face_dir = os.path.join(DATA_ROOT, "faces")
+    list_dir = os.path.join(DATA_ROOT, "lists")
+    print(f"Data path: {face_dir}")
 
-            epoch_results = {
-                'train_losses': train_losses,
-                'val_losses': val_losses,
-                'train_accs': train_accuracies,
-                'val_accs': val_accuracies,
-                'current_epoch': epoch + 1
-            }
+    names, pairs = load_pair_index(list_dir)
+    face_store = build_face_store(names, face_dir, os.path.join(DATA_ROOT, "face_store"))
+    face_cache = build_resized_cache(names, face_store, os.path.join(DATA_ROOT, "face_cache"), sizes=(256,))
+    split_idx = int(0.9 * len(pairs))
+    train_pairs = pairs[:split_idx]
+    val_pairs = pairs[split_idx:]
 
-            epoch_data_dir = os.path.join(MODEL_DIR, "standard", "epoch_data", t)
-            os.makedirs(epoch_data_dir, exist_ok=True)
-
-            with open(os.path.join(epoch_data_dir, f"epoch_{epoch+1}_data.json"), 'w') as f:
-                json.dump(epoch_results, f, indent=2)
-
-            print(f"Epoch {epoch+1} data saved for time setting {t}")
-
-            if (epoch + 1) % 2 == 0:
-                checkpoint = {
-                    'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'loss': train_loss,
-                }
-                checkpoint_path = os.path.join(MODEL_DIR, f"checkpoint_T{t}_epoch{epoch+1}.pt")
-                torch.save(checkpoint, checkpoint_path)
-                print(f"Checkpoint saved: {checkpoint_path}")
-# Save the model
-        save_path = os.path.join(MODEL_DIR, f"model_T{t}.pt")
-        torch.save(model.state_dict(), save_path)
-        print(f"Model {t} saved to {save_path}")
-
-        results[t] = {
-            'train_losses': train_losses,
-            'val_losses': val_losses,
-            'train_accs': train_accuracies,
-            'val_accs': val_accuracies
-        }
+    results = run_sweep(time_settings, ["standard"], train_pairs, val_pairs, names, face_cache, num_epochs=num_epochs, max_workers=max_workers)["standard"]
 
     with open(os.path.join(BASE_PATH, 'training_results.json'), 'w') as f:
         json.dump(results, f)
 
     return results
 
-def predict_pair_over_time(img1_path, img2_path, time_settings, model_filenames, threshold=0.5, alpha=10, beta=5, use_pretrained=False, freeze_backbone=False):
+# Weight-shared supernet: one pretrained model whose recurrent blocks have the longest time of every region,
+# trained with a (V2, V4, IT) setting sampled per batch, so every setting is later read from the same checkpoint
+# by truncating the unroll (embedding_net.active_times). One run of num_epochs replaces len(time_settings) runs.
+def train_supernet(train_dataset, val_dataset, time_settings, num_epochs=10, freeze_backbone=False, single_pass=False):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    max_times = {region: max(times[region] for times in time_settings.values()) for region in ("V2", "V4", "IT")}
+    print(f"Supernet time setting: {max_times}")
+
+    model = SiamesePretrainedCORnet(max_times, pretrained=True, freeze_backbone=freeze_backbone, single_pass=single_pass).to(device)
+    criterion = ContrastiveLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+    train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, num_workers=4, pin_memory=True)
+    amp = MixedPrecision(device)
+    scaler = amp.scaler
+
+    mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
+    supernet_dir = os.path.join(MODEL_DIR, "pretrained", "supernet", mode_dir)
+    os.makedirs(supernet_dir, exist_ok=True)
+
+    settings = list(time_settings.items())
+    train_losses, train_accuracies, val_accuracies = [], [], []
+    start = time.time()
+
+    for epoch in range(num_epochs):
+        model.train()
+        metrics = MetricsAccumulator()
+        for img1, img2, label in train_loader:
+            img1, img2, label = img1.to(device), img2.to(device), label.to(device)
+            model.embedding_net.active_times = random.choice(settings)[1]
+            optimizer.zero_grad()
+
+            with amp.autocast():
+                out1, out2 = model(img1, img2)
+                loss = criterion(out1, out2, label)
+
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+
+            metrics.update(out1, out2, label, loss)
+
+        train_loss, train_acc = metrics.compute()
+        train_losses.append(train_loss)
+        train_accuracies.append(train_acc)
+
+        # Per-epoch validation on the longest setting only; the full sweep runs once after training
+        model.embedding_net.active_times = None
+        val_acc = evaluate_pairs(model, val_dataset, device, batch_size=64)['accuracy']
+        val_accuracies.append(val_acc)
+        print(f"[Supernet] Epoch {epoch+1}/{num_epochs} | Training loss: {train_loss:.5f}, Training accuracy: {train_acc:.5f} | Validation accuracy (full unroll): {val_acc:.5f}")
+
+    train_time = time.time() - start
+    model.embedding_net.active_times = None
+    save_path = os.path.join(supernet_dir, "supernet_model.pt")
+    torch.save(model.state_dict(), save_path)
+    print(f"Supernet saved to {save_path}")
+
+    # Accuracy of the independently trained models, from the results file written by main()
+    independent = {}
+    results_path = os.path.join(BASE_PATH, f'pretrained_{mode_dir}_training_results.json')
+    if os.path.exists(results_path):
+        with open(results_path, 'r') as f:
+            independent = json.load(f)
+
+    # Note: ResNet BatchNorm running stats are shared by all settings (averaged over the sampled unrolls);
+    # each CORblock iteration keeps its own norm*_t layers, so truncation uses the statistics of its own steps
+    report = {
+        'max_times': max_times,
+        'num_epochs': num_epochs,
+        'model_epochs': num_epochs,
+        'independent_model_epochs': num_epochs * len(time_settings),
+        'train_time_sec': train_time,
+        'train_losses': train_losses,
+        'train_accs': train_accuracies,
+        'val_accs_full_unroll': val_accuracies,
+        'settings': {}
+    }
+    for t, times_dict in settings:
+        model.embedding_net.active_times = times_dict
+        val_results = evaluate_pairs(model, val_dataset, device, criterion, batch_size=64)
+        entry = {'supernet_val_acc': val_results['accuracy'], 'supernet_val_loss': val_results['loss']}
+        if t in independent:
+            entry['independent_val_acc'] = independent[t]['val_accs'][-1]
+            entry['acc_diff'] = entry['supernet_val_acc'] - entry['independent_val_acc']
+        report['settings'][t] = entry
+        print(f"[Supernet T={t}] Validation accuracy: {entry['supernet_val_acc']:.5f}" +
+              (f" | Independent: {entry['independent_val_acc']:.5f} ({entry['acc_diff']:+.5f})" if t in independent else ""))
+    model.embedding_net.active_times = None
+
+    with open(os.path.join(BASE_PATH, f'supernet_{mode_dir}_report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Supernet report saved to {os.path.join(BASE_PATH, f'supernet_{mode_dir}_report.json')}")
+
+    return model, report
+
+# quantized = True scores with the int8 models (quantize_time_settings) on the CPU
+def predict_pair_over_time(img1_path, img2_path, time_settings, model_filenames, threshold=0.5, alpha=10, beta=5, use_pretrained=False, freeze_backbone=False, quantized=False):
+    device = torch.device('cpu') if quantized else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     transform = transforms.Compose([
         transforms.Resize((256, 256)),
         transforms.ToTensor()
     ])
 
-    img1 = transform(Image.open(img1_path).convert("RGB")).unsqueeze(0).to(device)
-    img2 = transform(Image.open(img2_path).convert("RGB")).unsqueeze(0).to(device)
+    img1 = transform(load_image(img1_path)).unsqueeze(0).to(device)
+    img2 = transform(load_image(img2_path)).unsqueeze(0).to(device)
 
     distances = []
     probs = []
@@ -364,22 +1602,24 @@ def predict_pair_over_time(img1_path, img2_path, time_settings, model_filenames,
     for structure_name in sorted_keys:
         times_dict = time_settings[structure_name]
         if use_pretrained:
-            model = SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False).to(device)
             print(f"Using pretrained model for time setting {structure_name}")
 
             mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
             pretrained_model_dir = os.path.join(MODEL_DIR, "pretrained", mode_dir)
             pretrained_model_path = os.path.join(pretrained_model_dir, f"pretrained_model_T{structure_name}.pt")
 
+            model = None
             if os.path.exists(pretrained_model_path):
                 try:
-                    model.load_state_dict(torch.load(pretrained_model_path, map_location=device))
+                    model = cached_model("SiamesePretrainedCORnet", times_dict, pretrained_model_path, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False), quantized)
                     print(f"Loaded pretrained model weights from {pretrained_model_path}")
                 except Exception as e:
                     print(f"Could not load pretrained weights for {structure_name}: {e}")
                     print("Using base pretrained ResNet weights")
             else:
                 print(f"No trained weights found for {structure_name} in {pretrained_model_dir}, using base pretrained ResNet weights")
+            if model is None:
+                model = cached_model("SiamesePretrainedCORnet", times_dict, None, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False))
         else:
             model = SiameseCORnet(times_dict).to(device)
 
@@ -446,6 +1686,122 @@ def predict_pair_over_time(img1_path, img2_path, time_settings, model_filenames,
     with open(os.path.join(save_dir, 'prediction_results.json'), 'w') as f:
         json.dump(results, f, indent=2)
 
+# Distance-over-time curves from a single model: one unrolled pass per region gives the pair distance after
+# every recurrent step of V2, V4 and IT, with the other regions at their configured depth
+def predict_pair_anytime(img1_path, img2_path, structure_name, times_dict, alpha=10, beta=5, freeze_backbone=False):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    transform = transforms.Compose([
+        transforms.Resize((256, 256)),
+        transforms.ToTensor()
+    ])
+    img1 = transform(load_image(img1_path)).unsqueeze(0).to(device)
+    img2 = transform(load_image(img2_path)).unsqueeze(0).to(device)
+
+    mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
+    pretrained_model_path = os.path.join(MODEL_DIR, "pretrained", mode_dir, f"pretrained_model_T{structure_name}.pt")
+    model = None
+    if os.path.exists(pretrained_model_path):
+        try:
+            model = cached_model("SiamesePretrainedCORnet", times_dict, pretrained_model_path, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False))
+        except Exception as e:
+            print(f"Could not load pretrained weights for {structure_name}: {e}")
+    if model is None:
+        print(f"No trained weights for {structure_name}, using base pretrained ResNet weights")
+        model = cached_model("SiamesePretrainedCORnet", times_dict, None, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False))
+    model.eval()
+
+    curves = {}
+    with torch.no_grad():
+        for region in ['V2', 'V4', 'IT']:
+            emb1, emb2 = model.forward_anytime(img1, img2, region)
+            distances = F.pairwise_distance(emb1, emb2)[:, 0]
+            probs = torch.sigmoid(-alpha * distances + beta)
+            curves[region] = {'distances': distances.tolist(), 'probabilities': probs.tolist()}
+            print(f"{structure_name} {region} steps → " + ", ".join(f"{d:.4f}" for d in curves[region]['distances']))
+
+    plt.figure(figsize=(15, 4))
+    for k, region in enumerate(['V2', 'V4', 'IT']):
+        plt.subplot(1, 3, k + 1)
+        steps = range(1, len(curves[region]['distances']) + 1)
+        plt.plot(steps, curves[region]['distances'], 'b-o', linewidth=1.5, alpha=0.7)
+        plt.title(f"{region} time (T={structure_name})")
+        plt.xlabel(f"{region} time")
+        plt.ylabel("Distance")
+        plt.xticks(list(steps))
+        plt.grid()
+    plt.tight_layout()
+
+    save_dir = os.path.join(OUTPUT_DIR, "predictions")
+    os.makedirs(save_dir, exist_ok=True)
+    save_path = os.path.join(save_dir, f"anytime_{structure_name}.png")
+    plt.savefig(save_path)
+    print(f"Saved distance-over-time curves → {save_path}")
+    plt.close()
+
+    with open(os.path.join(save_dir, f"anytime_{structure_name}.json"), 'w') as f:
+        json.dump(curves, f, indent=2)
+    return curves
+
+# Early-exit sweep over val faces: for each tolerance, accuracy, embedding time and the time each face used per region
+# (tol = 0.0 never halts, i.e. the full configured unroll). Per-image step counts are saved by image name
+def early_exit_report(dataset, structure_name, times_dict, tols=(0.0, 0.01, 0.05, 0.1), max_steps=None, threshold=0.5, batch_size=64, freeze_backbone=False):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
+    pretrained_model_path = os.path.join(MODEL_DIR, "pretrained", mode_dir, f"pretrained_model_T{structure_name}.pt")
+    model = None
+    if os.path.exists(pretrained_model_path):
+        try:
+            model = cached_model("SiamesePretrainedCORnet", times_dict, pretrained_model_path, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False))
+        except Exception as e:
+            print(f"Could not load pretrained weights for {structure_name}: {e}")
+    if model is None:
+        print(f"No trained weights for {structure_name}, using base pretrained ResNet weights")
+        model = cached_model("SiamesePretrainedCORnet", times_dict, None, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False))
+    model.eval()
+    embedding = model.embedding_net
+
+    faces = UniqueFacesDataset(dataset)
+    loader = DataLoader(faces, batch_size=batch_size, shuffle=False, num_workers=4, pin_memory=True)
+    rows = torch.from_numpy(np.searchsorted(faces.ids, dataset.pairs[:, :2])).long()
+    labels = torch.from_numpy(dataset.pairs[:, 2]).float()
+
+    report = {'structure': structure_name, 'max_steps': max_steps, 'tolerances': {}}
+    try:
+        for tol in tols:
+            embedding.exit_tol, embedding.max_steps = tol, max_steps
+            embeddings, steps = [], {}
+            start = time.time()
+            with torch.no_grad():
+                for images in loader:
+                    embeddings.append(model.forward_once(images.to(device)).float().cpu())
+                    for region, used in embedding.steps_used.items():
+                        steps.setdefault(region, []).append(used.cpu())
+            elapsed = time.time() - start
+            embeddings = torch.cat(embeddings)
+            distances = F.pairwise_distance(embeddings[rows[:, 0]], embeddings[rows[:, 1]])
+            accuracy = ((distances < threshold).float() == labels).float().mean().item()
+            steps = {region: torch.cat(used) for region, used in steps.items()}
+            report['tolerances'][str(tol)] = {
+                'accuracy': accuracy,
+                'embed_time_sec': elapsed,
+                'mean_steps': {region: used.float().mean().item() for region, used in steps.items()},
+                'per_image_steps': {str(dataset.names[i]): {region: int(used[k]) for region, used in steps.items()}
+                                    for k, i in enumerate(faces.ids)}
+            }
+            print(f"{structure_name} tol={tol} → Accuracy={accuracy:.4f}, Time={elapsed:.2f}s, Mean steps=" +
+                  ", ".join(f"{region}:{used.float().mean().item():.2f}" for region, used in steps.items()))
+    finally:
+        embedding.exit_tol, embedding.max_steps = None, None
+
+    save_dir = os.path.join(OUTPUT_DIR, "predictions")
+    os.makedirs(save_dir, exist_ok=True)
+    with open(os.path.join(save_dir, f"early_exit_{structure_name}.json"), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved early exit report → {os.path.join(save_dir, f'early_exit_{structure_name}.json')}")
+    return report
+
 def generate_saliency_over_time_batch(dataset, time_settings, top_percent=0.1, intensity=0.9, num_images=10, use_pretrained=False, freeze_backbone=False):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -458,22 +1814,24 @@ def generate_saliency_over_time_batch(dataset, time_settings, top_percent=0.1, i
         os.makedirs(save_dir, exist_ok=True)
 
         if use_pretrained:
-            model = SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False).to(device)
             print(f"Using pretrained model for saliency time setting {t}")
 
             mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
             pretrained_model_dir = os.path.join(MODEL_DIR, "pretrained", mode_dir)
             pretrained_model_path = os.path.join(pretrained_model_dir, f"pretrained_model_T{t}.pt")
 
+            model = None
             if os.path.exists(pretrained_model_path):
                 try:
-                    model.load_state_dict(torch.load(pretrained_model_path, map_location=device))
+                    model = cached_model("SiamesePretrainedCORnet", times_dict, pretrained_model_path, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False))
                     print(f"Loaded pretrained model weights from {pretrained_model_path}")
                 except Exception as e:
                     print(f"Could not load pretrained weights for {t}: {e}")
                     print("Using base pretrained ResNet weights")
             else:
                 print(f"No trained weights found for {t} in {pretrained_model_dir}, using base pretrained ResNet weights")
+            if model is None:
+                model = cached_model("SiamesePretrainedCORnet", times_dict, None, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False))
         else:
             model = SiameseCORnet(times_dict).to(device)
 
@@ -491,7 +1849,7 @@ def generate_saliency_over_time_batch(dataset, time_settings, top_percent=0.1, i
 
         for i in range(num_images):
             img_tensor, _, _ = dataset[i]
-            img_tensor = img_tensor.unsqueeze(0).to(device).requires_grad_()
+            img_tensor = prepare_batch(img_tensor.unsqueeze(0).to(device), model.input_size).requires_grad_()
 
             model.zero_grad()
             out1, _ = model(img_tensor, img_tensor)
@@ -532,10 +1890,8 @@ def generate_saliency_over_time_batch(dataset, time_settings, top_percent=0.1, i
 
 
 # Prediction
-def compare_models_performance(val_dataset, time_settings, threshold=0.5, alpha=10, beta=5, freeze_backbone=False):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-    val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False, num_workers=4, pin_memory=True)
+def compare_models_performance(val_dataset, time_settings, threshold=0.5, alpha=10, beta=5, freeze_backbone=False, quantized=False):
+    device = torch.device('cpu') if quantized else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     results = {
         'standard': {},
@@ -554,58 +1910,31 @@ def compare_models_performance(val_dataset, time_settings, threshold=0.5, alpha=
                 standard_model.load_state_dict(torch.load(standard_model_path, map_location=device))
                 print(f"Loaded standard model from {standard_model_path}")
 
-                standard_model.eval()
-                running_acc = 0.0
-                with torch.no_grad():
-                    for img1, img2, label in val_loader:
-                        img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-                        out1, out2 = standard_model(img1, img2)
-                        acc = compute_accuracy(out1, out2, label, threshold=threshold)
-                        running_acc += acc
-
-                standard_accuracy = running_acc / len(val_loader)
+                standard_accuracy = evaluate_pairs(standard_model, val_dataset, device, threshold=threshold)['accuracy']
                 print(f"Standard model accuracy: {standard_accuracy:.5f}")
             except Exception as e:
                 print(f"Could not load standard model: {e}")
         else:
             print(f"No standard model found for time setting {t}")
 
-        pretrained_model = SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=freeze_backbone).to(device)
         mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
         pretrained_model_path = os.path.join(MODEL_DIR, "pretrained", mode_dir, f"pretrained_model_T{t}.pt")
         pretrained_accuracy = 0
 
         if os.path.exists(pretrained_model_path):
             try:
-                pretrained_model.load_state_dict(torch.load(pretrained_model_path, map_location=device))
+                pretrained_model = cached_model("SiamesePretrainedCORnet", times_dict, pretrained_model_path, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=freeze_backbone), quantized)
                 print(f"Loaded pretrained model from {pretrained_model_path}")
 
-                pretrained_model.eval()
-                running_acc = 0.0
-                with torch.no_grad():
-                    for img1, img2, label in val_loader:
-                        img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-                        out1, out2 = pretrained_model(img1, img2)
-                        acc = compute_accuracy(out1, out2, label, threshold=threshold)
-                        running_acc += acc
-
-                pretrained_accuracy = running_acc / len(val_loader)
+                pretrained_accuracy = evaluate_pairs(pretrained_model, val_dataset, device, threshold=threshold)['accuracy']
                 print(f"Pretrained model accuracy: {pretrained_accuracy:.5f}")
             except Exception as e:
                 print(f"Could not load pretrained model: {e}")
         else:
             print(f"No fine-tuned pretrained model found for time setting {t}, using base pretrained model")
 
-            pretrained_model.eval()
-            running_acc = 0.0
-            with torch.no_grad():
-                for img1, img2, label in val_loader:
-                    img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-                    out1, out2 = pretrained_model(img1, img2)
-                    acc = compute_accuracy(out1, out2, label, threshold=threshold)
-                    running_acc += acc
-
-            pretrained_accuracy = running_acc / len(val_loader)
+            pretrained_model = cached_model("SiamesePretrainedCORnet", times_dict, None, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=freeze_backbone))
+            pretrained_accuracy = evaluate_pairs(pretrained_model, val_dataset, device, threshold=threshold)['accuracy']
             print(f"Base pretrained model accuracy: {pretrained_accuracy:.5f}")
 
         results['standard'][t] = standard_accuracy
@@ -643,6 +1972,26 @@ def compare_models_performance(val_dataset, time_settings, threshold=0.5, alpha=
 
     return results
 
+# int8 models of the trained pretrained model of every time setting (quantize_model), next to the checkpoints; the
+# prediction and comparison functions score with them when called with quantized=True on the CPU
+def quantize_time_settings(time_settings, val_dataset, freeze_backbone=False, calibration_images=256):
+    mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
+    reports = {}
+    for t, times_dict in time_settings.items():
+        checkpoint_path = os.path.join(MODEL_DIR, "pretrained", mode_dir, f"pretrained_model_T{t}.pt")
+        if not os.path.exists(checkpoint_path):
+            print(f"No fine-tuned pretrained model found for time setting {t}, not quantized")
+            continue
+        print(f"\n==== Quantizing time setting {t} ====")
+        model = load_checkpoint_model(lambda: SiamesePretrainedCORnet(times_dict, pretrained=False), checkpoint_path, torch.device('cpu'))
+        _, reports[t] = quantize_model(model, val_dataset, quantized_path(checkpoint_path), calibration_images)
+
+    save_path = os.path.join(OUTPUT_DIR, f"quantization_report_{mode_dir}.json")
+    with open(save_path, 'w') as f:
+        json.dump(reports, f, indent=2)
+    print(f"Quantization report saved to {save_path}")
+    return reports
+
 def plot_training_curves(time_settings, use_pretrained=True, freeze_backbone=False):
     print("\nGenerating training process curves...")
 
@@ -760,12 +2109,13 @@ def plot_training_curves(time_settings, use_pretrained=True, freeze_backbone=Fal
 def main():
     """主函数：一次性运行整个实验流程"""
     print("Begin the experiment of CORnet...")
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     face_dir = os.path.join(DATA_ROOT, "faces")
     list_dir = os.path.join(DATA_ROOT, "lists")
 
-    pairs = load_all_pairs(list_dir)
+    names, pairs = load_pair_index(list_dir)
+    face_store = build_face_store(names, face_dir, os.path.join(DATA_ROOT, "face_store"))
+    face_cache = build_resized_cache(names, face_store, os.path.join(DATA_ROOT, "face_cache"), sizes=(256,))
     split_idx = int(0.9 * len(pairs))
     train_pairs = pairs[:split_idx]
     val_pairs = pairs[split_idx:]
@@ -775,127 +2125,64 @@ def main():
         transforms.ToTensor()
     ])
 
-    train_dataset = FacePairsDataset(train_pairs, face_dir, transform=transform)
-    val_dataset = FacePairsDataset(val_pairs, face_dir, transform=transform)
+    train_dataset = ShardedFacePairsDataset(train_pairs, names, face_cache, 256)
+    val_dataset = ShardedFacePairsDataset(val_pairs, names, face_cache, 256)
 
     should_train = True
     use_pretrained = True
     freeze_backbone = False
+    single_pass = False
+    # supernet = True trains one weight-shared model for all time settings instead of one model per setting
+    supernet = False
+    # successive_halving_sweep = True stops dominated / diverging settings at epochs 1 and 3 of the pretrained sweep; the
+    # survivors train the same 10 epochs, as the separate sweep mode <mode>_asha (models in pretrained/<mode>_asha)
+    successive_halving_sweep = False
+    # Activation checkpointing of the pretrained sweep per region: "region" or every k recurrent steps, e.g. {"V4": 2, "IT": "region"}
+    activation_checkpoints = {}
+    # Truncated BPTT of the pretrained sweep: backprop through the last k iterations per region, e.g. {"V2": 2, "V4": 2, "IT": 2};
+    # trained as the separate sweep mode <mode>_tbptt and compared with the full-BPTT sweep. The state is detached before
+    # the last k iterations; bptt_straight_through = True (mode <mode>_tbptt_st) keeps an identity gradient path to step 0
+    bptt_steps = {}
+    bptt_straight_through = False
+    embedding_options = {'activation_checkpoints': activation_checkpoints, 'bptt_steps': bptt_steps, 'bptt_straight_through': bptt_straight_through}
+    # Mixed precision of the training loops (CUDA fp16 / CPU bf16, see MixedPrecision); amp_comparison = True also
+    # trains the pretrained sweep in fp32 as <mode>_fp32 and compares accuracy and throughput of the two
+    mixed_precision = True
+    amp_comparison = False
+    # quantize_int8 = True writes int8 models of the pretrained sweep (quantize_time_settings) and scores the
+    # illusion pairs / validation comparison with them when running on the CPU. The int8 models have no anytime or
+    # early-exit path, predict_pair_anytime and early_exit_report always use the fp32 checkpoints
+    quantize_int8 = False
+    # benchmark_resize = True times PIL Resize against prepare_batch on the validation pairs before training
+    # (last recorded run: Output/CORnet-S/output_images/batch_resize_benchmark.json)
+    benchmark_resize = False
+
+    if benchmark_resize:
+        check_batch_resize(FacePairsDataset(val_pairs, names, face_dir, store=face_store, raw=True), transform, 256, save_path=os.path.join(OUTPUT_DIR, "batch_resize_benchmark.json"))
 
     if should_train:
         print("Start training models...")
-        if use_pretrained:
+        if use_pretrained and supernet:
+            train_supernet(train_dataset, val_dataset, time_settings, num_epochs=10, freeze_backbone=freeze_backbone, single_pass=single_pass)
+        elif use_pretrained:
             print(f"使用预训练模型作为初始参数训练所有时间设置")
-
-            results = {}
-
-            for t, times_dict in time_settings.items():
-                print(f"\n==== Training pretrained model for time setting = {t} ====")
-
-                model = SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=freeze_backbone).to(device)
-
-                total_params = sum(p.numel() for p in model.parameters())
-                trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
-                print(f"总参数数量: {total_params:,}")
-                print(f"可训练参数数量: {trainable_params:,}")
-                print(f"冻结参数比例: {100 * (total_params - trainable_params) / total_params:.2f}%")
-
-                criterion = ContrastiveLoss()
-
-                optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
-
-                train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, num_workers=4, pin_memory=True)
-                val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False, num_workers=4, pin_memory=True)
-
-                scaler = torch.cuda.amp.GradScaler()
-
-                train_losses, val_losses = [], []
-                train_accuracies, val_accuracies = [], []
-
-                num_epochs = 10
-
-                for epoch in range(num_epochs):
-                    model.train()
-                    running_loss = 0.0
-                    running_acc = 0.0
-                    for img1, img2, label in train_loader:
-                        img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-                        optimizer.zero_grad()
-
-                        with torch.cuda.amp.autocast():
-                            out1, out2 = model(img1, img2)
-                            loss = criterion(out1, out2, label)
-
-                        scaler.scale(loss).backward()
-                        scaler.step(optimizer)
-                        scaler.update()
-
-                        acc = compute_accuracy(out1, out2, label)
-                        running_loss += loss.item()
-                        running_acc += acc
-
-                    train_loss = running_loss / len(train_loader)
-                    train_acc = running_acc / len(train_loader)
-
-                    model.eval()
-                    running_loss = 0.0
-                    running_acc = 0.0
-                    with torch.no_grad():
-                        for img1, img2, label in val_loader:
-                            img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-
-                            with torch.cuda.amp.autocast():
-                                out1, out2 = model(img1, img2)
-                                loss = criterion(out1, out2, label)
-
-                            acc = compute_accuracy(out1, out2, label)
-                            running_loss += loss.item()
-                            running_acc += acc
-
-                    val_loss = running_loss / len(val_loader)
-                    val_acc = running_acc / len(val_loader)
-
-                    train_losses.append(train_loss)
-                    val_losses.append(val_loss)
-                    train_accuracies.append(train_acc)
-                    val_accuracies.append(val_acc)
-
-                    print(f"[Pretrained T={t}] Epoch {epoch+1}/{num_epochs} | Training loss: {train_loss:.5f}, Training accuracy: {train_acc:.5f} | Validation loss: {val_loss:.5f}, Validation accuracy: {val_acc:.5f}")
-
-                    epoch_results = {
-                        'train_losses': train_losses,
-                        'val_losses': val_losses,
-                        'train_accs': train_accuracies,
-                        'val_accs': val_accuracies,
-                        'current_epoch': epoch + 1
-                    }
-
-                    mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
-                    epoch_data_dir = os.path.join(MODEL_DIR, "pretrained", mode_dir, "epoch_data", t)
-                    os.makedirs(epoch_data_dir, exist_ok=True)
-
-                    with open(os.path.join(epoch_data_dir, f"epoch_{epoch+1}_data.json"), 'w') as f:
-                        json.dump(epoch_results, f, indent=2)
-
-                    print(f"Epoch {epoch+1} data saved for time setting {t}")
-
-                mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
-                pretrained_model_dir = os.path.join(MODEL_DIR, "pretrained", mode_dir)
-                os.makedirs(pretrained_model_dir, exist_ok=True)
-                save_path = os.path.join(pretrained_model_dir, f"pretrained_model_T{t}.pt")
-                torch.save(model.state_dict(), save_path)
-                print(f"Pretrained model {t} saved to {save_path}")
-
-                results[t] = {
-                    'train_losses': train_losses,
-                    'val_losses': val_losses,
-                    'train_accs': train_accuracies,
-                    'val_accs': val_accuracies
-                }
+            if activation_checkpoints:
+                activation_checkpoint_report(time_settings, {"none": {}, "configured": activation_checkpoints}, batch_size=64)
 
             mode_dir = "frozen_backbone" if freeze_backbone else "full_finetune"
-            with open(os.path.join(BASE_PATH, f'pretrained_{mode_dir}_training_results.json'), 'w') as f:
+            sweep_mode = (f"{mode_dir}_tbptt_st" if bptt_straight_through else f"{mode_dir}_tbptt") if bptt_steps else mode_dir
+            if successive_halving_sweep:
+                results, _, sweep_mode = successive_halving(time_settings, sweep_mode, train_pairs, val_pairs, names, face_cache, single_pass=single_pass, embedding_options=embedding_options)
+            else:
+                results = run_sweep(time_settings, [sweep_mode], train_pairs, val_pairs, names, face_cache, num_epochs=10, single_pass=single_pass, embedding_options=embedding_options, amp=mixed_precision)[sweep_mode]
+
+            with open(os.path.join(BASE_PATH, f'pretrained_{sweep_mode}_training_results.json'), 'w') as f:
                 json.dump(results, f, indent=2)
+            if bptt_steps:
+                compare_sweep_modes(time_settings, [mode_dir, sweep_mode])
+            if amp_comparison and mixed_precision:
+                run_sweep(time_settings, [f"{sweep_mode}_fp32"], train_pairs, val_pairs, names, face_cache, num_epochs=10, single_pass=single_pass, embedding_options=embedding_options, amp=False)
+                compare_sweep_modes(time_settings, [f"{sweep_mode}_fp32", sweep_mode])
 
             print("所有时间设置的训练结果已保存")
 
@@ -936,8 +2223,14 @@ def main():
                     mt_inverted = os.path.join(face_dir, image_files[1])
                     print(f"使用 {mt_normal} 和 {mt_inverted} 作为测试图像")
 
+    if use_pretrained and quantize_int8:
+        quantize_time_settings(time_settings, val_dataset, freeze_backbone=freeze_backbone)
+
     print("\nStart predicting Margaret Thatcher effect image pairs...")
-    predict_pair_over_time(mt_normal, mt_inverted, time_settings, model_filenames, use_pretrained=use_pretrained, freeze_backbone=freeze_backbone)
+    predict_pair_over_time(mt_normal, mt_inverted, time_settings, model_filenames, use_pretrained=use_pretrained, freeze_backbone=freeze_backbone, quantized=quantize_int8)
+    if use_pretrained:
+        predict_pair_anytime(mt_normal, mt_inverted, "5_10_5", time_settings["5_10_5"], freeze_backbone=freeze_backbone)
+        early_exit_report(val_dataset, "5_10_5", time_settings["5_10_5"], freeze_backbone=freeze_backbone)
 
     print("\nStart generating saliency maps...")
     if use_pretrained:
@@ -947,7 +2240,7 @@ def main():
         print("Generating saliency maps for all standard models...")
         generate_saliency_over_time_batch(val_dataset, time_settings, num_images=10, use_pretrained=False, freeze_backbone=False)
 
-    compare_models_performance(val_dataset, time_settings, freeze_backbone=freeze_backbone)
+    compare_models_performance(val_dataset, time_settings, freeze_backbone=freeze_backbone, quantized=quantize_int8)
 
     if should_train:
         if use_pretrained:
@@ -975,16 +2268,13 @@ print("加载数据集...")
 face_dir = os.path.join(DATA_ROOT, "faces")
 list_dir = os.path.join(DATA_ROOT, "lists")
 
-pairs = load_all_pairs(list_dir)
+names, pairs = load_pair_index(list_dir)
+face_store = build_face_store(names, face_dir, os.path.join(DATA_ROOT, "face_store"))
+face_cache = build_resized_cache(names, face_store, os.path.join(DATA_ROOT, "face_cache"), sizes=(256,))
 split_idx = int(0.9 * len(pairs))
 val_pairs = pairs[split_idx:]
 
-transform = transforms.Compose([
-    transforms.Resize((256, 256)),
-    transforms.ToTensor()
-])
-
-val_dataset = FacePairsDataset(val_pairs, face_dir, transform=transform)
+val_dataset = ShardedFacePairsDataset(val_pairs, names, face_cache, 256)
 print(f"验证集大小: {len(val_dataset)}张图像对")
 
 print("\n为所有时间设置生成10张显著图...")
@@ -1149,8 +2439,39 @@ from torchvision import transforms
 save_dir = os.path.join(OUTPUT_DIR, "predictions")
 os.makedirs(save_dir, exist_ok=True)
 
-def predict_all_images():
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# Batched illusion prediction: all pairs are preprocessed once into one stack per side and every model
+# runs once over the whole stack, giving (models x pairs) distance / probability matrices. Pairs that fail to
+# load are skipped; when none loads the stacks are None
+def load_pair_stack(image_pairs, transform):
+    left, right, names = [], [], []
+    for img1_path, img2_path, name in image_pairs:
+        try:
+            img1 = transform(load_image(img1_path))
+            img2 = transform(load_image(img2_path))
+        except Exception as e:
+            print(f"处理图片对 {name} 时出错: {e}")
+            continue
+        left.append(img1)
+        right.append(img2)
+        names.append(name)
+    if not names:
+        return None, None, names
+    return torch.stack(left), torch.stack(right), names
+
+def predict_pair_matrix(models, left, right, device, alpha=10, beta=5):
+    left, right = left.to(device), right.to(device)
+    distances = torch.empty(len(models), left.size(0))
+    with torch.no_grad():
+        for row, model in enumerate(models):
+            model.eval()
+            emb1, emb2 = model(left, right)
+            distances[row] = F.pairwise_distance(emb1, emb2).float().cpu()
+    probs = torch.sigmoid(-alpha * distances + beta)
+    return distances.numpy(), probs.numpy()
+
+# quantized = True scores with the int8 models (quantize_time_settings) on the CPU
+def predict_all_images(quantized=False):
+    device = torch.device('cpu') if quantized else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     image_pairs = [
         ("/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion.jpg",
@@ -1181,43 +2502,43 @@ def predict_all_images():
 
     early_models = ["0_0_1", "0_0_2", "0_0_4", "0_2_1", "0_2_2", "0_2_4"]
 
-    for img1_path, img2_path, name in image_pairs:
-        print(f"\n预测图片对: {name}")
-        try:
-            img1 = transform(Image.open(img1_path).convert("RGB")).unsqueeze(0).to(device)
-            img2 = transform(Image.open(img2_path).convert("RGB")).unsqueeze(0).to(device)
-
-            distances = []
-            probs = []
-
-            sorted_keys = sorted(time_settings.keys(), key=sort_key)
-
-            for structure_name in sorted_keys:
-                times_dict = time_settings[structure_name]
-
-                model = SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False).to(device)
-
-                pretrained_model_dir = os.path.join(MODEL_DIR, "pretrained", "full_finetune")
-                pretrained_model_path = os.path.join(pretrained_model_dir, f"pretrained_model_T{structure_name}.pt")
+    sorted_keys = sorted(time_settings.keys(), key=sort_key)
+    models = []
+    for structure_name in sorted_keys:
+        times_dict = time_settings[structure_name]
 
-                if os.path.exists(pretrained_model_path):
-                    try:
-                        model.load_state_dict(torch.load(pretrained_model_path, map_location=device))
-                        print(f"加载模型权重: {pretrained_model_path}")
-                    except Exception as e:
-                        print(f"无法加载权重 {structure_name}: {e}")
-                else:
-                    print(f"未找到模型 {structure_name}, 使用基础预训练权重")
+        pretrained_model_dir = os.path.join(MODEL_DIR, "pretrained", "full_finetune")
+        pretrained_model_path = os.path.join(pretrained_model_dir, f"pretrained_model_T{structure_name}.pt")
 
-                model.eval()
+        model = None
+        if os.path.exists(pretrained_model_path):
+            try:
+                model = cached_model("SiamesePretrainedCORnet", times_dict, pretrained_model_path, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False), quantized)
+                print(f"加载模型权重: {pretrained_model_path}")
+            except Exception as e:
+                print(f"无法加载权重 {structure_name}: {e}")
+        else:
+            print(f"未找到模型 {structure_name}, 使用基础预训练权重")
+        if model is None:
+            model = cached_model("SiamesePretrainedCORnet", times_dict, None, device, lambda: SiamesePretrainedCORnet(times_dict, pretrained=True, freeze_backbone=False))
+        models.append(model)
+
+    left, right, pair_names = load_pair_stack(image_pairs, transform)
+    if not pair_names:
+        print("没有可以加载的图片对，跳过预测")
+        return
+    distance_matrix, prob_matrix = predict_pair_matrix(models, left, right, device)
 
-                with torch.no_grad():
-                    emb1, emb2 = model(img1, img2)
-                    dist = F.pairwise_distance(emb1, emb2).item()
-                    prob = torch.sigmoid(torch.tensor(-10 * dist + 5)).item()
-                    distances.append(dist)
-                    probs.append(prob)
+    with open(os.path.join(save_dir, "prediction_matrix.json"), "w") as f:
+        json.dump({"time_settings": sorted_keys, "pairs": pair_names,
+                   "distances": distance_matrix.tolist(), "probs": prob_matrix.tolist()}, f, indent=2)
 
+    for col, name in enumerate(pair_names):
+        print(f"\n预测图片对: {name}")
+        try:
+            distances = distance_matrix[:, col].tolist()
+            probs = prob_matrix[:, col].tolist()
+            for structure_name, dist, prob in zip(sorted_keys, distances, probs):
                 print(f"{structure_name} → 距离={dist:.4f}, 相同概率={prob:.4f}")
 
             overall_max_idx = np.argmax(probs)
@@ -12,53 +12,267 @@ drive.flush_and_unmount()
 drive.mount('/content/drive')
 
 import os
+import re
+import hashlib
+import time
+import contextlib
+import copy
+import warnings
 
 #Prepare to read pair
-def read_pairs(file_path, label):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    return [(line.strip().split()[0], line.strip().split()[1], label) for line in lines]
+# Pair index: int32 rows of (left id, right id, label, fold, split), ids point into `names`
+PAIR_SPLITS = ["train", "test"]
 
-def load_all_pairs(list_dir):
-    all_pairs = []
+def pair_list_files(list_dir):
+    files = []
     for i in range(1, 11):
         prefix = f"{i:02d}"
-        for split in ["train", "test"]:
-            same_file = os.path.join(list_dir, f"{prefix}_{split}_same.txt")
-            diff_file = os.path.join(list_dir, f"{prefix}_{split}_diff.txt")
-            all_pairs += read_pairs(same_file, 1)
-            all_pairs += read_pairs(diff_file, 0)
-    return all_pairs
+        for split in PAIR_SPLITS:
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_same.txt"), 1, i, PAIR_SPLITS.index(split)))
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_diff.txt"), 0, i, PAIR_SPLITS.index(split)))
+    return files
+
+def load_pair_index(list_dir, cache_dir=None):
+    files = pair_list_files(list_dir)
+    digest = hashlib.sha1()
+    for path, _, _, _ in files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    key = digest.hexdigest()[:16]
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(list_dir), "pair_index")
+    names_path = os.path.join(cache_dir, f"names_{key}.npy")
+    pairs_path = os.path.join(cache_dir, f"pairs_{key}.npy")
+    if os.path.exists(names_path) and os.path.exists(pairs_path):
+        return np.load(names_path), np.load(pairs_path)
+
+    ids = {}
+    rows = []
+    for path, label, fold, split in files:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                left = ids.setdefault(fields[0], len(ids))
+                right = ids.setdefault(fields[1], len(ids))
+                rows.append((left, right, label, fold, split))
+
+    names = np.array(list(ids), dtype=str)
+    pairs = np.array(rows, dtype=np.int32).reshape(-1, 5)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(names_path, names)
+    np.save(pairs_path, pairs)
+    print(f"Pair index built: {len(pairs)} pairs, {len(names)} faces → {pairs_path}")
+    return names, pairs
+
+def select_pairs(pairs, fold=None, split=None, label=None):
+    mask = np.ones(len(pairs), dtype=bool)
+    if fold is not None:
+        mask &= pairs[:, 3] == fold
+    if split is not None:
+        mask &= pairs[:, 4] == PAIR_SPLITS.index(split)
+    if label is not None:
+        mask &= pairs[:, 2] == label
+    return pairs[mask]
+
+def dedupe_pairs(pairs):
+    # (a, b) and (b, a) with the same label count as one pair, first occurrence is kept
+    key = np.stack([pairs[:, :2].min(axis=1), pairs[:, :2].max(axis=1), pairs[:, 2]], axis=1)
+    _, first = np.unique(key, axis=0, return_index=True)
+    return pairs[np.sort(first)]
 
 from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 import torchvision.transforms as transforms
 import torch
+import numpy as np
+import json
+
+# LFWCrop faces are binary PPM (P6), so the pixel block can be mapped directly without PIL
+PPM_HEADER = re.compile(rb'P6(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)\s')
+
+def read_ppm(path):
+    with open(path, 'rb') as f:
+        header = PPM_HEADER.match(f.read(512))
+    if header is None or int(header.group(3)) > 255:
+        return None
+    width, height = int(header.group(1)), int(header.group(2))
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=header.end(), shape=(height, width, 3))
+
+def load_pixels(path):
+    # Other formats (e.g. the .jpg illusion stimuli) fall back to PIL
+    pixels = read_ppm(path) if path.lower().endswith(".ppm") else None
+    if pixels is None:
+        pixels = np.asarray(Image.open(path).convert("RGB"))
+    return pixels
+
+def load_image(path):
+    return Image.fromarray(np.asarray(load_pixels(path)))
+
+# Decode every face once into a memory-mapped uint8 store (faces.npy + name -> row index)
+def build_face_store(names, image_dir, store_dir):
+    names = [str(name) for name in names]
+    faces_path = os.path.join(store_dir, "faces.npy")
+    index_path = os.path.join(store_dir, "index.json")
+
+    if os.path.exists(faces_path) and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if all(name in index for name in names):
+            return faces_path, index
+
+    os.makedirs(store_dir, exist_ok=True)
+    first = np.asarray(load_image(os.path.join(image_dir, names[0] + ".ppm")))
+    faces = np.lib.format.open_memmap(faces_path, mode='w+', dtype=np.uint8, shape=(len(names),) + first.shape)
+    for row, name in enumerate(names):
+        faces[row] = np.asarray(load_image(os.path.join(image_dir, name + ".ppm")))
+    faces.flush()
+    del faces
+
+    # The index is written last, so an interrupted build is redone next time
+    index = {name: row for row, name in enumerate(names)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f"Face store built: {len(names)} faces → {faces_path}")
+    return faces_path, index
 
 class FacePairsDataset(Dataset):
-    def __init__(self, pairs, image_dir, transform=None):
+    def __init__(self, pairs, names, image_dir, transform=None, store=None, raw=False):
         self.pairs = pairs
+        self.names = names
         self.image_dir = image_dir
         self.transform = transform or transforms.ToTensor()
+        # store = (faces_path, index) from build_face_store, pairs are then served by row lookup
+        self.store = store
+        # raw = True skips the transform and returns uint8 CHW tensors for prepare_batch
+        self.raw = raw
+        self._faces = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def _load(self, name):
+        if self.store is None:
+            pixels = load_pixels(os.path.join(self.image_dir, name + ".ppm"))
+        else:
+            if self._faces is None:
+                # Opened lazily so that every DataLoader worker maps the file on its own
+                self._faces = np.load(self.store[0], mmap_mode='r')
+            pixels = self._faces[self.store[1][name]]
+        if self.raw:
+            return torch.from_numpy(np.array(pixels)).permute(2, 0, 1)
+        return self.transform(Image.fromarray(np.asarray(pixels)))
+
+    def __getitem__(self, idx):
+        left, right, label = self.pairs[idx, :3]
+        img1 = self._load(str(self.names[left]))
+        img2 = self._load(str(self.names[right]))
+        return img1, img2, torch.tensor(label, dtype=torch.float32)
+
+# Resized uint8 faces per training resolution, written once as memory-mapped shards + manifest.json. Each script
+# builds only the size it trains at (sizes); another size is added to the same cache the first time it is asked for
+CACHE_SIZES = (64, 224, 256)
+
+def build_resized_cache(names, face_store, cache_dir, sizes=CACHE_SIZES, shard_size=4096):
+    names = [str(name) for name in names]
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {"names": names, "sizes": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            cached = json.load(f)
+        if cached["names"] == names:
+            manifest = cached
+
+    missing = [size for size in sizes if str(size) not in manifest["sizes"]]
+    if not missing:
+        return manifest_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    faces = np.load(face_store[0], mmap_mode='r')
+    # transforms.Resize on the decoded face, so cached pixels equal today's Resize + ToTensor output
+    resizers = {size: transforms.Resize((size, size)) for size in missing}
+    shards = {size: [] for size in missing}
+
+    for start in range(0, len(names), shard_size):
+        chunk = names[start:start + shard_size]
+        arrays = {}
+        for size in missing:
+            file_name = f"faces_{size}_{start // shard_size:03d}.npy"
+            arrays[size] = np.lib.format.open_memmap(os.path.join(cache_dir, file_name), mode='w+',
+                                                     dtype=np.uint8, shape=(len(chunk), 3, size, size))
+            shards[size].append({"file": file_name, "start": start, "count": len(chunk)})
+        for row, name in enumerate(chunk):
+            image = Image.fromarray(np.asarray(faces[face_store[1][name]]))
+            for size in missing:
+                arrays[size][row] = np.asarray(resizers[size](image)).transpose(2, 0, 1)
+        for array in arrays.values():
+            array.flush()
+
+    for size in missing:
+        manifest["sizes"][str(size)] = shards[size]
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    print(f"Face cache built for sizes {missing} → {cache_dir}")
+    return manifest_path
+
+class ShardedFacePairsDataset(Dataset):
+    def __init__(self, pairs, names, manifest_path, size, return_ids=False):
+        self.pairs = pairs
+        self.names = names
+        self.size = size
+        # return_ids = True also yields the two image ids, used by the Siamese wrappers to embed each face once per batch
+        self.return_ids = return_ids
+        self.cache_dir = os.path.dirname(manifest_path)
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        self.shards = manifest["sizes"][str(size)]
+        self.starts = np.array([shard["start"] for shard in self.shards])
+        cache_rows = {name: row for row, name in enumerate(manifest["names"])}
+        # image id (from the pair index) -> row in the cache
+        self.rows = np.array([cache_rows[str(name)] for name in names])
+        self._arrays = None
 
     def __len__(self):
         return len(self.pairs)
 
+    def _load(self, image_id):
+        if self._arrays is None:
+            # Opened lazily so that every DataLoader worker maps the shards on its own
+            self._arrays = [np.load(os.path.join(self.cache_dir, shard["file"]), mmap_mode='r') for shard in self.shards]
+        row = self.rows[image_id]
+        shard = np.searchsorted(self.starts, row, side='right') - 1
+        return torch.from_numpy(np.array(self._arrays[shard][row - self.starts[shard]]))
+
+    def __getitem__(self, idx):
+        left, right, label = self.pairs[idx, :3]
+        if self.return_ids:
+            return self._load(left), self._load(right), torch.tensor(label, dtype=torch.float32), int(left), int(right)
+        return self._load(left), self._load(right), torch.tensor(label, dtype=torch.float32)
+
+# Every distinct face of a pair dataset once, in sorted id order (for per-image evaluation)
+class UniqueFacesDataset(Dataset):
+    def __init__(self, pair_dataset):
+        self.pair_dataset = pair_dataset
+        self.ids = np.unique(pair_dataset.pairs[:, :2])
+
+    def __len__(self):
+        return len(self.ids)
+
     def __getitem__(self, idx):
-        name1, name2, label = self.pairs[idx]
-        name1 += ".ppm"
-        name2 += ".ppm"
-        img1 = Image.open(os.path.join(self.image_dir, name1)).convert("RGB")
-        img2 = Image.open(os.path.join(self.image_dir, name2)).convert("RGB")
-        return self.transform(img1), self.transform(img2), torch.tensor(label, dtype=torch.float32)
+        return self.pair_dataset._load(self.ids[idx])
 
 data_root = "/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/LFWCrop_dataset_pytorch"
 face_dir = os.path.join(data_root, "faces")
 list_dir = os.path.join(data_root, "lists")
+weights_root = os.path.join(os.path.dirname(data_root), "pretrained_weights")
 print(face_dir)
 print(list_dir)
 
-pairs = load_all_pairs(list_dir)
+names, pairs = load_pair_index(list_dir)
+face_store = build_face_store(names, face_dir, os.path.join(data_root, "face_store"))
+face_cache = build_resized_cache(names, face_store, os.path.join(data_root, "face_cache"), sizes=(256,))
 
 split_idx = int(0.9 * len(pairs))
 train_pairs = pairs[:split_idx]
@@ -71,8 +285,8 @@ transform = transforms.Compose([
 ])
 
 # Dataset and Dataloader
-train_dataset = FacePairsDataset(train_pairs, face_dir, transform=transform)
-val_dataset = FacePairsDataset(val_pairs, face_dir, transform=transform)
+train_dataset = ShardedFacePairsDataset(train_pairs, names, face_cache, 256, return_ids=True)
+val_dataset = ShardedFacePairsDataset(val_pairs, names, face_cache, 256)
 
 train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, num_workers=4)
 val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False)
@@ -82,6 +296,63 @@ import torch.nn as nn
 import torchvision.models as models
 import torch.nn.functional as F
 import numpy as np
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+# Batched Resize + ToTensor for the uint8 batches of a raw FacePairsDataset, float batches pass through
+def prepare_batch(images, size):
+    if images.dtype != torch.uint8:
+        return images
+    images = images.float().div_(255)
+    if tuple(images.shape[-2:]) != (size, size):
+        images = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+    return images
+
+# Embed both sides of a pair batch with each unique image id embedded once, then gather back to pair order.
+# The gradient of a shared embedding is the sum over its copies, which matches separate calls only when no layer
+# normalises with batch statistics: only used by the BatchNorm-free models (VGG-16 HED, ViT)
+def embed_unique(embed, x1, x2, ids1, ids2):
+    ids = torch.cat([ids1, ids2])
+    unique_ids, inverse = torch.unique(ids, return_inverse=True)
+    positions = torch.arange(ids.numel(), device=ids.device)
+    first = torch.full_like(unique_ids, ids.numel()).scatter_reduce_(0, inverse, positions, reduce='amin')
+    out = embed(torch.cat([x1, x2]).index_select(0, first.to(x1.device)))
+    out = out.index_select(0, inverse.to(out.device))
+    return out[:x1.size(0)], out[x1.size(0):]
+
+def check_batch_resize(dataset, transform, size, num_batches=20, batch_size=64, num_workers=4, save_path=None):
+    # Throughput of per-sample PIL Resize vs. raw uint8 + prepare_batch, and how far apart the outputs are
+    pil_dataset = FacePairsDataset(dataset.pairs, dataset.names, dataset.image_dir, transform=transform, store=dataset.store)
+    raw_dataset = FacePairsDataset(dataset.pairs, dataset.names, dataset.image_dir, store=dataset.store, raw=True)
+
+    results = {"size": size}
+    for mode, ds in (("pil", pil_dataset), ("batched", raw_dataset)):
+        loader = DataLoader(ds, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+        seen = 0
+        start = time.time()
+        for b, (img1, img2, _) in enumerate(loader):
+            if b == num_batches:
+                break
+            img1, img2 = prepare_batch(img1, size), prepare_batch(img2, size)
+            seen += img1.size(0)
+        results[f"{mode}_samples_per_sec"] = seen / (time.time() - start)
+
+    n = min(batch_size, len(dataset))
+    reference = torch.stack([pil_dataset[i][0] for i in range(n)])
+    batched = prepare_batch(torch.stack([raw_dataset[i][0] for i in range(n)]), size)
+    results["max_abs_diff"] = (reference - batched).abs().max().item()
+    results["speedup"] = results["batched_samples_per_sec"] / results["pil_samples_per_sec"]
+
+    print(f"Resize {size}x{size}: PIL {results['pil_samples_per_sec']:.1f} samples/s | "
+          f"batched {results['batched_samples_per_sec']:.1f} samples/s | max diff {results['max_abs_diff']:.5f}")
+    # PIL rounds to uint8 after resampling, so one grey level is the expected gap
+    if results["max_abs_diff"] > 2 / 255:
+        print(f"Warning: prepare_batch differs from transforms.Resize by more than 2/255 ({results['max_abs_diff']:.5f})")
+
+    if save_path:
+        with open(save_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
 
 class ContrastiveLoss(nn.Module):
     def __init__(self, margin=1.0):
@@ -97,11 +368,64 @@ class ContrastiveLoss(nn.Module):
 
 import matplotlib.pyplot as plt
 
+# Pretrained backbones come from a local registry in weights_root: one flat state-dict file per backbone,
+# sha256-checked against registry.json and memory-mapped on load. A missing entry is fetched once from
+# PRETRAINED_SOURCES, which needs network, so populate the registry on such a machine first.
+PRETRAINED_SOURCES = {
+    "vgg16": lambda: models.vgg16(weights=models.VGG16_Weights.IMAGENET1K_V1),
+}
+_verified_weights = set()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_weight_registry(weights_dir):
+    registry_path = os.path.join(weights_dir, "registry.json")
+    if not os.path.exists(registry_path):
+        return {}
+    with open(registry_path, 'r') as f:
+        return json.load(f)
+
+def register_weights(name, state_dict, weights_dir=None):
+    weights_dir = weights_dir or weights_root
+    os.makedirs(weights_dir, exist_ok=True)
+    path = os.path.join(weights_dir, f"{name}.pt")
+    torch.save({key: value.detach().cpu().contiguous() for key, value in state_dict.items()}, path)
+
+    registry = read_weight_registry(weights_dir)
+    registry[name] = {"file": f"{name}.pt", "sha256": file_sha256(path), "bytes": os.path.getsize(path)}
+    with open(os.path.join(weights_dir, "registry.json"), 'w') as f:
+        json.dump(registry, f, indent=2)
+    print(f"Registered pretrained weights {name} → {path}")
+
+def pretrained_state(name, weights_dir=None):
+    weights_dir = weights_dir or weights_root
+    registry = read_weight_registry(weights_dir)
+    if name not in registry:
+        register_weights(name, PRETRAINED_SOURCES[name]().state_dict(), weights_dir)
+        registry = read_weight_registry(weights_dir)
+
+    entry = registry[name]
+    path = os.path.join(weights_dir, entry["file"])
+    stat = os.stat(path)
+    # Hash once per file version and process, later loads are plain page-cache reads
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _verified_weights:
+        if file_sha256(path) != entry["sha256"]:
+            raise ValueError(f"Pretrained weights {name} do not match the registry hash: {path}")
+        _verified_weights.add(key)
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
 # Embedded HED
 class HED_Embedding(nn.Module):
     def __init__(self):
         super(HED_Embedding, self).__init__()
-        vgg = models.vgg16(pretrained=True)
+        vgg = models.vgg16()
+        vgg.load_state_dict(pretrained_state("vgg16"))
         features = list(vgg.features.children())
 
         self.stage1 = nn.Sequential(*features[0:5])
@@ -129,64 +453,286 @@ class HED_Embedding(nn.Module):
 
 # Siamese
 class SiameseNetwork(nn.Module):
-    def __init__(self, embedding_net):
+    def __init__(self, embedding_net, input_size=256, single_pass=False):
         super(SiameseNetwork, self).__init__()
         self.embedding_net = embedding_net
-
-    def forward(self, x1, x2):
+        self.input_size = input_size
+        # single_pass = True embeds x1 and x2 as one 2B batch (one backbone call per step).
+        # VGG-16 has no BatchNorm, so the outputs are the same as two separate calls.
+        self.single_pass = single_pass
+
+    def forward_once(self, x):
+        return self.embedding_net(prepare_batch(x, self.input_size))
+
+    def forward(self, x1, x2, ids1=None, ids2=None):
+        if ids1 is not None:
+            return embed_unique(self.forward_once, x1, x2, ids1, ids2)
+        x1 = prepare_batch(x1, self.input_size)
+        x2 = prepare_batch(x2, self.input_size)
+        if self.single_pass:
+            out = self.embedding_net(torch.cat([x1, x2]))
+            return out[:x1.size(0)], out[x1.size(0):]
         out1 = self.embedding_net(x1)
         out2 = self.embedding_net(x2)
         return out1, out2
 
-def compute_accuracy(out1, out2, labels, threshold=0.5):
+# Fold every Conv2d -> BatchNorm2d pair of an eval-mode module into the conv, in place (the BatchNorm becomes
+# Identity): consecutive children of nn.Sequential and conv<i> / bn<i> of torchvision ResNet blocks.
+# Returns the number of folded pairs
+def fold_conv_bn(module):
+    folded = 0
+    for name, child in list(module.named_children()):
+        folded += fold_conv_bn(child)
+    names = list(module._modules)
+    pairs = list(zip(names, names[1:])) if isinstance(module, nn.Sequential) else []
+    if isinstance(module, (models.ResNet, models.resnet.BasicBlock, models.resnet.Bottleneck)):
+        pairs += [(f'conv{i}', f'bn{i}') for i in (1, 2, 3)]
+    for conv_name, bn_name in pairs:
+        conv, bn = module._modules.get(conv_name), module._modules.get(bn_name)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, conv_name, torch.nn.utils.fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+            folded += 1
+    return folded
+
+# Largest difference of the embeddings and of the pair distances of two Siamese models on the same image pairs
+def inference_equivalence(reference, model, x1, x2):
+    with torch.no_grad():
+        r1, r2 = reference(x1, x2)
+        f1, f2 = model(x1, x2)
+    return {
+        'max_embedding_diff': max((r1 - f1).abs().max().item(), (r2 - f2).abs().max().item()),
+        'max_distance_diff': (F.pairwise_distance(r1, r2) - F.pairwise_distance(f1, f2)).abs().max().item()
+    }
+
+# Inference export of a Siamese model: an eval-mode copy with the conv -> BatchNorm pairs folded, the weights in
+# channels_last (the convolutions then keep their activations channels_last) and no parameter gradients. The copy is
+# checked against the model on example = (x1, x2), random images by default, and a pair distance that moves by more
+# than atol raises ValueError. Returns the copy and the check
+def freeze_for_inference(model, example=None, atol=1e-4):
+    training = model.training
+    model.eval()
+    frozen = copy.deepcopy(model)
+    folded = fold_conv_bn(frozen)
+    frozen = frozen.to(memory_format=torch.channels_last).requires_grad_(False)
+    if example is None:
+        device = next(model.parameters()).device
+        generator = torch.Generator().manual_seed(0)
+        example = [torch.rand(4, 3, model.input_size, model.input_size, generator=generator).to(device) for _ in range(2)]
+    check = dict(inference_equivalence(model, frozen, *example), folded_pairs=folded)
+    model.train(training)
+    if check['max_distance_diff'] > atol:
+        raise ValueError(f"Folded model differs from the original: max pair distance difference {check['max_distance_diff']:.2e}")
+    return frozen, check
+
+# From the state dict: quantized modules keep their (packed) weights outside parameters()
+def model_nbytes(model):
+    values = [v for value in model.state_dict().values() for v in (value if isinstance(value, tuple) else (value,))]
+    return sum(t.numel() * t.element_size() for t in values if isinstance(t, torch.Tensor))
+
+# int8 artifact of a checkpoint (quantize_model), stored next to it
+def quantized_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + "_int8.pt"
+
+# Int8 version of a frozen model (freeze_for_inference): its embedding_net is traced with torch.fx and quantized
+# statically, with the activation ranges observed by calibrate(prepared); nn.Linear layers are quantized dynamically
+# (int8 weights, activation range per batch). Quantized kernels run on the CPU only. VGG-16 has no BatchNorm to fold,
+# its fc head is the dynamically quantized part
+def quantize_structure(frozen, calibrate=None):
+    quantized = copy.deepcopy(frozen).cpu()
+    # Linear layers (also when fused with a following ReLU) stay float in the traced graph for quantize_dynamic
+    qconfig_mapping = get_default_qconfig_mapping('x86')
+    for name, module in quantized.embedding_net.named_modules():
+        if isinstance(module, nn.Linear):
+            qconfig_mapping.set_module_name(name, None)
+    example = torch.rand(1, 3, frozen.input_size, frozen.input_size)
+    prepared = prepare_fx(quantized.embedding_net, qconfig_mapping, (example,))
+    if calibrate is not None:
+        with torch.no_grad():
+            calibrate(prepared)
+    quantized.embedding_net = convert_fx(prepared)
+    return quantize_dynamic(quantized, {nn.Linear, torch.ao.nn.intrinsic.LinearReLU}, dtype=torch.qint8)
+
+# The artifact is the int8 state dict: the quantized structure is rebuilt (uncalibrated) from `build` created on the
+# meta device and materialised as zeros on the CPU, so no pretrained copy, init or equivalence check runs for values
+# that the quantized weights, scales and zero points of the artifact then replace
+def load_quantized_model(build, path):
+    # The pretrained weights HED_Embedding copies in __init__ are a no-op on the meta device
+    with torch.device('meta'), warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='.*non-meta parameter')
+        structure = build()
+    structure = structure.to_empty(device='cpu').eval().requires_grad_(False)
+    with torch.no_grad():
+        for tensor in list(structure.parameters()) + list(structure.buffers()):
+            tensor.zero_()
+    fold_conv_bn(structure)
+    model = quantize_structure(structure)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    return model.eval()
+
+# Post-training int8 quantization for CPU pair scoring (quantize_structure), calibrated on calibration_images faces
+# sampled from `dataset` (the validation pairs). Saves the int8 state dict to save_path and a report of the
+# pair-distance drift and verification-accuracy change against the fp32 model on all pairs of `dataset` to
+# <save_path>_report.json. Returns the int8 model and the report
+def quantize_model(model, dataset, save_path, calibration_images=256, batch_size=32, threshold=0.5):
+    reference = freeze_for_inference(model)[0].cpu()
+    faces = UniqueFacesDataset(dataset)
+    sample = np.random.RandomState(0).permutation(len(faces))[:calibration_images]
+    loader = DataLoader(torch.utils.data.Subset(faces, sample), batch_size=batch_size, shuffle=False, num_workers=4)
+
+    def calibrate(prepared):
+        for images in loader:
+            prepared(prepare_batch(images, model.input_size))
+
+    quantized = quantize_structure(reference, calibrate)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    torch.save(quantized.state_dict(), save_path)
+
+    report = {'calibration_images': len(sample)}
+    results = {}
+    for name, m in (('fp32', reference), ('int8', quantized)):
+        start = time.time()
+        results[name] = evaluate_pairs(m, dataset, torch.device('cpu'), threshold=threshold, batch_size=batch_size)
+        report[f'{name}_accuracy'] = results[name]['accuracy']
+        report[f'{name}_eval_sec'] = time.time() - start
+        report[f'{name}_mb'] = model_nbytes(m) / 1024 ** 2
+    drift = (results['int8']['distances'] - results['fp32']['distances']).abs()
+    flips = (results['int8']['distances'] < threshold) != (results['fp32']['distances'] < threshold)
+    report.update({
+        'num_pairs': results['fp32']['num_pairs'],
+        'accuracy_change': report['int8_accuracy'] - report['fp32_accuracy'],
+        'mean_distance_drift': drift.mean().item(),
+        'max_distance_drift': drift.max().item(),
+        'decision_flips': int(flips.sum())
+    })
+
+    report_path = os.path.splitext(save_path)[0] + "_report.json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"int8 model saved to {save_path} | accuracy {report['fp32_accuracy']:.5f} -> {report['int8_accuracy']:.5f}, "
+          f"mean distance drift {report['mean_distance_drift']:.4f}, {report['fp32_mb']:.1f} -> {report['int8_mb']:.1f} MB")
+    return quantized, report
+
+# Running loss / accuracy kept as device tensors, read back once per epoch instead of with .item() every batch
+class MetricsAccumulator:
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = 0.0
+        self.correct = 0.0
+        self.count = 0
+
+    def update(self, out1, out2, labels, loss):
+        with torch.no_grad():
+            distances = F.pairwise_distance(out1.float(), out2.float())
+            preds = (distances < self.threshold).float()
+            self.correct = self.correct + (preds == labels).float().sum()
+            # Batch means are weighted by batch size, so a short last batch counts for what it holds
+            self.loss_sum = self.loss_sum + loss.detach().float() * labels.size(0)
+        self.count += labels.size(0)
+
+    def compute(self):
+        return float(self.loss_sum) / self.count, float(self.correct) / self.count
+
+# Mixed precision for the training loops: CUDA fp16 with a GradScaler, CPU bfloat16 where the CPU computes bf16
+# natively (AMX / AVX512-BF16), fp32 otherwise. bf16 keeps the fp32 exponent range, so off CUDA the scaler is a no-op
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'amx_bf16' in flags or 'avx512_bf16' in flags
+
+class MixedPrecision:
+    def __init__(self, device, enabled=True):
+        self.device_type = torch.device(device).type
+        if self.device_type == 'cuda':
+            self.dtype = torch.float16
+        elif self.device_type == 'cpu' and cpu_supports_bf16():
+            self.dtype = torch.bfloat16
+        else:
+            self.dtype = None
+        self.enabled = enabled and self.dtype is not None
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.enabled and self.dtype == torch.float16)
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def __repr__(self):
+        return f"MixedPrecision({self.device_type}, {self.dtype if self.enabled else 'fp32'})"
+
+# Evaluation engine: embed each unique face of the split once, then score every pair from the embedding table
+def embed_faces(model, dataset, device, batch_size=64, num_workers=4):
+    faces = UniqueFacesDataset(dataset)
+    loader = DataLoader(faces, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for images in loader:
+            embeddings.append(model.forward_once(images.to(device)).float())
+    return faces.ids, torch.cat(embeddings)
+
+def evaluate_pairs(model, dataset, device, criterion=None, threshold=0.5, batch_size=64, num_workers=4):
+    ids, embeddings = embed_faces(model, dataset, device, batch_size, num_workers)
+    rows = torch.from_numpy(np.searchsorted(ids, dataset.pairs[:, :2])).long().to(embeddings.device)
+    labels = torch.from_numpy(dataset.pairs[:, 2]).float().to(embeddings.device)
+    out1, out2 = embeddings[rows[:, 0]], embeddings[rows[:, 1]]
     distances = F.pairwise_distance(out1, out2)
     preds = (distances < threshold).float()
-    correct = (preds == labels).float().sum()
-    accuracy = correct / labels.size(0)
-    return accuracy.item()
-
-def train_epoch(model, dataloader, criterion, optimizer):
+    results = {
+        'accuracy': (preds == labels).float().mean().item(),
+        'distances': distances.cpu(),
+        'num_images': len(ids),
+        'num_pairs': len(labels)
+    }
+    if criterion is not None:
+        results['loss'] = criterion(out1, out2, labels).item()
+    return results
+
+def train_epoch(model, dataloader, criterion, optimizer, amp):
     model.train()
-    running_loss = 0.0
-    running_acc = 0.0
-    for img1, img2, label in dataloader:
+    metrics = MetricsAccumulator()
+    for img1, img2, label, ids1, ids2 in dataloader:
         img1, img2, label = img1.to(device), img2.to(device), label.to(device)
         optimizer.zero_grad()
-        out1, out2 = model(img1, img2)
-        loss = criterion(out1, out2, label)
-        acc = compute_accuracy(out1, out2, label)
-        loss.backward()
-        optimizer.step()
-        running_loss += loss.item()
-        running_acc += acc
-    return running_loss / len(dataloader), running_acc / len(dataloader)
+        with amp.autocast():
+            out1, out2 = model(img1, img2, ids1, ids2)
+            loss = criterion(out1, out2, label)
+        amp.scaler.scale(loss).backward()
+        amp.scaler.step(optimizer)
+        amp.scaler.update()
+        metrics.update(out1, out2, label, loss)
+    return metrics.compute()
 
 def validate(model, dataloader, criterion):
-    model.eval()
-    running_loss = 0.0
-    running_acc = 0.0
-    with torch.no_grad():
-        for img1, img2, label in dataloader:
-            img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-            out1, out2 = model(img1, img2)
-            loss = criterion(out1, out2, label)
-            acc = compute_accuracy(out1, out2, label)
-            running_loss += loss.item()
-            running_acc += acc
-    return running_loss / len(dataloader), running_acc / len(dataloader)
+    results = evaluate_pairs(model, dataloader.dataset, device, criterion, batch_size=dataloader.batch_size)
+    return results['loss'], results['accuracy']
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+# Set benchmark_resize = True to time PIL Resize against prepare_batch on the validation pairs before training
+# (last recorded run: Output/HED/HED_batch_resize_benchmark.json)
+benchmark_resize = False
+if benchmark_resize:
+    check_batch_resize(FacePairsDataset(val_pairs, names, face_dir, store=face_store, raw=True), transform, 256, save_path="HED_batch_resize_benchmark.json")
+
 model = SiameseNetwork(HED_Embedding()).to(device)
 criterion = ContrastiveLoss()
 optimizer = torch.optim.Adam(model.parameters(), lr=4e-6)
+amp = MixedPrecision(device)
+print(f"Precision: {amp}")
 
 num_epochs = 10
 train_losses, val_losses = [], []
 train_accuracies, val_accuracies = [], []
 
 for epoch in range(num_epochs):
-    train_loss, train_acc = train_epoch(model, train_loader, criterion, optimizer)
+    train_loss, train_acc = train_epoch(model, train_loader, criterion, optimizer, amp)
     val_loss, val_acc = validate(model, val_loader, criterion)
 
     train_losses.append(train_loss)
@@ -244,14 +790,36 @@ plt.tight_layout()
 plt.savefig("Loss and Accuracy Curves.png")
 plt.show()
 
-def predict_HED_over_time(img1_path, img2_path, model, device, transform=None, threshold=0.5, alpha=10, beta=5):
+# Folded, channels_last copy of the trained model for the forward-only cells (predictions and saliency maps).
+# VGG-16 has no BatchNorm, so nothing is folded here and the copy only changes the memory format
+inference_model, equivalence = freeze_for_inference(model)
+print(f"Inference model: {equivalence['folded_pairs']} conv-BN pairs folded, max distance difference {equivalence['max_distance_diff']:.2e}")
+
+# quantize_int8 = True also writes an int8 copy of the trained model (quantize_model: calibrated on validation faces,
+# with a drift / accuracy report) and the prediction cells score with it on the CPU; it is saved with the model below
+quantize_int8 = False
+quantized_model_path = "HED_model_int8.pt" if quantize_int8 else None
+if quantize_int8:
+    quantize_model(model, val_dataset, quantized_model_path)
+
+# int8 SiameseNetwork of a quantize_model artifact, loaded once per path
+_int8_models = {}
+def load_int8_model(path):
+    if path not in _int8_models:
+        _int8_models[path] = load_quantized_model(lambda: SiameseNetwork(HED_Embedding()), path)
+    return _int8_models[path]
+
+def predict_HED_over_time(img1_path, img2_path, model, device, transform=None, threshold=0.5, alpha=10, beta=5, quantized_model_path=None):
+    # quantized_model_path scores with that int8 artifact (quantize_model) on the CPU instead of `model`
+    if quantized_model_path:
+        model, device = load_int8_model(quantized_model_path), torch.device('cpu')
 
     transform = transforms.Compose([
         transforms.Resize((224, 224)),
         transforms.ToTensor()])
 
-    img1 = transform(Image.open(img1_path).convert("RGB")).unsqueeze(0).to(device)
-    img2 = transform(Image.open(img2_path).convert("RGB")).unsqueeze(0).to(device)
+    img1 = transform(load_image(img1_path)).unsqueeze(0).to(device)
+    img2 = transform(load_image(img2_path)).unsqueeze(0).to(device)
 
     model.eval()
     with torch.no_grad():
@@ -305,10 +873,10 @@ def predict_HED_over_time(img1_path, img2_path, model, device, transform=None, t
 
     return is_same, dist, prob
 
-predict_HED_over_time("/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test.jpg", "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test_n.jpg", model, device, threshold=0.5)
-# predict_HED_over_time("/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test2.jpg", "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test_n2.jpg", model, device, threshold=0.5)
-# predict_HED_over_time("/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion.jpg", "/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion_n.jpg", model, device, threshold=0.5)
-# predict_HED_over_time("/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion2.jpg", "/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion_n2.jpg", model, device, threshold=0.5)
+predict_HED_over_time("/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test.jpg", "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test_n.jpg", inference_model, device, threshold=0.5, quantized_model_path=quantized_model_path)
+# predict_HED_over_time("/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test2.jpg", "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Margaret Thatcher_test_n2.jpg", inference_model, device, threshold=0.5, quantized_model_path=quantized_model_path)
+# predict_HED_over_time("/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion.jpg", "/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion_n.jpg", inference_model, device, threshold=0.5, quantized_model_path=quantized_model_path)
+# predict_HED_over_time("/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion2.jpg", "/content/drive/MyDrive/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion_n2.jpg", inference_model, device, threshold=0.5, quantized_model_path=quantized_model_path)
 
 def enhance_red_in_saliency(model, dataset, device, num_samples=10, top_percent=0.1, intensity=0.9, save_dir=None):
     model.eval()
@@ -318,7 +886,7 @@ def enhance_red_in_saliency(model, dataset, device, num_samples=10, top_percent=
 
     for i in range(num_samples):
         img1, _, _ = dataset[i]
-        img1 = img1.unsqueeze(0).to(device).requires_grad_()
+        img1 = prepare_batch(img1.unsqueeze(0).to(device), model.input_size).requires_grad_()
 
         out1, _ = model.forward(img1, img1)
         score = out1.norm()
@@ -364,10 +932,11 @@ def enhance_red_in_saliency(model, dataset, device, num_samples=10, top_percent=
 
         plt.show()
 
-enhance_red_in_saliency(model, val_dataset, device, num_samples=10, save_dir="/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /Forth Experiment/HED")
+enhance_red_in_saliency(inference_model, val_dataset, device, num_samples=10, save_dir="/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /Forth Experiment/HED")
 
 # This saves model
 import os
+import shutil
 import torch
 from datetime import datetime
 
@@ -382,11 +951,19 @@ torch.save(model, model_path)
 weights_path = os.path.join(save_dir, "weights.pt")
 torch.save(model.state_dict(), weights_path)
 
+# int8 model and its drift / accuracy report (quantize_int8 above), next to the fp32 model
+saved_int8_path = None
+if quantize_int8:
+    saved_int8_path = os.path.join(save_dir, "model_int8.pt")
+    shutil.copy(quantized_model_path, saved_int8_path)
+    shutil.copy(os.path.splitext(quantized_model_path)[0] + "_report.json", os.path.splitext(saved_int8_path)[0] + "_report.json")
+
 config = {
     "model_name": model_name,
     "input_size": [3, 224, 224],
     "output_size": model.output_size if hasattr(model, "output_size") else None,
     "timestamp": timestamp,
+    "quantized_model": os.path.basename(saved_int8_path) if saved_int8_path else None,
     "description": "HED model trained on face recognition task"
 }
 
@@ -18,15 +18,25 @@ from google.colab import drive
 drive.mount('/content/drive')
 
 import os
+import re
+import hashlib
+import time
+import random
+import contextlib
+import copy
 import torch
+import torch.utils.checkpoint
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
 from torchvision import transforms, models
 from PIL import Image
 import matplotlib.pyplot as plt
 import numpy as np
 from cornet.cornet_s import CORblock_S
+from collections import OrderedDict
 import json
 from datetime import datetime
 
@@ -36,6 +46,7 @@ PREVIOUS_MODELS_PATH = "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Pr
 
 MODEL_DIR = os.path.join(BASE_PATH, "models")
 OUTPUT_DIR = os.path.join(BASE_PATH, "output")
+WEIGHTS_DIR = os.path.join(os.path.dirname(DATA_ROOT), "pretrained_weights")
 
 def ensure_directories():
     dirs = [
@@ -55,67 +66,347 @@ def ensure_directories():
 ensure_directories()
 
 # Preopare to read the image pair
-def read_pairs(file_path, label):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    return [(line.strip().split()[0], line.strip().split()[1], label) for line in lines]
+# Pair index: int32 rows of (left id, right id, label, fold, split), ids point into `names`
+PAIR_SPLITS = ["train", "test"]
 
-def load_all_pairs(list_dir):
-    all_pairs = []
+def pair_list_files(list_dir):
+    files = []
     for i in range(1, 11):
         prefix = f"{i:02d}"
-        for split in ["train", "test"]:
-            same_file = os.path.join(list_dir, f"{prefix}_{split}_same.txt")
-            diff_file = os.path.join(list_dir, f"{prefix}_{split}_diff.txt")
-            all_pairs += read_pairs(same_file, 1)
-            all_pairs += read_pairs(diff_file, 0)
-    return all_pairs
+        for split in PAIR_SPLITS:
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_same.txt"), 1, i, PAIR_SPLITS.index(split)))
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_diff.txt"), 0, i, PAIR_SPLITS.index(split)))
+    return files
+
+def load_pair_index(list_dir, cache_dir=None):
+    files = pair_list_files(list_dir)
+    digest = hashlib.sha1()
+    for path, _, _, _ in files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    key = digest.hexdigest()[:16]
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(list_dir), "pair_index")
+    names_path = os.path.join(cache_dir, f"names_{key}.npy")
+    pairs_path = os.path.join(cache_dir, f"pairs_{key}.npy")
+    if os.path.exists(names_path) and os.path.exists(pairs_path):
+        return np.load(names_path), np.load(pairs_path)
+
+    ids = {}
+    rows = []
+    for path, label, fold, split in files:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                left = ids.setdefault(fields[0], len(ids))
+                right = ids.setdefault(fields[1], len(ids))
+                rows.append((left, right, label, fold, split))
+
+    names = np.array(list(ids), dtype=str)
+    pairs = np.array(rows, dtype=np.int32).reshape(-1, 5)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(names_path, names)
+    np.save(pairs_path, pairs)
+    print(f"Pair index built: {len(pairs)} pairs, {len(names)} faces → {pairs_path}")
+    return names, pairs
+
+def select_pairs(pairs, fold=None, split=None, label=None):
+    mask = np.ones(len(pairs), dtype=bool)
+    if fold is not None:
+        mask &= pairs[:, 3] == fold
+    if split is not None:
+        mask &= pairs[:, 4] == PAIR_SPLITS.index(split)
+    if label is not None:
+        mask &= pairs[:, 2] == label
+    return pairs[mask]
+
+def dedupe_pairs(pairs):
+    # (a, b) and (b, a) with the same label count as one pair, first occurrence is kept
+    key = np.stack([pairs[:, :2].min(axis=1), pairs[:, :2].max(axis=1), pairs[:, 2]], axis=1)
+    _, first = np.unique(key, axis=0, return_index=True)
+    return pairs[np.sort(first)]
+
+# LFWCrop faces are binary PPM (P6), so the pixel block can be mapped directly without PIL
+PPM_HEADER = re.compile(rb'P6(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)\s')
+
+def read_ppm(path):
+    with open(path, 'rb') as f:
+        header = PPM_HEADER.match(f.read(512))
+    if header is None or int(header.group(3)) > 255:
+        return None
+    width, height = int(header.group(1)), int(header.group(2))
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=header.end(), shape=(height, width, 3))
+
+def load_pixels(path):
+    # Other formats (e.g. the .jpg illusion stimuli) fall back to PIL
+    pixels = read_ppm(path) if path.lower().endswith(".ppm") else None
+    if pixels is None:
+        pixels = np.asarray(Image.open(path).convert("RGB"))
+    return pixels
+
+def load_image(path):
+    return Image.fromarray(np.asarray(load_pixels(path)))
+
+# Decode every face once into a memory-mapped uint8 store (faces.npy + name -> row index)
+def build_face_store(names, image_dir, store_dir):
+    names = [str(name) for name in names]
+    faces_path = os.path.join(store_dir, "faces.npy")
+    index_path = os.path.join(store_dir, "index.json")
+
+    if os.path.exists(faces_path) and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if all(name in index for name in names):
+            return faces_path, index
+
+    os.makedirs(store_dir, exist_ok=True)
+    first = np.asarray(load_image(os.path.join(image_dir, names[0] + ".ppm")))
+    faces = np.lib.format.open_memmap(faces_path, mode='w+', dtype=np.uint8, shape=(len(names),) + first.shape)
+    for row, name in enumerate(names):
+        faces[row] = np.asarray(load_image(os.path.join(image_dir, name + ".ppm")))
+    faces.flush()
+    del faces
+
+    # The index is written last, so an interrupted build is redone next time
+    index = {name: row for row, name in enumerate(names)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f"Face store built: {len(names)} faces → {faces_path}")
+    return faces_path, index
 
 class FacePairsDataset(Dataset):
-    def __init__(self, pairs, image_dir, transform=None):
+    def __init__(self, pairs, names, image_dir, transform=None, store=None, raw=False):
         self.pairs = pairs
+        self.names = names
         self.image_dir = image_dir
         self.transform = transform or transforms.ToTensor()
+        # store = (faces_path, index) from build_face_store, pairs are then served by row lookup
+        self.store = store
+        # raw = True skips the transform and returns uint8 CHW tensors for prepare_batch
+        self.raw = raw
+        self._faces = None
 
     def __len__(self):
         return len(self.pairs)
 
+    def _load(self, name):
+        if self.store is None:
+            pixels = load_pixels(os.path.join(self.image_dir, name + ".ppm"))
+        else:
+            if self._faces is None:
+                # Opened lazily so that every DataLoader worker maps the file on its own
+                self._faces = np.load(self.store[0], mmap_mode='r')
+            pixels = self._faces[self.store[1][name]]
+        if self.raw:
+            return torch.from_numpy(np.array(pixels)).permute(2, 0, 1)
+        return self.transform(Image.fromarray(np.asarray(pixels)))
+
+    def __getitem__(self, idx):
+        left, right, label = self.pairs[idx, :3]
+        img1 = self._load(str(self.names[left]))
+        img2 = self._load(str(self.names[right]))
+        return img1, img2, torch.tensor(label, dtype=torch.float32)
+
+# Resized uint8 faces per training resolution, written once as memory-mapped shards + manifest.json. Each script
+# builds only the size it trains at (sizes); another size is added to the same cache the first time it is asked for
+CACHE_SIZES = (64, 224, 256)
+
+def build_resized_cache(names, face_store, cache_dir, sizes=CACHE_SIZES, shard_size=4096):
+    names = [str(name) for name in names]
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {"names": names, "sizes": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            cached = json.load(f)
+        if cached["names"] == names:
+            manifest = cached
+
+    missing = [size for size in sizes if str(size) not in manifest["sizes"]]
+    if not missing:
+        return manifest_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    faces = np.load(face_store[0], mmap_mode='r')
+    # transforms.Resize on the decoded face, so cached pixels equal today's Resize + ToTensor output
+    resizers = {size: transforms.Resize((size, size)) for size in missing}
+    shards = {size: [] for size in missing}
+
+    for start in range(0, len(names), shard_size):
+        chunk = names[start:start + shard_size]
+        arrays = {}
+        for size in missing:
+            file_name = f"faces_{size}_{start // shard_size:03d}.npy"
+            arrays[size] = np.lib.format.open_memmap(os.path.join(cache_dir, file_name), mode='w+',
+                                                     dtype=np.uint8, shape=(len(chunk), 3, size, size))
+            shards[size].append({"file": file_name, "start": start, "count": len(chunk)})
+        for row, name in enumerate(chunk):
+            image = Image.fromarray(np.asarray(faces[face_store[1][name]]))
+            for size in missing:
+                arrays[size][row] = np.asarray(resizers[size](image)).transpose(2, 0, 1)
+        for array in arrays.values():
+            array.flush()
+
+    for size in missing:
+        manifest["sizes"][str(size)] = shards[size]
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    print(f"Face cache built for sizes {missing} → {cache_dir}")
+    return manifest_path
+
+class ShardedFacePairsDataset(Dataset):
+    def __init__(self, pairs, names, manifest_path, size):
+        self.pairs = pairs
+        self.names = names
+        self.size = size
+        self.cache_dir = os.path.dirname(manifest_path)
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        self.shards = manifest["sizes"][str(size)]
+        self.starts = np.array([shard["start"] for shard in self.shards])
+        cache_rows = {name: row for row, name in enumerate(manifest["names"])}
+        # image id (from the pair index) -> row in the cache
+        self.rows = np.array([cache_rows[str(name)] for name in names])
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def _load(self, image_id):
+        if self._arrays is None:
+            # Opened lazily so that every DataLoader worker maps the shards on its own
+            self._arrays = [np.load(os.path.join(self.cache_dir, shard["file"]), mmap_mode='r') for shard in self.shards]
+        row = self.rows[image_id]
+        shard = np.searchsorted(self.starts, row, side='right') - 1
+        return torch.from_numpy(np.array(self._arrays[shard][row - self.starts[shard]]))
+
     def __getitem__(self, idx):
-        name1, name2, label = self.pairs[idx]
-        name1 += ".ppm"
-        name2 += ".ppm"
-        img1 = Image.open(os.path.join(self.image_dir, name1)).convert("RGB")
-        img2 = Image.open(os.path.join(self.image_dir, name2)).convert("RGB")
-        return self.transform(img1), self.transform(img2), torch.tensor(label, dtype=torch.float32)
+        left, right, label = self.pairs[idx, :3]
+        return self._load(left), self._load(right), torch.tensor(label, dtype=torch.float32)
+
+# Every distinct face of a pair dataset once, in sorted id order (for per-image evaluation)
+class UniqueFacesDataset(Dataset):
+    def __init__(self, pair_dataset):
+        self.pair_dataset = pair_dataset
+        self.ids = np.unique(pair_dataset.pairs[:, :2])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        return self.pair_dataset._load(self.ids[idx])
+
+# Shuffling sampler whose order depends only on (seed, epoch), so an interrupted epoch can restart at any batch
+class ResumableSampler(Sampler):
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        # start = number of samples of this epoch already consumed
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+# Batched Resize + ToTensor for the uint8 batches of a raw FacePairsDataset, float batches pass through
+def prepare_batch(images, size):
+    if images.dtype != torch.uint8:
+        return images
+    images = images.float().div_(255)
+    if tuple(images.shape[-2:]) != (size, size):
+        images = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+    return images
 
 def get_data_loaders():
     face_dir = os.path.join(DATA_ROOT, "faces")
     list_dir = os.path.join(DATA_ROOT, "lists")
 
-    transform = transforms.Compose([
-        transforms.Resize((256, 256)),
-        transforms.ToTensor()
-    ])
-
-    pairs = load_all_pairs(list_dir)
+    names, pairs = load_pair_index(list_dir)
+    face_store = build_face_store(names, face_dir, os.path.join(DATA_ROOT, "face_store"))
+    face_cache = build_resized_cache(names, face_store, os.path.join(DATA_ROOT, "face_cache"), sizes=(256,))
     split_idx = int(0.9 * len(pairs))
     train_pairs = pairs[:split_idx]
     val_pairs = pairs[split_idx:]
 
-    train_dataset = FacePairsDataset(train_pairs, face_dir, transform=transform)
-    val_dataset = FacePairsDataset(val_pairs, face_dir, transform=transform)
+    train_dataset = ShardedFacePairsDataset(train_pairs, names, face_cache, 256)
+    val_dataset = ShardedFacePairsDataset(val_pairs, names, face_cache, 256)
 
-    train_loader = DataLoader(train_dataset, batch_size=128, shuffle=True, num_workers=8, pin_memory=True)
+    train_loader = DataLoader(train_dataset, batch_size=128, sampler=ResumableSampler(train_dataset), num_workers=8, pin_memory=True, generator=torch.Generator())
     val_loader = DataLoader(val_dataset, batch_size=128, shuffle=False, num_workers=8, pin_memory=True)
 
     return train_loader, val_loader, train_dataset, val_dataset
 
+# Pretrained backbones come from a local registry in WEIGHTS_DIR: one flat state-dict file per backbone,
+# sha256-checked against registry.json and memory-mapped on load. A missing entry is fetched once from
+# PRETRAINED_SOURCES, which needs network, so populate the registry on such a machine first.
+PRETRAINED_SOURCES = {
+    "resnet18": lambda: models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1),
+}
+_verified_weights = set()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_weight_registry(weights_dir):
+    registry_path = os.path.join(weights_dir, "registry.json")
+    if not os.path.exists(registry_path):
+        return {}
+    with open(registry_path, 'r') as f:
+        return json.load(f)
+
+def register_weights(name, state_dict, weights_dir=None):
+    weights_dir = weights_dir or WEIGHTS_DIR
+    os.makedirs(weights_dir, exist_ok=True)
+    path = os.path.join(weights_dir, f"{name}.pt")
+    torch.save({key: value.detach().cpu().contiguous() for key, value in state_dict.items()}, path)
+
+    registry = read_weight_registry(weights_dir)
+    registry[name] = {"file": f"{name}.pt", "sha256": file_sha256(path), "bytes": os.path.getsize(path)}
+    with open(os.path.join(weights_dir, "registry.json"), 'w') as f:
+        json.dump(registry, f, indent=2)
+    print(f"Registered pretrained weights {name} → {path}")
+
+def pretrained_state(name, weights_dir=None):
+    weights_dir = weights_dir or WEIGHTS_DIR
+    registry = read_weight_registry(weights_dir)
+    if name not in registry:
+        register_weights(name, PRETRAINED_SOURCES[name]().state_dict(), weights_dir)
+        registry = read_weight_registry(weights_dir)
+
+    entry = registry[name]
+    path = os.path.join(weights_dir, entry["file"])
+    stat = os.stat(path)
+    # Hash once per file version and process, later loads are plain page-cache reads
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _verified_weights:
+        if file_sha256(path) != entry["sha256"]:
+            raise ValueError(f"Pretrained weights {name} do not match the registry hash: {path}")
+        _verified_weights.add(key)
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
 # Hybrid CORnet Model Design
 class HybridCORnetEmbedding(nn.Module):
     def __init__(self, pretrained=True):
         super().__init__()
         # Use Resnet18 as the backbone
-        self.resnet = models.resnet18(pretrained=pretrained)
+        self.resnet = models.resnet18()
+        if pretrained:
+            self.resnet.load_state_dict(pretrained_state("resnet18"))
 
         # Use the 002 model (1 V1, 1 V2, 1 V4, 2 IT)
         self.v2_time = 0
@@ -162,8 +453,28 @@ class HybridCORnetEmbedding(nn.Module):
         # Pooling
         self.pool = nn.AdaptiveAvgPool2d((1, 1))
         self.flatten = nn.Flatten()
+        # Early exit: exit_tol halts a region's recurrence per sample once its relative state change drops below it,
+        # max_steps caps every region's time; steps_used holds the time each sample used per region (last forward)
+        self.exit_tol = None
+        self.max_steps = None
+        self.steps_used = {}
+
+    def run_recurrent(self, region, x, time):
+        block = getattr(self, f'{region}_recurrent')
+        if self.max_steps is not None:
+            time = min(time, self.max_steps)
+        if time <= 1:
+            return x
+        if self.exit_tol is None:
+            return run_corblock(block, x, time - 1)
+        if self.training:
+            raise ValueError("Early exit is inference-only (BatchNorm must use running stats), call model.eval() first")
+        x, steps = corblock_adaptive(block, x, self.exit_tol, time - 1)
+        self.steps_used[region] = steps + 1
+        return x
 
     def forward(self, x):
+        self.steps_used = {}
         # V1: conv1 + bn1 + relu + maxpool
         x = self.resnet.conv1(x)
         x = self.resnet.bn1(x)
@@ -180,7 +491,7 @@ class HybridCORnetEmbedding(nn.Module):
         x = self.resnet.layer3(x3)
         x = self.resnet.layer4(x)
         if self.it_time > 1:
-            x = self.IT_recurrent(x)
+            x = self.run_recurrent('IT', x, self.it_time)
 
         side1_feat = self.side1(x1)
         side2_feat = self.side2(x2)
@@ -205,19 +516,184 @@ class HybridCORnetEmbedding(nn.Module):
 
 # Siamese
 class SiameseHybridCORnet(nn.Module):
-    def __init__(self, pretrained=True):
+    def __init__(self, pretrained=True, input_size=256, single_pass=False):
         super().__init__()
+        self.input_size = input_size
+        # single_pass = True embeds x1 and x2 as one 2B batch (one backbone call per step).
+        # In train mode BatchNorm then normalises with the joint statistics of both branches and
+        # updates its running stats once per step instead of once per branch; eval mode is unchanged.
+        self.single_pass = single_pass
         self.embedding_net = HybridCORnetEmbedding(pretrained=pretrained)
 
+    def forward_once(self, x):
+        return self.embedding_net(prepare_batch(x, self.input_size))
+
     def forward(self, x1, x2):
+        x1 = prepare_batch(x1, self.input_size)
+        x2 = prepare_batch(x2, self.input_size)
+        if self.single_pass:
+            f = self.embedding_net(torch.cat([x1, x2]))
+            return f[:x1.size(0)], f[x1.size(0):]
         f1 = self.embedding_net(x1)
         f2 = self.embedding_net(x2)
         return f1, f2
 
+# Iteration t of CORblock_S.forward on the state x (x is conv_input(inp) for t = 0)
+def corblock_step(block, x, t):
+    if isinstance(block, FoldedCORblock):
+        return block.step(x, t)
+    if t == 0:
+        skip = block.norm_skip(block.skip(x))
+        block.conv2.stride = (2, 2)
+    else:
+        skip = x
+        block.conv2.stride = (1, 1)
+    x = block.conv1(x)
+    x = getattr(block, f'norm1_{t}')(x)
+    x = block.nonlin1(x)
+    x = block.conv2(x)
+    x = getattr(block, f'norm2_{t}')(x)
+    x = block.nonlin2(x)
+    x = block.conv3(x)
+    x = getattr(block, f'norm3_{t}')(x)
+    x += skip
+    return block.nonlin3(x)
+
+# CORblock_S.forward unrolled as a generator, yielding the block state after every recurrent iteration
+def corblock_steps(block, inp):
+    x = block.conv_input(inp)
+    for t in range(block.times):
+        x = corblock_step(block, x, t)
+        yield block.output(x)
+
+# Output of `block` after only its first `steps` recurrent iterations (truncated unroll of a longer block)
+def run_corblock(block, x, steps):
+    if steps >= block.times:
+        return block(x)
+    for _, out in zip(range(steps), corblock_steps(block, x)):
+        pass
+    return out
+
+# Truncated BPTT over the first `steps` iterations of `block`: the state is detached right before the last k
+# iterations, so backward runs through those k only. In CORblock_S the input enters at step 0, so a truncated
+# block passes no gradient to conv_input or to the layers below it.
+# straight_through = True keeps step 0 in the graph as well (k + 1 iterations) and passes the gradient from the
+# detached state to step 0 as identity, so the layers below still learn; the skipped iterations get no gradient
+def run_corblock_truncated(block, x, steps, k, straight_through=False):
+    if steps <= (k + 1 if straight_through else k):
+        return run_corblock(block, x, steps)
+    if straight_through:
+        h0 = corblock_step(block, block.conv_input(x), 0)
+        h = h0.detach()
+        start = 1
+    else:
+        h = block.conv_input(x)
+        start = 0
+    with torch.no_grad():
+        for t in range(start, steps - k):
+            h = corblock_step(block, h, t)
+    if straight_through:
+        h = h + (h0 - h0.detach())
+    for t in range(steps - k, steps):
+        h = corblock_step(block, h, t)
+    return block.output(h)
+
+# Early exit (inference only): at most max_steps iterations of `block`, a sample halts once the relative change
+# of its state between two iterations falls below tol. Halted samples leave the batch, so later iterations only
+# run on the samples still changing. Returns the output and the iterations used per sample
+def corblock_adaptive(block, inp, tol, max_steps):
+    x = corblock_step(block, block.conv_input(inp), 0)
+    steps = torch.ones(x.size(0), dtype=torch.long, device=x.device)
+    active = torch.arange(x.size(0), device=x.device)
+    for t in range(1, min(max_steps, block.times)):
+        h = x[active]
+        new = corblock_step(block, h, t)
+        change = (new - h).float().flatten(1).norm(dim=1) / h.float().flatten(1).norm(dim=1).clamp_min(1e-12)
+        x = x.index_copy(0, active, new)
+        steps[active] += 1
+        active = active[change >= tol]
+        if active.numel() == 0:
+            break
+    return block.output(x), steps
+
+# CORblock_S for inference with its conv -> BatchNorm pairs folded. The block reuses conv1-3 on every iteration with
+# per-iteration norms, so every iteration gets its own folded copy (conv2 with the stride of that iteration)
+class FoldedCORblock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.times = block.times
+        self.conv_input = block.conv_input
+        self.skip = torch.nn.utils.fuse_conv_bn_eval(block.skip, block.norm_skip)
+        self.nonlin1, self.nonlin2, self.nonlin3 = block.nonlin1, block.nonlin2, block.nonlin3
+        self.output = block.output
+        for t in range(block.times):
+            for i in (1, 2, 3):
+                setattr(self, f'conv{i}_{t}', torch.nn.utils.fuse_conv_bn_eval(getattr(block, f'conv{i}'), getattr(block, f'norm{i}_{t}')))
+            getattr(self, f'conv2_{t}').stride = (2, 2) if t == 0 else (1, 1)
+
+    def step(self, x, t):
+        skip = self.skip(x) if t == 0 else x
+        x = self.nonlin1(getattr(self, f'conv1_{t}')(x))
+        x = self.nonlin2(getattr(self, f'conv2_{t}')(x))
+        x = getattr(self, f'conv3_{t}')(x)
+        x += skip
+        return self.nonlin3(x)
+
+    def forward(self, inp):
+        for out in corblock_steps(self, inp):
+            pass
+        return out
+
+# Recompute context of a checkpointed segment: the BatchNorm running stats of its modules are restored after the
+# recomputation in backward, so they are updated once per training step as without checkpointing
+@contextlib.contextmanager
+def restore_bn_stats(modules):
+    buffers = [buf for module in modules for buf in module.buffers()]
+    saved = [buf.clone() for buf in buffers]
+    try:
+        yield
+    finally:
+        # Also runs when the recomputation stops early, once the tensors backward needs are recomputed
+        with torch.no_grad():
+            for buf, value in zip(buffers, saved):
+                buf.copy_(value)
+
+# Activation checkpointing: only the input of fn is kept, its activations are recomputed during backward
+def checkpoint_segment(fn, x, *modules):
+    modules = [module for module in modules if module is not None]
+    return torch.utils.checkpoint.checkpoint(fn, x, use_reentrant=False,
+                                             context_fn=lambda: (contextlib.nullcontext(), restore_bn_stats(modules)))
+
+# First `steps` iterations of `block` as checkpointed segments of `every` iterations each
+def run_corblock_checkpointed(block, x, steps, every):
+    for start in range(0, steps, every):
+        def segment(h, start=start):
+            if start == 0:
+                h = block.conv_input(h)
+            for t in range(start, min(start + every, steps)):
+                h = corblock_step(block, h, t)
+            return h
+        x = checkpoint_segment(segment, x, block)
+    return block.output(x)
+
+# Run fn once per group of equally shaped states (stacked along the batch), outputs in input order
+def apply_stacked(fn, states):
+    groups = {}
+    for i, state in enumerate(states):
+        groups.setdefault(tuple(state.shape), []).append(i)
+    outputs = [None] * len(states)
+    for idx in groups.values():
+        out = fn(torch.cat([states[i] for i in idx]))
+        for i, chunk in zip(idx, out.chunk(len(idx))):
+            outputs[i] = chunk
+    return outputs
+
 class PretrainedCORnetEmbedding(nn.Module):
     def __init__(self, times_dict, pretrained=True):
         super().__init__()
-        self.resnet = models.resnet18(pretrained=pretrained)
+        self.resnet = models.resnet18()
+        if pretrained:
+            self.resnet.load_state_dict(pretrained_state("resnet18"))
 
         def get_times(region): return times_dict.get(region, 2)
         self.v2_time = get_times('V2')
@@ -239,8 +715,66 @@ class PretrainedCORnetEmbedding(nn.Module):
         # Resnet Pooling
         self.pool = nn.AdaptiveAvgPool2d((1, 1))
         self.flatten = nn.Flatten()
+        # Supernet mode: a {"V2", "V4", "IT"} times dict that truncates each region's unroll at that time
+        # (never beyond the configured one); None runs the full configured unroll
+        self.active_times = None
+        # Early exit: exit_tol halts a region's recurrence per sample once its relative state change drops below it,
+        # max_steps caps every region's time; steps_used holds the time each sample used per region (last forward)
+        self.exit_tol = None
+        self.max_steps = None
+        self.steps_used = {}
+        # Activation checkpointing while training: {region: "region" | k}. "region" recomputes the region's ResNet
+        # layers and whole unroll as one segment, k checkpoints the layers and then every k recurrent steps
+        self.activation_checkpoints = {}
+        # Truncated BPTT while training: {region: k} backpropagates through the last k recurrent iterations only
+        # (regions trained this way skip step-level checkpointing, their backward is already bounded)
+        self.bptt_steps = {}
+        # bptt_straight_through = True also keeps the gradient path to the region input (see run_corblock_truncated)
+        self.bptt_straight_through = False
+
+    def region_time(self, region, configured):
+        time = configured if self.active_times is None else min(self.active_times.get(region, 2), configured)
+        return time if self.max_steps is None else min(time, self.max_steps)
+
+    def run_recurrent(self, region, x, time):
+        block = getattr(self, f'{region}_recurrent')
+        if self.exit_tol is None:
+            k = self.bptt_steps.get(region) if self.training and torch.is_grad_enabled() else None
+            if k:
+                return run_corblock_truncated(block, x, time - 1, k, self.bptt_straight_through)
+            return run_corblock(block, x, time - 1)
+        if self.training:
+            raise ValueError("Early exit is inference-only (BatchNorm must use running stats), call model.eval() first")
+        x, steps = corblock_adaptive(block, x, self.exit_tol, time - 1)
+        self.steps_used[region] = steps + 1
+        return x
+
+    def run_region(self, region, layers, x, time):
+        block = getattr(self, f'{region}_recurrent') if time > 1 else None
+        segment = self.activation_checkpoints.get(region) if self.training and torch.is_grad_enabled() else None
+
+        def run_layers(h):
+            for layer in layers:
+                h = layer(h)
+            return h
+
+        def run(h):
+            h = run_layers(h)
+            return self.run_recurrent(region, h, time) if block is not None else h
+
+        if segment is None:
+            return run(x)
+        if segment == "region":
+            return checkpoint_segment(run, x, *layers, block)
+        x = checkpoint_segment(run_layers, x, *layers)
+        if block is None:
+            return x
+        if self.bptt_steps.get(region):
+            return self.run_recurrent(region, x, time)
+        return run_corblock_checkpointed(block, x, time - 1, segment)
 
     def forward(self, x):
+        self.steps_used = {}
         # V1: conv1 + bn1 + relu + maxpool
         x = self.resnet.conv1(x)
         x = self.resnet.bn1(x)
@@ -248,29 +782,55 @@ class PretrainedCORnetEmbedding(nn.Module):
         x = self.resnet.maxpool(x)
 
         # V2: layer1 (BasicBlock x2)
-        x = self.resnet.layer1(x)
-        if self.v2_time > 1:
-            x = self.V2_recurrent(x)
+        x = self.run_region('V2', [self.resnet.layer1], x, self.region_time('V2', self.v2_time))
 
         # V4: layer2 (BasicBlock x2)
-        x = self.resnet.layer2(x)
-        if self.v4_time > 1:
-            x = self.V4_recurrent(x)
+        x = self.run_region('V4', [self.resnet.layer2], x, self.region_time('V4', self.v4_time))
 
         # IT: layer3 (BasicBlock x2) + layer4 (BasicBlock x2)
-        x = self.resnet.layer3(x)
-        x = self.resnet.layer4(x)
-        if self.it_time > 1:
-            x = self.IT_recurrent(x)
+        x = self.run_region('IT', [self.resnet.layer3, self.resnet.layer4], x, self.region_time('IT', self.it_time))
 
         x = self.pool(x)
         x = self.flatten(x)
 
         return x
 
+    def forward_anytime(self, x, region='IT'):
+        # Embedding after every recurrent step of `region` in one unrolled pass: [region time, B, D], where
+        # index 0 skips the recurrence and the last index equals forward(x). Earlier regions run once at their
+        # configured depth, later regions run once on all step states together
+        stages = [
+            ('V2', [self.resnet.layer1], getattr(self, 'V2_recurrent', None)),
+            ('V4', [self.resnet.layer2], getattr(self, 'V4_recurrent', None)),
+            ('IT', [self.resnet.layer3, self.resnet.layer4], getattr(self, 'IT_recurrent', None))
+        ]
+        x = self.resnet.maxpool(self.resnet.relu(self.resnet.bn1(self.resnet.conv1(x))))
+        states = None
+        for name, layers, block in stages:
+            def run(h, layers=layers, block=block):
+                for layer in layers:
+                    h = layer(h)
+                return block(h) if block is not None else h
+
+            if states is not None:
+                states = apply_stacked(run, states)
+            elif name == region:
+                for layer in layers:
+                    x = layer(x)
+                states = [x] + (list(corblock_steps(block, x)) if block is not None else [])
+            else:
+                x = run(x)
+
+        return torch.stack(apply_stacked(lambda h: self.flatten(self.pool(h)), states))
+
 class SiamesePretrainedCORnet(nn.Module):
-    def __init__(self, times_dict, pretrained=True, freeze_backbone=False):
+    def __init__(self, times_dict, pretrained=True, freeze_backbone=False, input_size=256, single_pass=False):
         super().__init__()
+        self.input_size = input_size
+        # single_pass = True embeds x1 and x2 as one 2B batch (one backbone call per step).
+        # In train mode BatchNorm then normalises with the joint statistics of both branches and
+        # updates its running stats once per step instead of once per branch; eval mode is unchanged.
+        self.single_pass = single_pass
         self.embedding_net = PretrainedCORnetEmbedding(times_dict, pretrained=pretrained)
 
         if freeze_backbone:
@@ -289,11 +849,216 @@ class SiamesePretrainedCORnet(nn.Module):
                 for param in self.embedding_net.IT_recurrent.parameters():
                     param.requires_grad = True
 
+    def forward_once(self, x):
+        return self.embedding_net(prepare_batch(x, self.input_size))
+
     def forward(self, x1, x2):
+        x1 = prepare_batch(x1, self.input_size)
+        x2 = prepare_batch(x2, self.input_size)
+        if self.single_pass:
+            f = self.embedding_net(torch.cat([x1, x2]))
+            return f[:x1.size(0)], f[x1.size(0):]
         f1 = self.embedding_net(x1)
         f2 = self.embedding_net(x2)
         return f1, f2
 
+    def forward_anytime(self, x1, x2, region='IT'):
+        if not hasattr(self.embedding_net, 'forward_anytime'):
+            raise ValueError("forward_anytime needs the fp32 model: the int8 embedding_net (quantize_structure) is a traced graph of the configured unroll only")
+        x = torch.cat([prepare_batch(x1, self.input_size), prepare_batch(x2, self.input_size)])
+        f = self.embedding_net.forward_anytime(x, region)
+        return f[:, :x1.size(0)], f[:, x1.size(0):]
+
+# Build a model straight from a checkpoint: parameters are created on the meta device (no ImageNet copy,
+# no random init of the CORblocks) and the memory-mapped checkpoint tensors are assigned in their place
+def load_checkpoint_model(build, checkpoint_path, device):
+    with torch.device('meta'):
+        model = build()
+    state_dict = torch.load(checkpoint_path, map_location='cpu', mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    return model.to(device)
+
+# Fold every Conv2d -> BatchNorm2d pair of an eval-mode module into the conv, in place (the BatchNorm becomes
+# Identity): consecutive children of nn.Sequential, conv<i> / bn<i> of torchvision ResNet blocks and every CORblock_S
+# (replaced by a FoldedCORblock). Returns the number of folded pairs
+def fold_conv_bn(module):
+    folded = 0
+    for name, child in list(module.named_children()):
+        if isinstance(child, CORblock_S):
+            setattr(module, name, FoldedCORblock(child))
+            folded += 1 + 3 * child.times
+        else:
+            folded += fold_conv_bn(child)
+    names = list(module._modules)
+    pairs = list(zip(names, names[1:])) if isinstance(module, nn.Sequential) else []
+    if isinstance(module, (models.ResNet, models.resnet.BasicBlock, models.resnet.Bottleneck)):
+        pairs += [(f'conv{i}', f'bn{i}') for i in (1, 2, 3)]
+    for conv_name, bn_name in pairs:
+        conv, bn = module._modules.get(conv_name), module._modules.get(bn_name)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, conv_name, torch.nn.utils.fuse_conv_bn_eval(conv, bn))
+            setattr(module, bn_name, nn.Identity())
+            folded += 1
+    return folded
+
+# Largest difference of the embeddings and of the pair distances of two Siamese models on the same image pairs
+def inference_equivalence(reference, model, x1, x2):
+    with torch.no_grad():
+        r1, r2 = reference(x1, x2)
+        f1, f2 = model(x1, x2)
+    return {
+        'max_embedding_diff': max((r1 - f1).abs().max().item(), (r2 - f2).abs().max().item()),
+        'max_distance_diff': (F.pairwise_distance(r1, r2) - F.pairwise_distance(f1, f2)).abs().max().item()
+    }
+
+# Inference export of a Siamese model: an eval-mode copy with the conv -> BatchNorm pairs folded, the weights in
+# channels_last (the convolutions then keep their activations channels_last) and no parameter gradients. The copy is
+# checked against the model on example = (x1, x2), random images by default, and a pair distance that moves by more
+# than atol raises ValueError. Returns the copy and the check
+def freeze_for_inference(model, example=None, atol=1e-4):
+    training = model.training
+    model.eval()
+    frozen = copy.deepcopy(model)
+    folded = fold_conv_bn(frozen)
+    frozen = frozen.to(memory_format=torch.channels_last).requires_grad_(False)
+    if example is None:
+        device = next(model.parameters()).device
+        generator = torch.Generator().manual_seed(0)
+        example = [torch.rand(4, 3, model.input_size, model.input_size, generator=generator).to(device) for _ in range(2)]
+    check = dict(inference_equivalence(model, frozen, *example), folded_pairs=folded)
+    model.train(training)
+    if check['max_distance_diff'] > atol:
+        raise ValueError(f"Folded model differs from the original: max pair distance difference {check['max_distance_diff']:.2e}")
+    return frozen, check
+
+# int8 artifact of a checkpoint (quantize_model), stored next to it
+def quantized_path(checkpoint_path):
+    return os.path.splitext(checkpoint_path)[0] + "_int8.pt"
+
+# Int8 version of a frozen model (freeze_for_inference): its embedding_net is traced with torch.fx and quantized
+# statically, with the activation ranges observed by calibrate(prepared); nn.Linear layers are quantized dynamically
+# (int8 weights, activation range per batch). Quantized kernels run on the CPU only. The traced embedding_net runs
+# the configured unroll only: forward_anytime and early exit (exit_tol) need the fp32 model
+def quantize_structure(frozen, calibrate=None):
+    quantized = copy.deepcopy(frozen).cpu()
+    # Linear layers (also when fused with a following ReLU) stay float in the traced graph for quantize_dynamic
+    qconfig_mapping = get_default_qconfig_mapping('x86')
+    for name, module in quantized.embedding_net.named_modules():
+        if isinstance(module, nn.Linear):
+            qconfig_mapping.set_module_name(name, None)
+    example = torch.rand(1, 3, frozen.input_size, frozen.input_size)
+    prepared = prepare_fx(quantized.embedding_net, qconfig_mapping, (example,))
+    if calibrate is not None:
+        with torch.no_grad():
+            calibrate(prepared)
+    quantized.embedding_net = convert_fx(prepared)
+    return quantize_dynamic(quantized, {nn.Linear, torch.ao.nn.intrinsic.LinearReLU}, dtype=torch.qint8)
+
+# The artifact is the int8 state dict: the quantized structure is rebuilt (uncalibrated) from `build` created on the
+# meta device and materialised as zeros on the CPU, so no pretrained copy, init or equivalence check runs for values
+# that the quantized weights, scales and zero points of the artifact then replace
+def load_quantized_model(build, path):
+    with torch.device('meta'):
+        structure = build()
+    structure = structure.to_empty(device='cpu').eval().requires_grad_(False)
+    with torch.no_grad():
+        for tensor in list(structure.parameters()) + list(structure.buffers()):
+            tensor.zero_()
+    fold_conv_bn(structure)
+    model = quantize_structure(structure)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    return model.eval()
+
+# Post-training int8 quantization for CPU pair scoring (quantize_structure), calibrated on calibration_images faces
+# sampled from `dataset` (the validation pairs). Saves the int8 state dict to save_path and a report of the
+# pair-distance drift and verification-accuracy change against the fp32 model on all pairs of `dataset` to
+# <save_path>_report.json. Returns the int8 model and the report
+def quantize_model(model, dataset, save_path, calibration_images=256, batch_size=32, threshold=0.5):
+    reference = freeze_for_inference(model)[0].cpu()
+    faces = UniqueFacesDataset(dataset)
+    sample = np.random.RandomState(0).permutation(len(faces))[:calibration_images]
+    loader = DataLoader(torch.utils.data.Subset(faces, sample), batch_size=batch_size, shuffle=False, num_workers=4)
+
+    def calibrate(prepared):
+        for images in loader:
+            prepared(prepare_batch(images, model.input_size))
+
+    quantized = quantize_structure(reference, calibrate)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    torch.save(quantized.state_dict(), save_path)
+
+    report = {'calibration_images': len(sample)}
+    results = {}
+    for name, m in (('fp32', reference), ('int8', quantized)):
+        start = time.time()
+        results[name] = evaluate_pairs(m, dataset, torch.device('cpu'), threshold=threshold, batch_size=batch_size)
+        report[f'{name}_accuracy'] = results[name]['accuracy']
+        report[f'{name}_eval_sec'] = time.time() - start
+        report[f'{name}_mb'] = model_nbytes(m) / 1024 ** 2
+    drift = (results['int8']['distances'] - results['fp32']['distances']).abs()
+    flips = (results['int8']['distances'] < threshold) != (results['fp32']['distances'] < threshold)
+    report.update({
+        'num_pairs': results['fp32']['num_pairs'],
+        'accuracy_change': report['int8_accuracy'] - report['fp32_accuracy'],
+        'mean_distance_drift': drift.mean().item(),
+        'max_distance_drift': drift.max().item(),
+        'decision_flips': int(flips.sum())
+    })
+
+    report_path = os.path.splitext(save_path)[0] + "_report.json"
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"int8 model saved to {save_path} | accuracy {report['fp32_accuracy']:.5f} -> {report['int8_accuracy']:.5f}, "
+          f"mean distance drift {report['mean_distance_drift']:.4f}, {report['fp32_mb']:.1f} -> {report['int8_mb']:.1f} MB")
+    return quantized, report
+
+# Process-wide LRU cache of built models, shared by the prediction, saliency and comparison functions, which only
+# run them forward: the cached models are frozen for inference (freeze_for_inference). Keyed by (architecture, times_dict, checkpoint path, checkpoint mtime, device); least recently used
+# models are dropped once the cached parameters and buffers exceed MODEL_CACHE_BYTES
+MODEL_CACHE_BYTES = 4 * 1024 ** 3
+_model_cache = OrderedDict()
+
+# From the state dict: quantized modules keep their (packed) weights outside parameters()
+def model_nbytes(model):
+    values = [v for value in model.state_dict().values() for v in (value if isinstance(value, tuple) else (value,))]
+    return sum(t.numel() * t.element_size() for t in values if isinstance(t, torch.Tensor))
+
+def cached_model(arch, times_dict, checkpoint_path, device, build, quantized=False):
+    # checkpoint_path = None caches the freshly initialised model from `build`. quantized = True takes the int8
+    # artifact of the checkpoint (quantize_model) instead; int8 kernels run on the CPU only, and a checkpoint
+    # without an artifact is loaded in fp32 with a warning
+    quantized = quantized and checkpoint_path is not None
+    if quantized and torch.device(device).type != 'cpu':
+        raise ValueError(f"{arch}: int8 models run on the CPU only, got device {device}")
+    missing_int8 = None
+    if quantized and not os.path.exists(quantized_path(checkpoint_path)):
+        missing_int8, quantized = quantized_path(checkpoint_path), False
+    if quantized:
+        checkpoint_path = quantized_path(checkpoint_path)
+    mtime = os.path.getmtime(checkpoint_path) if checkpoint_path else None
+    times_key = tuple(sorted(times_dict.items())) if times_dict else None
+    key = (arch, times_key, checkpoint_path, mtime, str(device))
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        return _model_cache[key]
+
+    if missing_int8:
+        print(f"Warning: {arch}: int8 model {missing_int8} not found, using the fp32 checkpoint")
+    if quantized:
+        model = load_quantized_model(build, checkpoint_path)
+        print(f"{arch}: int8 model {checkpoint_path}")
+    else:
+        if checkpoint_path:
+            model = load_checkpoint_model(build, checkpoint_path, device)
+        else:
+            model = build().to(device)
+        model, check = freeze_for_inference(model)
+        print(f"{arch} frozen for inference: {check['folded_pairs']} conv-BN pairs folded, max distance difference {check['max_distance_diff']:.2e}")
+    _model_cache[key] = model
+    while len(_model_cache) > 1 and sum(model_nbytes(m) for m in _model_cache.values()) > MODEL_CACHE_BYTES:
+        _model_cache.popitem(last=False)
+    return model
+
 class ContrastiveLoss(nn.Module):
     def __init__(self, margin=1.0):
         super(ContrastiveLoss, self).__init__()
@@ -305,20 +1070,137 @@ class ContrastiveLoss(nn.Module):
                (1 - label) * torch.pow(torch.clamp(self.margin - euclidean_distance, min=0.0), 2)
         return loss.mean()
 
-def compute_accuracy(out1, out2, labels, threshold=0.5):
+# Running loss / accuracy kept as device tensors, read back once per epoch instead of with .item() every batch
+class MetricsAccumulator:
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = 0.0
+        self.correct = 0.0
+        self.count = 0
+
+    def update(self, out1, out2, labels, loss):
+        with torch.no_grad():
+            distances = F.pairwise_distance(out1.float(), out2.float())
+            preds = (distances < self.threshold).float()
+            self.correct = self.correct + (preds == labels).float().sum()
+            # Batch means are weighted by batch size, so a short last batch counts for what it holds
+            self.loss_sum = self.loss_sum + loss.detach().float() * labels.size(0)
+        self.count += labels.size(0)
+
+    def compute(self):
+        return float(self.loss_sum) / self.count, float(self.correct) / self.count
+
+# Mixed precision for the training loops: CUDA fp16 with a GradScaler, CPU bfloat16 where the CPU computes bf16
+# natively (AMX / AVX512-BF16), fp32 otherwise. bf16 keeps the fp32 exponent range, so off CUDA the scaler is a no-op
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'amx_bf16' in flags or 'avx512_bf16' in flags
+
+class MixedPrecision:
+    def __init__(self, device, enabled=True):
+        self.device_type = torch.device(device).type
+        if self.device_type == 'cuda':
+            self.dtype = torch.float16
+        elif self.device_type == 'cpu' and cpu_supports_bf16():
+            self.dtype = torch.bfloat16
+        else:
+            self.dtype = None
+        self.enabled = enabled and self.dtype is not None
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.enabled and self.dtype == torch.float16)
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def __repr__(self):
+        return f"MixedPrecision({self.device_type}, {self.dtype if self.enabled else 'fp32'})"
+
+# Exact resume: a training state holds model, optimizer, GradScaler, RNG and running metrics plus the position
+# (resume_epoch, resume_step = batches of that epoch already done). Train loaders draw their worker seeds from
+# their own generator, so restoring the global RNG reproduces the uninterrupted run from that step on
+RESUME_EVERY_STEPS = 200
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_training_state(path, model, optimizer, scaler, resume_epoch, resume_step, metrics=None, **extra):
+    state = {
+        'resume_epoch': resume_epoch,
+        'resume_step': resume_step,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scaler_state_dict': scaler.state_dict() if scaler is not None else None,
+        'rng_state': rng_state(),
+        'metrics': vars(metrics) if metrics is not None else None
+    }
+    state.update(extra)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_training_state(path, model, optimizer, scaler):
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if 'resume_epoch' not in checkpoint:
+        raise ValueError(f"Checkpoint has no resume state: {path}")
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if scaler is not None and checkpoint['scaler_state_dict'] is not None:
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
+    set_rng_state(checkpoint['rng_state'])
+    return checkpoint
+
+# Evaluation engine: embed each unique face of the split once, then score every pair from the embedding table
+def embed_faces(model, dataset, device, batch_size=64, num_workers=4):
+    faces = UniqueFacesDataset(dataset)
+    loader = DataLoader(faces, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for images in loader:
+            embeddings.append(model.forward_once(images.to(device)).float())
+    return faces.ids, torch.cat(embeddings)
+
+def evaluate_pairs(model, dataset, device, criterion=None, threshold=0.5, batch_size=64, num_workers=4):
+    ids, embeddings = embed_faces(model, dataset, device, batch_size, num_workers)
+    rows = torch.from_numpy(np.searchsorted(ids, dataset.pairs[:, :2])).long().to(embeddings.device)
+    labels = torch.from_numpy(dataset.pairs[:, 2]).float().to(embeddings.device)
+    out1, out2 = embeddings[rows[:, 0]], embeddings[rows[:, 1]]
     distances = F.pairwise_distance(out1, out2)
     preds = (distances < threshold).float()
-    correct = (preds == labels).float().sum()
-    accuracy = correct / labels.size(0)
-    return accuracy.item()
+    results = {
+        'accuracy': (preds == labels).float().mean().item(),
+        'distances': distances.cpu(),
+        'num_images': len(ids),
+        'num_pairs': len(labels)
+    }
+    if criterion is not None:
+        results['loss'] = criterion(out1, out2, labels).item()
+    return results
 
-def train_hybrid_model(num_epochs=10):
+def train_hybrid_model(num_epochs=10, single_pass=False):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     print(f"Using devices: {device}")
 
-    train_loader, val_loader, _, _ = get_data_loaders()
+    train_loader, _, _, val_dataset = get_data_loaders()
 
-    model = SiameseHybridCORnet(pretrained=True).to(device)
+    model = SiameseHybridCORnet(pretrained=True, single_pass=single_pass).to(device)
 
     total_params = sum(p.numel() for p in model.parameters())
     trainable_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -331,7 +1213,9 @@ def train_hybrid_model(num_epochs=10):
     criterion = ContrastiveLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
 
-    scaler = torch.cuda.amp.GradScaler()
+    amp = MixedPrecision(device)
+    scaler = amp.scaler
+    print(f"Precision: {amp}")
 
     train_losses, val_losses = [], []
     train_accuracies, val_accuracies = [], []
@@ -344,15 +1228,30 @@ def train_hybrid_model(num_epochs=10):
     best_val_acc = 0.0
     best_epoch = 0
 
-    for epoch in range(num_epochs):
+    # Resume point, replaced every RESUME_EVERY_STEPS steps and at the end of every epoch; removed once training ends
+    resume_path = os.path.join(hybrid_model_dir, "resume.pt")
+    history = {'train_losses': train_losses, 'val_losses': val_losses, 'train_accs': train_accuracies, 'val_accs': val_accuracies}
+    start_epoch, start_step, metrics_state = 0, 0, None
+    if os.path.exists(resume_path):
+        checkpoint = load_training_state(resume_path, model, optimizer, scaler)
+        for key, values in checkpoint['history'].items():
+            history[key].extend(values)
+        best_val_acc, best_epoch = checkpoint['best_val_acc'], checkpoint['best_epoch']
+        start_epoch, start_step, metrics_state = checkpoint['resume_epoch'], checkpoint['resume_step'], checkpoint['metrics']
+        print(f"Resuming at epoch {start_epoch+1}, step {start_step}")
+
+    for epoch in range(start_epoch, num_epochs):
         model.train()
-        running_loss = 0.0
-        running_acc = 0.0
+        metrics = MetricsAccumulator()
+        step = start_step if epoch == start_epoch else 0
+        if step > 0:
+            metrics.__dict__.update(metrics_state)
+        train_loader.sampler.set_epoch(epoch, step * train_loader.batch_size)
         for img1, img2, label in train_loader:
             img1, img2, label = img1.to(device), img2.to(device), label.to(device)
             optimizer.zero_grad()
 
-            with torch.cuda.amp.autocast():
+            with amp.autocast():
                 out1, out2 = model(img1, img2)
                 loss = criterion(out1, out2, label)
 
@@ -360,30 +1259,15 @@ def train_hybrid_model(num_epochs=10):
             scaler.step(optimizer)
             scaler.update()
 
-            acc = compute_accuracy(out1, out2, label)
-            running_loss += loss.item()
-            running_acc += acc
-
-        train_loss = running_loss / len(train_loader)
-        train_acc = running_acc / len(train_loader)
-
-        model.eval()
-        running_loss = 0.0
-        running_acc = 0.0
-        with torch.no_grad():
-            for img1, img2, label in val_loader:
-                img1, img2, label = img1.to(device), img2.to(device), label.to(device)
-
-                with torch.cuda.amp.autocast():
-                    out1, out2 = model(img1, img2)
-                    loss = criterion(out1, out2, label)
+            metrics.update(out1, out2, label, loss)
+            step += 1
+            if step % RESUME_EVERY_STEPS == 0:
+                save_training_state(resume_path, model, optimizer, scaler, epoch, step, metrics, history=history, best_val_acc=best_val_acc, best_epoch=best_epoch)
 
-                acc = compute_accuracy(out1, out2, label)
-                running_loss += loss.item()
-                running_acc += acc
+        train_loss, train_acc = metrics.compute()
 
-        val_loss = running_loss / len(val_loader)
-        val_acc = running_acc / len(val_loader)
+        val_results = evaluate_pairs(model, val_dataset, device, criterion, batch_size=128)
+        val_loss, val_acc = val_results['loss'], val_results['accuracy']
 
         train_losses.append(train_loss)
         val_losses.append(val_loss)
@@ -404,18 +1288,12 @@ def train_hybrid_model(num_epochs=10):
             json.dump(epoch_results, f, indent=2)
 
         if (epoch + 1) % 3 == 0 or epoch == num_epochs - 1 or val_acc > best_val_acc:
-            checkpoint = {
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-                'train_loss': train_loss,
-                'val_loss': val_loss,
-                'train_acc': train_acc,
-                'val_acc': val_acc
-            }
-
+            # Also a full resume point (load_training_state)
             checkpoint_path = os.path.join(hybrid_model_dir, f"checkpoint_epoch{epoch+1}.pt")
-            torch.save(checkpoint, checkpoint_path)
+            save_training_state(checkpoint_path, model, optimizer, scaler, epoch + 1, 0,
+                                epoch=epoch, train_loss=train_loss, val_loss=val_loss, train_acc=train_acc, val_acc=val_acc,
+                                history=history, best_val_acc=max(best_val_acc, val_acc),
+                                best_epoch=epoch + 1 if val_acc > best_val_acc else best_epoch)
             print(f"Check point saves: {checkpoint_path}")
 
             if val_acc > best_val_acc:
@@ -425,11 +1303,15 @@ def train_hybrid_model(num_epochs=10):
                 torch.save(model.state_dict(), best_model_path)
                 print(f"Find new best (Val acc: {val_acc:.5f}), saved as: {best_model_path}")
 
+        save_training_state(resume_path, model, optimizer, scaler, epoch + 1, 0, history=history, best_val_acc=best_val_acc, best_epoch=best_epoch)
+
     plot_training_curves(train_losses, val_losses, train_accuracies, val_accuracies, "hybrid")
 
     final_model_path = os.path.join(hybrid_model_dir, "hybrid_model.pt")
     torch.save(model.state_dict(), final_model_path)
     print(f"Final model is saved in: {final_model_path}")
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
 
     report = {
         "num_epochs": num_epochs,
@@ -553,8 +1435,10 @@ def plot_training_curves(train_losses, val_losses, train_accs, val_accs, model_n
     print(f"Training curve saved: {save_path}")
     plt.close()
 
-def predict_models_comparison(hybrid_model_path):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# quantized = True scores with the int8 models of the checkpoints (quantize_model) on the CPU; int8 models missing
+# for the standard CORnet checkpoints are written first, calibrated on calibration_dataset
+def predict_models_comparison(hybrid_model_path, quantized=False, calibration_dataset=None):
+    device = torch.device('cpu') if quantized else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     image_pairs = [
         ("/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/Part_Whole_Illusion.jpg",
@@ -598,9 +1482,8 @@ def predict_models_comparison(hybrid_model_path):
     def sort_key(name):
         return list(map(int, name.split("_")))
 
-    hybrid_model = SiameseHybridCORnet(pretrained=False).to(device)
     try:
-        hybrid_model.load_state_dict(torch.load(hybrid_model_path, map_location=device))
+        hybrid_model = cached_model("SiameseHybridCORnet", None, hybrid_model_path, device, lambda: SiameseHybridCORnet(pretrained=False), quantized)
         print(f"Loading Hybrid model successfully: {hybrid_model_path}")
     except Exception as e:
         print(f"Failed to load Hybrid model: {e}")
@@ -613,8 +1496,8 @@ def predict_models_comparison(hybrid_model_path):
         print(f"\nPredicting image pair: {name}")
 
         try:
-            img1 = transform(Image.open(img1_path).convert("RGB")).unsqueeze(0).to(device)
-            img2 = transform(Image.open(img2_path).convert("RGB")).unsqueeze(0).to(device)
+            img1 = transform(load_image(img1_path)).unsqueeze(0).to(device)
+            img2 = transform(load_image(img2_path)).unsqueeze(0).to(device)
 
             results = {
                 'standard': {"distances": [], "probs": []},
@@ -636,12 +1519,14 @@ def predict_models_comparison(hybrid_model_path):
             sorted_keys = sorted(time_settings.keys(), key=sort_key)
             for structure_name in sorted_keys:
                 times_dict = time_settings[structure_name]
-                model = SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False).to(device)
                 model_path = os.path.join(PREVIOUS_MODELS_PATH, f"pretrained_model_T{structure_name}.pt")
 
                 if os.path.exists(model_path):
                     try:
-                        model.load_state_dict(torch.load(model_path, map_location=device))
+                        build = lambda: SiamesePretrainedCORnet(times_dict, pretrained=False, freeze_backbone=False)
+                        if quantized and calibration_dataset is not None and not os.path.exists(quantized_path(model_path)):
+                            quantize_model(load_checkpoint_model(build, model_path, device), calibration_dataset, quantized_path(model_path))
+                        model = cached_model("SiamesePretrainedCORnet", times_dict, model_path, device, build, quantized)
                     except Exception as e:
                         print(f"Failed to load weights {structure_name}: {e}")
                         continue
@@ -734,10 +1619,10 @@ def generate_hybrid_saliency_maps(dataset, hybrid_model_path, top_percent=0.1, i
     save_dir = os.path.join(OUTPUT_DIR, "saliency/hybrid_model")
     os.makedirs(save_dir, exist_ok=True)
 
-    hybrid_model = SiameseHybridCORnet(pretrained=False).to(device)
+    hybrid_model = None
     if os.path.exists(hybrid_model_path):
         try:
-            hybrid_model.load_state_dict(torch.load(hybrid_model_path, map_location=device))
+            hybrid_model = cached_model("SiameseHybridCORnet", None, hybrid_model_path, device, lambda: SiameseHybridCORnet(pretrained=False))
             print(f"Loading Hybrid model successfully: {hybrid_model_path}")
         except Exception as e:
             print(f"Failed to load Hybrid model: {e}")
@@ -745,12 +1630,14 @@ def generate_hybrid_saliency_maps(dataset, hybrid_model_path, top_percent=0.1, i
     else:
         print(f"Cannot find model path: {hybrid_model_path}")
         print("Using initialized weights")
+    if hybrid_model is None:
+        hybrid_model = cached_model("SiameseHybridCORnet", None, None, device, lambda: SiameseHybridCORnet(pretrained=False))
 
     hybrid_model.eval()
 
     for i in range(num_images):
         img_tensor, _, _ = dataset[i]
-        img_tensor = img_tensor.unsqueeze(0).to(device).requires_grad_()
+        img_tensor = prepare_batch(img_tensor.unsqueeze(0).to(device), hybrid_model.input_size).requires_grad_()
 
         hybrid_model.zero_grad()
         out1, _ = hybrid_model(img_tensor, img_tensor)
@@ -820,9 +1707,16 @@ def main():
 
         print("Loading data")
         train_loader, val_loader, train_dataset, val_dataset = get_data_loaders()
+        # quantize_int8 = True writes the int8 models of the hybrid and standard checkpoints and scores the pairs with them (CPU)
+        # The int8 models have no anytime or early-exit path (forward_anytime, exit_tol), those need the fp32 checkpoints
+        quantize_int8 = False
+        if quantize_int8 and os.path.exists(hybrid_model_path):
+            model = load_checkpoint_model(lambda: SiameseHybridCORnet(pretrained=False), hybrid_model_path, torch.device('cpu'))
+            quantize_model(model, val_dataset, quantized_path(hybrid_model_path))
+
         print("\n[3/3] Genreralizing model performance result and saliency map")
         try:
-            predict_models_comparison(hybrid_model_path)
+            predict_models_comparison(hybrid_model_path, quantized=quantize_int8, calibration_dataset=val_dataset)
             print("Finished model predicion")
         except Exception as e:
             print(f"Error: {e}")
@@ -11,69 +11,299 @@ from google.colab import drive
 drive.mount('/content/drive')
 
 import os
+import re
+import hashlib
+import random
+import contextlib
 
 # Prepare to read the label
-def read_pairs(file_path, label):
-    with open(file_path, 'r') as f:
-        lines = f.readlines()
-    return [(line.strip().split()[0], line.strip().split()[1], label) for line in lines]
+# Pair index: int32 rows of (left id, right id, label, fold, split), ids point into `names`
+PAIR_SPLITS = ["train", "test"]
 
-def load_all_pairs(list_dir):
-    all_pairs = []
+def pair_list_files(list_dir):
+    files = []
     for i in range(1, 11):
         prefix = f"{i:02d}"
-        for split in ["train", "test"]:
-            same_file = os.path.join(list_dir, f"{prefix}_{split}_same.txt")
-            diff_file = os.path.join(list_dir, f"{prefix}_{split}_diff.txt")
-            all_pairs += read_pairs(same_file, 1)
-            all_pairs += read_pairs(diff_file, 0)
-    return all_pairs
-
-from torch.utils.data import Dataset, DataLoader
+        for split in PAIR_SPLITS:
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_same.txt"), 1, i, PAIR_SPLITS.index(split)))
+            files.append((os.path.join(list_dir, f"{prefix}_{split}_diff.txt"), 0, i, PAIR_SPLITS.index(split)))
+    return files
+
+def load_pair_index(list_dir, cache_dir=None):
+    files = pair_list_files(list_dir)
+    digest = hashlib.sha1()
+    for path, _, _, _ in files:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    key = digest.hexdigest()[:16]
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(list_dir), "pair_index")
+    names_path = os.path.join(cache_dir, f"names_{key}.npy")
+    pairs_path = os.path.join(cache_dir, f"pairs_{key}.npy")
+    if os.path.exists(names_path) and os.path.exists(pairs_path):
+        return np.load(names_path), np.load(pairs_path)
+
+    ids = {}
+    rows = []
+    for path, label, fold, split in files:
+        with open(path, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                left = ids.setdefault(fields[0], len(ids))
+                right = ids.setdefault(fields[1], len(ids))
+                rows.append((left, right, label, fold, split))
+
+    names = np.array(list(ids), dtype=str)
+    pairs = np.array(rows, dtype=np.int32).reshape(-1, 5)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(names_path, names)
+    np.save(pairs_path, pairs)
+    print(f"Pair index built: {len(pairs)} pairs, {len(names)} faces → {pairs_path}")
+    return names, pairs
+
+def select_pairs(pairs, fold=None, split=None, label=None):
+    mask = np.ones(len(pairs), dtype=bool)
+    if fold is not None:
+        mask &= pairs[:, 3] == fold
+    if split is not None:
+        mask &= pairs[:, 4] == PAIR_SPLITS.index(split)
+    if label is not None:
+        mask &= pairs[:, 2] == label
+    return pairs[mask]
+
+def dedupe_pairs(pairs):
+    # (a, b) and (b, a) with the same label count as one pair, first occurrence is kept
+    key = np.stack([pairs[:, :2].min(axis=1), pairs[:, :2].max(axis=1), pairs[:, 2]], axis=1)
+    _, first = np.unique(key, axis=0, return_index=True)
+    return pairs[np.sort(first)]
+
+from torch.utils.data import Dataset, DataLoader, Sampler
 from PIL import Image
 import torchvision.transforms as transforms
 import torch
+import numpy as np
+import json
+
+# LFWCrop faces are binary PPM (P6), so the pixel block can be mapped directly without PIL
+PPM_HEADER = re.compile(rb'P6(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)(?:\s|#[^\n]*\n)+(\d+)\s')
+
+def read_ppm(path):
+    with open(path, 'rb') as f:
+        header = PPM_HEADER.match(f.read(512))
+    if header is None or int(header.group(3)) > 255:
+        return None
+    width, height = int(header.group(1)), int(header.group(2))
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=header.end(), shape=(height, width, 3))
+
+def load_pixels(path):
+    # Other formats (e.g. the .jpg illusion stimuli) fall back to PIL
+    pixels = read_ppm(path) if path.lower().endswith(".ppm") else None
+    if pixels is None:
+        pixels = np.asarray(Image.open(path).convert("RGB"))
+    return pixels
+
+def load_image(path):
+    return Image.fromarray(np.asarray(load_pixels(path)))
+
+# Decode every face once into a memory-mapped uint8 store (faces.npy + name -> row index)
+def build_face_store(names, image_dir, store_dir):
+    names = [str(name) for name in names]
+    faces_path = os.path.join(store_dir, "faces.npy")
+    index_path = os.path.join(store_dir, "index.json")
+
+    if os.path.exists(faces_path) and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if all(name in index for name in names):
+            return faces_path, index
+
+    os.makedirs(store_dir, exist_ok=True)
+    first = np.asarray(load_image(os.path.join(image_dir, names[0] + ".ppm")))
+    faces = np.lib.format.open_memmap(faces_path, mode='w+', dtype=np.uint8, shape=(len(names),) + first.shape)
+    for row, name in enumerate(names):
+        faces[row] = np.asarray(load_image(os.path.join(image_dir, name + ".ppm")))
+    faces.flush()
+    del faces
+
+    # The index is written last, so an interrupted build is redone next time
+    index = {name: row for row, name in enumerate(names)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f"Face store built: {len(names)} faces → {faces_path}")
+    return faces_path, index
 
 class FacePairsDataset(Dataset):
-    def __init__(self, pairs, image_dir, transform=None):
+    def __init__(self, pairs, names, image_dir, transform=None, store=None, raw=False):
         self.pairs = pairs
+        self.names = names
         self.image_dir = image_dir
         self.transform = transform or transforms.ToTensor()
+        # store = (faces_path, index) from build_face_store, pairs are then served by row lookup
+        self.store = store
+        # raw = True skips the transform and returns uint8 CHW tensors for prepare_batch
+        self.raw = raw
+        self._faces = None
 
     def __len__(self):
         return len(self.pairs)
 
+    def _load(self, name):
+        if self.store is None:
+            pixels = load_pixels(os.path.join(self.image_dir, name + ".ppm"))
+        else:
+            if self._faces is None:
+                # Opened lazily so that every DataLoader worker maps the file on its own
+                self._faces = np.load(self.store[0], mmap_mode='r')
+            pixels = self._faces[self.store[1][name]]
+        if self.raw:
+            return torch.from_numpy(np.array(pixels)).permute(2, 0, 1)
+        return self.transform(Image.fromarray(np.asarray(pixels)))
+
     def __getitem__(self, idx):
-        name1, name2, label = self.pairs[idx]
-        name1 += ".ppm"
-        name2 += ".ppm"
-        img1 = Image.open(os.path.join(self.image_dir, name1)).convert("RGB")
-        img2 = Image.open(os.path.join(self.image_dir, name2)).convert("RGB")
-        return self.transform(img1), self.transform(img2), torch.tensor(label, dtype=torch.float32)
+        left, right, label = self.pairs[idx, :3]
+        img1 = self._load(str(self.names[left]))
+        img2 = self._load(str(self.names[right]))
+        return img1, img2, torch.tensor(label, dtype=torch.float32)
+
+# Resized uint8 faces per training resolution, written once as memory-mapped shards + manifest.json. Each script
+# builds only the size it trains at (sizes); another size is added to the same cache the first time it is asked for
+CACHE_SIZES = (64, 224, 256)
+
+def build_resized_cache(names, face_store, cache_dir, sizes=CACHE_SIZES, shard_size=4096):
+    names = [str(name) for name in names]
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {"names": names, "sizes": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            cached = json.load(f)
+        if cached["names"] == names:
+            manifest = cached
+
+    missing = [size for size in sizes if str(size) not in manifest["sizes"]]
+    if not missing:
+        return manifest_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    faces = np.load(face_store[0], mmap_mode='r')
+    # transforms.Resize on the decoded face, so cached pixels equal today's Resize + ToTensor output
+    resizers = {size: transforms.Resize((size, size)) for size in missing}
+    shards = {size: [] for size in missing}
+
+    for start in range(0, len(names), shard_size):
+        chunk = names[start:start + shard_size]
+        arrays = {}
+        for size in missing:
+            file_name = f"faces_{size}_{start // shard_size:03d}.npy"
+            arrays[size] = np.lib.format.open_memmap(os.path.join(cache_dir, file_name), mode='w+',
+                                                     dtype=np.uint8, shape=(len(chunk), 3, size, size))
+            shards[size].append({"file": file_name, "start": start, "count": len(chunk)})
+        for row, name in enumerate(chunk):
+            image = Image.fromarray(np.asarray(faces[face_store[1][name]]))
+            for size in missing:
+                arrays[size][row] = np.asarray(resizers[size](image)).transpose(2, 0, 1)
+        for array in arrays.values():
+            array.flush()
+
+    for size in missing:
+        manifest["sizes"][str(size)] = shards[size]
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    print(f"Face cache built for sizes {missing} → {cache_dir}")
+    return manifest_path
+
+class ShardedFacePairsDataset(Dataset):
+    def __init__(self, pairs, names, manifest_path, size, return_ids=False):
+        self.pairs = pairs
+        self.names = names
+        self.size = size
+        # return_ids = True also yields the two image ids, used by the Siamese wrappers to embed each face once per batch
+        self.return_ids = return_ids
+        self.cache_dir = os.path.dirname(manifest_path)
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        self.shards = manifest["sizes"][str(size)]
+        self.starts = np.array([shard["start"] for shard in self.shards])
+        cache_rows = {name: row for row, name in enumerate(manifest["names"])}
+        # image id (from the pair index) -> row in the cache
+        self.rows = np.array([cache_rows[str(name)] for name in names])
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def _load(self, image_id):
+        if self._arrays is None:
+            # Opened lazily so that every DataLoader worker maps the shards on its own
+            self._arrays = [np.load(os.path.join(self.cache_dir, shard["file"]), mmap_mode='r') for shard in self.shards]
+        row = self.rows[image_id]
+        shard = np.searchsorted(self.starts, row, side='right') - 1
+        return torch.from_numpy(np.array(self._arrays[shard][row - self.starts[shard]]))
+
+    def __getitem__(self, idx):
+        left, right, label = self.pairs[idx, :3]
+        if self.return_ids:
+            return self._load(left), self._load(right), torch.tensor(label, dtype=torch.float32), int(left), int(right)
+        return self._load(left), self._load(right), torch.tensor(label, dtype=torch.float32)
+
+# Every distinct face of a pair dataset once, in sorted id order (for per-image evaluation)
+class UniqueFacesDataset(Dataset):
+    def __init__(self, pair_dataset):
+        self.pair_dataset = pair_dataset
+        self.ids = np.unique(pair_dataset.pairs[:, :2])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, idx):
+        return self.pair_dataset._load(self.ids[idx])
+
+# Shuffling sampler whose order depends only on (seed, epoch), so an interrupted epoch can restart at any batch
+class ResumableSampler(Sampler):
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        # start = number of samples of this epoch already consumed
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(len(self.data_source), generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.start
 
 data_root = "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /First Experiment/LFWCrop_dataset_pytorch"
 face_dir = os.path.join(data_root, "faces")
 list_dir = os.path.join(data_root, "lists")
+weights_root = os.path.join(os.path.dirname(data_root), "pretrained_weights")
 print(face_dir)
 print(list_dir)
 
-pairs = load_all_pairs(list_dir)
+names, pairs = load_pair_index(list_dir)
+face_store = build_face_store(names, face_dir, os.path.join(data_root, "face_store"))
 
 split_idx = int(0.9 * len(pairs))
 train_pairs = pairs[:split_idx]
 val_pairs = pairs[split_idx:]
 
-# Transform --> change pic size!!!!!
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor()
-])
+# Input size --> change pic size!!!!! (faces are read pre-resized from face_cache)
+input_size = 224
+face_cache = build_resized_cache(names, face_store, os.path.join(data_root, "face_cache"), sizes=(input_size,))
 
 # Dataset and DataLoader
-train_dataset = FacePairsDataset(train_pairs, face_dir, transform=transform)
-val_dataset = FacePairsDataset(val_pairs, face_dir, transform=transform)
+train_dataset = ShardedFacePairsDataset(train_pairs, names, face_cache, input_size, return_ids=True)
+val_dataset = ShardedFacePairsDataset(val_pairs, names, face_cache, input_size)
 
-train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True, num_workers=4)
+train_loader = DataLoader(train_dataset, batch_size=64, sampler=ResumableSampler(train_dataset), num_workers=4, generator=torch.Generator())
 val_loader = DataLoader(val_dataset, batch_size=64, shuffle=False)
 
 import torch
@@ -82,6 +312,27 @@ import torchvision.models as models
 import torch.nn.functional as F
 import numpy as np
 
+# Batched Resize + ToTensor for the uint8 batches of a raw FacePairsDataset, float batches pass through
+def prepare_batch(images, size):
+    if images.dtype != torch.uint8:
+        return images
+    images = images.float().div_(255)
+    if tuple(images.shape[-2:]) != (size, size):
+        images = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False, antialias=True)
+    return images
+
+# Embed both sides of a pair batch with each unique image id embedded once, then gather back to pair order.
+# The gradient of a shared embedding is the sum over its copies, which matches separate calls only when no layer
+# normalises with batch statistics: only used by the BatchNorm-free models (VGG-16 HED, ViT)
+def embed_unique(embed, x1, x2, ids1, ids2):
+    ids = torch.cat([ids1, ids2])
+    unique_ids, inverse = torch.unique(ids, return_inverse=True)
+    positions = torch.arange(ids.numel(), device=ids.device)
+    first = torch.full_like(unique_ids, ids.numel()).scatter_reduce_(0, inverse, positions, reduce='amin')
+    out = embed(torch.cat([x1, x2]).index_select(0, first.to(x1.device)))
+    out = out.index_select(0, inverse.to(out.device))
+    return out[:x1.size(0)], out[x1.size(0):]
+
 import timm
 
 class ContrastiveLoss(nn.Module):
@@ -96,83 +347,252 @@ class ContrastiveLoss(nn.Module):
                (1 - label) * torch.pow(torch.clamp(self.margin - euclidean_distance, min=0.0), 2)
         return loss.mean()
 
+# Running loss / accuracy kept as device tensors, read back once per epoch instead of with .item() every batch
+class MetricsAccumulator:
+    def __init__(self, threshold=0.5):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = 0.0
+        self.correct = 0.0
+        self.count = 0
+
+    def update(self, out1, out2, labels, loss):
+        with torch.no_grad():
+            distances = F.pairwise_distance(out1.float(), out2.float())
+            preds = (distances < self.threshold).float()
+            self.correct = self.correct + (preds == labels).float().sum()
+            # Batch means are weighted by batch size, so a short last batch counts for what it holds
+            self.loss_sum = self.loss_sum + loss.detach().float() * labels.size(0)
+        self.count += labels.size(0)
+
+    def compute(self):
+        return float(self.loss_sum) / self.count, float(self.correct) / self.count
+
+# Mixed precision for the training loops: CUDA fp16 with a GradScaler, CPU bfloat16 where the CPU computes bf16
+# natively (AMX / AVX512-BF16), fp32 otherwise. bf16 keeps the fp32 exponent range, so off CUDA the scaler is a no-op
+def cpu_supports_bf16():
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'amx_bf16' in flags or 'avx512_bf16' in flags
+
+class MixedPrecision:
+    def __init__(self, device, enabled=True):
+        self.device_type = torch.device(device).type
+        if self.device_type == 'cuda':
+            self.dtype = torch.float16
+        elif self.device_type == 'cpu' and cpu_supports_bf16():
+            self.dtype = torch.bfloat16
+        else:
+            self.dtype = None
+        self.enabled = enabled and self.dtype is not None
+        self.scaler = torch.amp.GradScaler(self.device_type, enabled=self.enabled and self.dtype == torch.float16)
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    def __repr__(self):
+        return f"MixedPrecision({self.device_type}, {self.dtype if self.enabled else 'fp32'})"
+
+# Exact resume: a training state holds model, optimizer, GradScaler, RNG and running metrics plus the position
+# (resume_epoch, resume_step = batches of that epoch already done). Train loaders draw their worker seeds from
+# their own generator, so restoring the global RNG reproduces the uninterrupted run from that step on
+RESUME_EVERY_STEPS = 200
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_training_state(path, model, optimizer, scaler, resume_epoch, resume_step, metrics=None, **extra):
+    state = {
+        'resume_epoch': resume_epoch,
+        'resume_step': resume_step,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scaler_state_dict': scaler.state_dict() if scaler is not None else None,
+        'rng_state': rng_state(),
+        'metrics': vars(metrics) if metrics is not None else None
+    }
+    state.update(extra)
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def load_training_state(path, model, optimizer, scaler):
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if 'resume_epoch' not in checkpoint:
+        raise ValueError(f"Checkpoint has no resume state: {path}")
+    model.load_state_dict(checkpoint['model_state_dict'])
+    optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+    if scaler is not None and checkpoint['scaler_state_dict'] is not None:
+        scaler.load_state_dict(checkpoint['scaler_state_dict'])
+    set_rng_state(checkpoint['rng_state'])
+    return checkpoint
+
+# Evaluation engine: embed each unique face of the split once, then score every pair from the embedding table
+def embed_faces(model, dataset, device, batch_size=64, num_workers=4):
+    faces = UniqueFacesDataset(dataset)
+    loader = DataLoader(faces, batch_size=batch_size, shuffle=False, num_workers=num_workers, pin_memory=True)
+    model.eval()
+    embeddings = []
+    with torch.no_grad():
+        for images in loader:
+            embeddings.append(model.forward_once(images.to(device)).float())
+    return faces.ids, torch.cat(embeddings)
+
+def evaluate_pairs(model, dataset, device, criterion=None, threshold=0.5, batch_size=64, num_workers=4):
+    ids, embeddings = embed_faces(model, dataset, device, batch_size, num_workers)
+    rows = torch.from_numpy(np.searchsorted(ids, dataset.pairs[:, :2])).long().to(embeddings.device)
+    labels = torch.from_numpy(dataset.pairs[:, 2]).float().to(embeddings.device)
+    out1, out2 = embeddings[rows[:, 0]], embeddings[rows[:, 1]]
+    distances = F.pairwise_distance(out1, out2)
+    preds = (distances < threshold).float()
+    results = {
+        'accuracy': (preds == labels).float().mean().item(),
+        'distances': distances.cpu(),
+        'num_images': len(ids),
+        'num_pairs': len(labels)
+    }
+    if criterion is not None:
+        results['loss'] = criterion(out1, out2, labels).item()
+    return results
+
 import matplotlib.pyplot as plt
 
+# Pretrained backbones come from a local registry in weights_root: one flat state-dict file per backbone,
+# sha256-checked against registry.json and memory-mapped on load. A missing entry is fetched once from
+# PRETRAINED_SOURCES, which needs network, so populate the registry on such a machine first.
+PRETRAINED_SOURCES = {
+    "vit_base_patch16_224": lambda: timm.create_model('vit_base_patch16_224', pretrained=True),
+}
+_verified_weights = set()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_weight_registry(weights_dir):
+    registry_path = os.path.join(weights_dir, "registry.json")
+    if not os.path.exists(registry_path):
+        return {}
+    with open(registry_path, 'r') as f:
+        return json.load(f)
+
+def register_weights(name, state_dict, weights_dir=None):
+    weights_dir = weights_dir or weights_root
+    os.makedirs(weights_dir, exist_ok=True)
+    path = os.path.join(weights_dir, f"{name}.pt")
+    torch.save({key: value.detach().cpu().contiguous() for key, value in state_dict.items()}, path)
+
+    registry = read_weight_registry(weights_dir)
+    registry[name] = {"file": f"{name}.pt", "sha256": file_sha256(path), "bytes": os.path.getsize(path)}
+    with open(os.path.join(weights_dir, "registry.json"), 'w') as f:
+        json.dump(registry, f, indent=2)
+    print(f"Registered pretrained weights {name} → {path}")
+
+def pretrained_state(name, weights_dir=None):
+    weights_dir = weights_dir or weights_root
+    registry = read_weight_registry(weights_dir)
+    if name not in registry:
+        register_weights(name, PRETRAINED_SOURCES[name]().state_dict(), weights_dir)
+        registry = read_weight_registry(weights_dir)
+
+    entry = registry[name]
+    path = os.path.join(weights_dir, entry["file"])
+    stat = os.stat(path)
+    # Hash once per file version and process, later loads are plain page-cache reads
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _verified_weights:
+        if file_sha256(path) != entry["sha256"]:
+            raise ValueError(f"Pretrained weights {name} do not match the registry hash: {path}")
+        _verified_weights.add(key)
+    return torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+
 # Embedded ViT and Siamese
 class ViTEmbeddingNet(nn.Module):
     def __init__(self, model_name='vit_base_patch16_224', pretrained=True):
         super(ViTEmbeddingNet, self).__init__()
-        self.vit = timm.create_model(model_name, pretrained=pretrained)
+        self.vit = timm.create_model(model_name, pretrained=False)
+        if pretrained:
+            self.vit.load_state_dict(pretrained_state(model_name))
         self.vit.reset_classifier(0)  # move classifier head
 
     def forward(self, x):
         return self.vit(x)
 
 class SiameseNetwork(nn.Module):
-    def __init__(self, embedding_net):
+    def __init__(self, embedding_net, input_size=224, single_pass=False):
         super(SiameseNetwork, self).__init__()
         self.embedding_net = embedding_net
-
-    def forward(self, x1, x2):
+        self.input_size = input_size
+        # single_pass = True embeds x1 and x2 as one 2B batch (one backbone call per step).
+        # ViT only uses LayerNorm, so the outputs are the same as two separate calls.
+        self.single_pass = single_pass
+
+    def forward_once(self, x):
+        return self.embedding_net(prepare_batch(x, self.input_size))
+
+    def forward(self, x1, x2, ids1=None, ids2=None):
+        if ids1 is not None:
+            return embed_unique(self.forward_once, x1, x2, ids1, ids2)
+        x1 = prepare_batch(x1, self.input_size)
+        x2 = prepare_batch(x2, self.input_size)
+        if self.single_pass:
+            out = self.embedding_net(torch.cat([x1, x2]))
+            return out[:x1.size(0)], out[x1.size(0):]
         out1 = self.embedding_net(x1)
         out2 = self.embedding_net(x2)
         return out1, out2
 
 # Train & Eval
-def train(model, loader, criterion, optimizer, device):
+# metrics / start_step continue a resumed epoch; on_step(step, metrics) runs after every optimizer step
+def train(model, loader, criterion, optimizer, device, metrics=None, start_step=0, on_step=None, amp=None):
     model.train()
-    total_loss = 0.0
-    correct = 0
-    total = 0
+    metrics = metrics if metrics is not None else MetricsAccumulator()
+    amp = amp if amp is not None else MixedPrecision(device, enabled=False)
 
-    for x1, x2, label in loader:
+    for step, (x1, x2, label, ids1, ids2) in enumerate(loader, start_step + 1):
         x1, x2, label = x1.to(device), x2.to(device), label.to(device)
 
         optimizer.zero_grad()
-        out1, out2 = model(x1, x2)
-        loss = criterion(out1, out2, label)
-        loss.backward()
-        optimizer.step()
-
-        dist = F.pairwise_distance(out1, out2)
-        pred = (dist < 0.5).float()
-        correct += (pred == label).sum().item()
-        total += label.size(0)
-        total_loss += loss.item()
-
-    return total_loss / len(loader), correct / total
-
-def evaluate(model, loader, device, threshold=0.5):
-    model.eval()
-    correct = total = 0
-    with torch.no_grad():
-        for x1, x2, label in loader:
-            x1, x2, label = x1.to(device), x2.to(device), label.to(device)
-            out1, out2 = model(x1, x2)
-            dist = F.pairwise_distance(out1, out2)
-            pred = (dist < threshold).float()
-            correct += (pred == label).sum().item()
-            total += label.size(0)
-    return correct / total
-
-def compute_val_loss(model, loader, criterion, device):
-    model.eval()
-    total_loss = 0.0
-    with torch.no_grad():
-        for x1, x2, label in loader:
-            x1, x2, label = x1.to(device), x2.to(device), label.to(device)
-            out1, out2 = model(x1, x2)
+        with amp.autocast():
+            out1, out2 = model(x1, x2, ids1, ids2)
             loss = criterion(out1, out2, label)
-            total_loss += loss.item()
-    return total_loss / len(loader)
+        amp.scaler.scale(loss).backward()
+        amp.scaler.step(optimizer)
+        amp.scaler.update()
+        metrics.update(out1, out2, label, loss)
+        if on_step is not None:
+            on_step(step, metrics)
+
+    return metrics.compute()
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 embedding_net = ViTEmbeddingNet()
-model = SiameseNetwork(embedding_net).to(device)
+model = SiameseNetwork(embedding_net, input_size=input_size).to(device)
 
 
 criterion = ContrastiveLoss()
 optimizer = torch.optim.Adam(model.parameters(), lr=4e-6)
+amp = MixedPrecision(device)
+print(f"Precision: {amp}")
 
 train_losses = []
 val_losses = []
@@ -182,14 +602,36 @@ val_accuracies = []
 save_dir = "/content/drive/MyDrive/Colab Notebooks/NE240/Holistic Processing /Forth Experiment/ViT"
 os.makedirs(save_dir, exist_ok=True)
 
-for epoch in range(10):
-
-    train_loss, train_acc = train(model, train_loader, criterion, optimizer, device)
+# Resume point, replaced every RESUME_EVERY_STEPS steps and at the end of every epoch; removed once training ends
+resume_path = os.path.join(save_dir, "resume.pt")
+history = {"train_losses": train_losses, "val_losses": val_losses, "train_accuracies": train_accuracies, "val_accuracies": val_accuracies}
+start_epoch, start_step, metrics_state = 0, 0, None
+if os.path.exists(resume_path):
+    checkpoint = load_training_state(resume_path, model, optimizer, amp.scaler)
+    for key, values in checkpoint['history'].items():
+        history[key].extend(values)
+    start_epoch, start_step, metrics_state = checkpoint['resume_epoch'], checkpoint['resume_step'], checkpoint['metrics']
+    print(f"Resuming at epoch {start_epoch+1}, step {start_step}")
+
+for epoch in range(start_epoch, 10):
+
+    step = start_step if epoch == start_epoch else 0
+    metrics = MetricsAccumulator()
+    if step > 0:
+        metrics.__dict__.update(metrics_state)
+    train_loader.sampler.set_epoch(epoch, step * train_loader.batch_size)
+
+    def save_step(step, metrics, epoch=epoch):
+        if step % RESUME_EVERY_STEPS == 0:
+            save_training_state(resume_path, model, optimizer, amp.scaler, epoch, step, metrics, history=history)
+
+    train_loss, train_acc = train(model, train_loader, criterion, optimizer, device, metrics, step, save_step, amp)
     train_losses.append(train_loss)
     train_accuracies.append(train_acc)
 
-    val_loss = compute_val_loss(model, val_loader, criterion, device)
-    val_acc = evaluate(model, val_loader, device)
+    # Loss, accuracy and distances from one pass over the validation faces
+    val_results = evaluate_pairs(model, val_loader.dataset, device, criterion, batch_size=val_loader.batch_size)
+    val_loss, val_acc = val_results['loss'], val_results['accuracy']
     val_losses.append(val_loss)
     val_accuracies.append(val_acc)
 
@@ -233,15 +675,14 @@ for epoch in range(10):
     plt.close()
 
     if (epoch + 1) % 5 == 0 or epoch == 9:
-        torch.save({
-            'epoch': epoch + 1,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'train_loss': train_loss,
-            'val_loss': val_loss,
-            'train_acc': train_acc,
-            'val_acc': val_acc
-        }, os.path.join(save_dir, f"model_checkpoint_epoch_{epoch+1}.pt"))
+        # Also a full resume point (load_training_state)
+        save_training_state(os.path.join(save_dir, f"model_checkpoint_epoch_{epoch+1}.pt"), model, optimizer, amp.scaler, epoch + 1, 0,
+                            epoch=epoch + 1, train_loss=train_loss, val_loss=val_loss, train_acc=train_acc, val_acc=val_acc, history=history)
+
+    save_training_state(resume_path, model, optimizer, amp.scaler, epoch + 1, 0, history=history)
+
+if os.path.exists(resume_path):
+    os.remove(resume_path)
 
 plt.figure(figsize=(12, 5))
 
@@ -303,7 +744,7 @@ def enhance_red_in_saliency(model, dataset, device, num_samples=10, top_percent=
 
     for i in range(num_samples):
         img1, _, _ = dataset[i]
-        img1 = img1.unsqueeze(0).to(device).requires_grad_()
+        img1 = prepare_batch(img1.unsqueeze(0).to(device), model.input_size).requires_grad_()
 
         out1, _ = model.forward(img1, img1)
         score = out1.norm()
@@ -367,8 +808,8 @@ def predict_HED_over_time(img1_path, img2_path, model, device, transform=None, t
             transforms.ToTensor()
         ])
 
-    img1 = transform(Image.open(img1_path).convert("RGB")).unsqueeze(0).to(device)
-    img2 = transform(Image.open(img2_path).convert("RGB")).unsqueeze(0).to(device)
+    img1 = transform(load_image(img1_path)).unsqueeze(0).to(device)
+    img2 = transform(load_image(img2_path)).unsqueeze(0).to(device)
 
     model.eval()
     with torch.no_grad():